@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+🧪 本地模拟 LLM 服务
+
+同时模拟 Gemini generateContent/streamGenerateContent、Anthropic Messages
+和 ModelScope（OpenAI 兼容）chat/completions 接口，延迟服从对数正态分布，
+可按比例注入 429/503 错误，用于压测而不消耗真实配额。
+
+    python benchmarks/mock_llm_server.py --port 9101 --median-ms 800 \
+        --sigma 0.4 --error-rate 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockProfile:
+    """模拟服务的延迟和错误配置"""
+
+    median_ms: float = 800.0
+    sigma: float = 0.4
+    error_rate: float = 0.0
+    output_tokens: int = 200
+    chunk_tokens: int = 10
+
+    def latency(self) -> float:
+        """首字节前的延迟（秒），对数正态分布"""
+        return random.lognormvariate(math.log(self.median_ms / 1000), self.sigma)
+
+    def should_fail(self) -> bool:
+        return random.random() < self.error_rate
+
+    def text(self) -> str:
+        return " ".join(["token"] * self.output_tokens)
+
+    def chunks(self):
+        words = ["token"] * self.output_tokens
+        for start in range(0, len(words), self.chunk_tokens):
+            stop = start + self.chunk_tokens
+            yield " ".join(words[start:stop]) + " "
+
+
+def create_app(profile: MockProfile) -> FastAPI:
+    app = FastAPI(title="Mock LLM")
+    stats = {"requests": 0, "errors": 0}
+
+    async def prepare():
+        """模拟排队和推理延迟，按比例返回限流或服务不可用"""
+        stats["requests"] += 1
+        await asyncio.sleep(profile.latency())
+        if profile.should_fail():
+            stats["errors"] += 1
+            status = random.choice([429, 503])
+            return JSONResponse(
+                status_code=status,
+                content={"error": {"code": status, "message": "injected failure"}},
+            )
+        return None
+
+    def sse(payload: dict, event: str = "") -> str:
+        prefix = f"event: {event}\n" if event else ""
+        return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+    async def paced(frames):
+        """逐块输出，块间隔按中位延迟的 1% 计算"""
+        for frame in frames:
+            yield frame
+            await asyncio.sleep(profile.median_ms / 1000 * 0.01)
+
+    @app.get("/health")
+    async def health():
+        return stats
+
+    @app.post("/v1beta/models/{model_action}")
+    async def gemini(model_action: str, request: Request):
+        await request.body()
+        failure = await prepare()
+        if failure is not None:
+            return failure
+        usage = {"promptTokenCount": 120, "candidatesTokenCount": profile.output_tokens}
+        if model_action.endswith(":streamGenerateContent"):
+            frames = [
+                sse(
+                    {
+                        "candidates": [
+                            {"content": {"parts": [{"text": chunk}], "role": "model"}}
+                        ]
+                    }
+                )
+                for chunk in profile.chunks()
+            ]
+            frames.append(
+                sse(
+                    {
+                        "candidates": [
+                            {
+                                "content": {"parts": [{"text": ""}]},
+                                "finishReason": "STOP",
+                            }
+                        ],
+                        "usageMetadata": usage,
+                    }
+                )
+            )
+            return StreamingResponse(paced(frames), media_type="text/event-stream")
+        return {
+            "candidates": [
+                {"content": {"parts": [{"text": profile.text()}], "role": "model"}}
+            ],
+            "usageMetadata": usage,
+        }
+
+    @app.post("/v1/messages")
+    async def anthropic(request: Request):
+        body = await request.json()
+        failure = await prepare()
+        if failure is not None:
+            return failure
+        if body.get("stream"):
+            frames = [
+                sse(
+                    {
+                        "type": "message_start",
+                        "message": {"usage": {"input_tokens": 120, "output_tokens": 1}},
+                    },
+                    "message_start",
+                )
+            ]
+            frames.extend(
+                sse(
+                    {
+                        "type": "content_block_delta",
+                        "index": 0,
+                        "delta": {"type": "text_delta", "text": chunk},
+                    },
+                    "content_block_delta",
+                )
+                for chunk in profile.chunks()
+            )
+            frames.append(
+                sse(
+                    {
+                        "type": "message_delta",
+                        "delta": {"stop_reason": "end_turn"},
+                        "usage": {"output_tokens": profile.output_tokens},
+                    },
+                    "message_delta",
+                )
+            )
+            frames.append(sse({"type": "message_stop"}, "message_stop"))
+            return StreamingResponse(paced(frames), media_type="text/event-stream")
+        return {
+            "content": [{"type": "text", "text": profile.text()}],
+            "usage": {"input_tokens": 120, "output_tokens": profile.output_tokens},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def openai_compatible(request: Request):
+        body = await request.json()
+        failure = await prepare()
+        if failure is not None:
+            return failure
+        usage = {"prompt_tokens": 120, "completion_tokens": profile.output_tokens}
+        if body.get("stream"):
+            frames = [
+                sse({"choices": [{"index": 0, "delta": {"content": chunk}}]})
+                for chunk in profile.chunks()
+            ]
+            frames.append(
+                sse(
+                    {
+                        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    }
+                )
+            )
+            frames.append("data: [DONE]\n\n")
+            return StreamingResponse(paced(frames), media_type="text/event-stream")
+        return {
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": profile.text()},
+                }
+            ],
+            "usage": usage,
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 LLM 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9101)
+    parser.add_argument(
+        "--median-ms", type=float, default=800.0, help="延迟中位数（毫秒）"
+    )
+    parser.add_argument(
+        "--sigma", type=float, default=0.4, help="对数正态分布的 sigma，越大长尾越重"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="注入 429/503 的比例"
+    )
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    profile = MockProfile(
+        args.median_ms, args.sigma, args.error_rate, args.output_tokens
+    )
+    uvicorn.run(
+        create_app(profile), host=args.host, port=args.port, log_level="warning"
+    )
+
+
+if __name__ == "__main__":
+    main()
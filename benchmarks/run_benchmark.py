@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+📈 GEO 平台压测
+
+启动三个本地模拟 LLM 服务（Gemini / Anthropic / ModelScope）和指向它们的平台实例，
+按递增并发驱动各接口，输出吞吐、p50/p95/p99 延迟和服务进程内存，结果写为 JSON。
+指定 --baseline 时与历史结果对比，超出阈值的退化会以非零状态码退出。
+
+    python benchmarks/run_benchmark.py --concurrency 1,8,32 --requests 200 \
+        --output bench.json
+    python benchmarks/run_benchmark.py --baseline bench.json --max-regression 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform as runtime
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+MARKETS = [
+    "USA",
+    "Canada",
+    "UK",
+    "Germany",
+    "France",
+    "Australia",
+    "Japan",
+    "Singapore",
+]
+
+# ==================== 压测场景 ====================
+
+
+def generate_payload(index: int) -> Dict[str, Any]:
+    return {
+        "prompt": f"推广我们的AI产品 #{index}",
+        "target_market": MARKETS[index % len(MARKETS)],
+        "content_type": "social_media",
+        "bypass_cache": True,
+    }
+
+
+def geo_optimize_payload(index: int) -> Dict[str, Any]:
+    return {
+        "prompt": f"优化我们的营销内容 #{index}",
+        "platform": "social_media",
+        "goal": "engagement",
+    }
+
+
+def batch_payload(index: int) -> Dict[str, Any]:
+    return {
+        "jobs": [
+            {
+                "prompt": f"推广我们的AI产品 #{index}",
+                "target_market": market,
+                "bypass_cache": True,
+            }
+            for market in MARKETS
+        ]
+    }
+
+
+SCENARIOS: Dict[str, Tuple[str, Callable[[int], Dict[str, Any]], bool]] = {
+    # 名称: (路径, 请求体, 是否为 SSE 流)
+    "generate": ("/api/v1/overseas_content/generate", generate_payload, False),
+    "generate_race": (
+        "/api/v1/overseas_content/generate",
+        lambda i: {**generate_payload(i), "mode": "race"},
+        False,
+    ),
+    "generate_stream": (
+        "/api/v1/overseas_content/generate/stream",
+        generate_payload,
+        True,
+    ),
+    "geo_optimize": ("/api/v1/geo_optimize", geo_optimize_payload, False),
+    "batch": ("/api/v1/overseas_content/batch", batch_payload, False),
+}
+
+# ==================== 进程管理 ====================
+
+
+def spawn(args: List[str]) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable] + args, cwd=ROOT_DIR)
+
+
+async def wait_ready(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务未就绪: {url}")
+
+
+def process_memory_mb(pid: int) -> Dict[str, Optional[float]]:
+    """读取 /proc 中的常驻内存和峰值内存，非 Linux 平台返回空值"""
+    memory: Dict[str, Optional[float]] = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+# ==================== 压测执行 ====================
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def to_ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 1) if value is not None else None
+
+
+def summarize(latencies: List[float]) -> Dict[str, Optional[float]]:
+    ordered = sorted(latencies)
+    return {
+        "p50": to_ms(percentile(ordered, 0.50)),
+        "p95": to_ms(percentile(ordered, 0.95)),
+        "p99": to_ms(percentile(ordered, 0.99)),
+        "mean": to_ms(sum(ordered) / len(ordered)) if ordered else None,
+        "max": to_ms(ordered[-1]) if ordered else None,
+    }
+
+
+async def one_request(
+    client: httpx.AsyncClient, path: str, payload: Dict[str, Any], streaming: bool
+) -> Tuple[bool, float, Optional[float]]:
+    """返回 (是否成功, 总耗时, 首个结果事件耗时)"""
+    started = time.perf_counter()
+    first_result = None
+    try:
+        if streaming:
+            async with client.stream("POST", path, json=payload) as response:
+                ok = response.status_code == 200
+                async for line in response.aiter_lines():
+                    if first_result is None and line.startswith("event: result"):
+                        first_result = time.perf_counter() - started
+            return ok, time.perf_counter() - started, first_result
+        response = await client.post(path, json=payload)
+        ok = response.status_code == 200 and response.json().get("success", False)
+        return ok, time.perf_counter() - started, None
+    except httpx.HTTPError:
+        return False, time.perf_counter() - started, None
+
+
+async def run_level(
+    base_url: str, scenario: str, concurrency: int, total: int, app_pid: int
+) -> Dict[str, Any]:
+    path, make_payload, streaming = SCENARIOS[scenario]
+    latencies: List[float] = []
+    first_results: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120.0
+    ) as client:
+
+        async def worker():
+            nonlocal errors
+            for index in counter:
+                ok, elapsed, first = await one_request(
+                    client, path, make_payload(index), streaming
+                )
+                latencies.append(elapsed)
+                if first is not None:
+                    first_results.append(first)
+                if not ok:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(total / duration, 2),
+        "latency_ms": summarize(latencies),
+        "memory": process_memory_mb(app_pid),
+    }
+    if first_results:
+        result["first_result_ms"] = summarize(first_results)
+    return result
+
+
+# ==================== 回归对比 ====================
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    """p95 延迟升高或吞吐下降超过阈值即视为退化"""
+    previous = {(item["scenario"], item["concurrency"]): item for item in baseline}
+    regressions = []
+    for item in results:
+        old = previous.get((item["scenario"], item["concurrency"]))
+        if old is None:
+            continue
+        label = f"{item['scenario']}@{item['concurrency']}"
+        old_p95, new_p95 = old["latency_ms"]["p95"], item["latency_ms"]["p95"]
+        if old_p95 and new_p95 and new_p95 > old_p95 * (1 + tolerance):
+            regressions.append(f"{label}: p95 {old_p95}ms -> {new_p95}ms")
+        if item["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: 吞吐 {old['throughput_rps']} -> {item['throughput_rps']} req/s"
+            )
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main_async(args) -> int:
+    mock_ports = {
+        "gemini": args.mock_base_port,
+        "claude": args.mock_base_port + 1,
+        "mota": args.mock_base_port + 2,
+    }
+    processes = []
+    try:
+        for index, port in enumerate(mock_ports.values()):
+            processes.append(
+                spawn(
+                    [
+                        os.path.join(BENCH_DIR, "mock_llm_server.py"),
+                        "--port",
+                        str(port),
+                        "--median-ms",
+                        str(args.mock_median_ms),
+                        "--sigma",
+                        str(args.mock_sigma),
+                        "--error-rate",
+                        str(args.mock_error_rate),
+                        "--seed",
+                        str(args.seed + index),
+                    ]
+                )
+            )
+        for port in mock_ports.values():
+            await wait_ready(f"http://127.0.0.1:{port}/health")
+
+        app = spawn(
+            [
+                os.path.join(BENCH_DIR, "serve_app.py"),
+                "--port",
+                str(args.app_port),
+                "--gemini-url",
+                f"http://127.0.0.1:{mock_ports['gemini']}",
+                "--claude-url",
+                f"http://127.0.0.1:{mock_ports['claude']}",
+                "--mota-url",
+                f"http://127.0.0.1:{mock_ports['mota']}/v1",
+            ]
+        )
+        processes.append(app)
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        await wait_ready(f"{base_url}/api/v1/health")
+
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                total = max(args.requests, concurrency)
+                result = await run_level(
+                    base_url, scenario, concurrency, total, app.pid
+                )
+                results.append(result)
+                latency = result["latency_ms"]
+                print(
+                    f"{scenario:<16} c={concurrency:<4} "
+                    f"{result['throughput_rps']:>8} req/s  "
+                    f"p50={latency['p50']}ms p95={latency['p95']}ms "
+                    f"p99={latency['p99']}ms  errors={result['errors']}  "
+                    f"rss={result['memory']['rss_mb']}MB",
+                    file=sys.stderr,
+                )
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    report = {
+        "meta": {
+            "started_at": datetime.now().isoformat(),
+            "git_commit": git_commit(),
+            "python": runtime.python_version(),
+            "mock": {
+                "median_ms": args.mock_median_ms,
+                "sigma": args.mock_sigma,
+                "error_rate": args.mock_error_rate,
+            },
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as handle:
+            regressions = compare(
+                results, json.load(handle)["results"], args.max_regression
+            )
+        for line in regressions:
+            print(f"⚠️ 性能退化 {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GEO 平台压测")
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=["generate", "geo_optimize", "batch"],
+        help=f"逗号分隔，可选: {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(item) for item in value.split(",")],
+        default=[1, 8, 32],
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="每个并发级别的请求数"
+    )
+    parser.add_argument("--app-port", type=int, default=9100)
+    parser.add_argument("--mock-base-port", type=int, default=9101)
+    parser.add_argument("--mock-median-ms", type=float, default=300.0)
+    parser.add_argument("--mock-sigma", type=float, default=0.4)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="结果 JSON 文件，不指定时输出到标准输出")
+    parser.add_argument("--baseline", help="用于对比的历史结果 JSON")
+    parser.add_argument(
+        "--max-regression", type=float, default=0.15, help="允许的退化比例"
+    )
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知场景: {', '.join(unknown)}")
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
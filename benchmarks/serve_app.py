@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+以压测配置启动 GEO 平台：三个 AI 服务指向本地模拟 LLM 服务。
+
+    python benchmarks/serve_app.py --port 9100 --gemini-url http://127.0.0.1:9101 \
+        --claude-url http://127.0.0.1:9102 --mota-url http://127.0.0.1:9103/v1
+"""
+
+import argparse
+import os
+import sys
+
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARK_KEY = "benchmark-key"
+
+
+def configure(gemini_url: str, claude_url: str, mota_url: str):
+    """通过环境变量替换上游地址和密钥，需在导入平台模块之前调用"""
+    os.environ.update(
+        {
+            "GEMINI_BASE_URL": gemini_url,
+            "CLAUDE_BASE_URL": claude_url,
+            "MOTA_API_BASE_URL": mota_url,
+            "GOOGLE_API_KEY": BENCHMARK_KEY,
+            "ANTHROPIC_API_KEY": BENCHMARK_KEY,
+            "MOTA_ACCESS_TOKEN": BENCHMARK_KEY,
+            # 模拟服务没有配额，压测只衡量平台自身的开销
+            "RATE_LIMIT_ENABLED": "false",
+            "CLIENT_RATE_LIMIT_RPM": "0",
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以压测配置启动 GEO 平台")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--gemini-url", required=True)
+    parser.add_argument("--claude-url", required=True)
+    parser.add_argument("--mota-url", required=True)
+    args = parser.parse_args()
+
+    configure(args.gemini_url, args.claude_url, args.mota_url)
+    import geo_content_platform as platform
+
+    uvicorn.run(platform.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
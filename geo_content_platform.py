@@ -11,17 +11,50 @@
 """
 
 import asyncio
+import bisect
+import codecs
+import contextvars
+import gzip
+import hashlib
+import ipaddress
 import json
 import logging
-from typing import Dict, List, Optional, Any
+import math
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional, Any, AsyncIterator, Awaitable, Callable, Deque, Iterator, Set, Tuple, Union
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
+from urllib.parse import urlsplit
 import httpx
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-import uvicorn
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.datastructures import Headers, MutableHeaders
+from pydantic import BaseModel, Field, ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时回退到标准库 json
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # 可选依赖，未安装时只提供 gzip
+    brotli = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -35,22 +68,215 @@ class ContentRequest(BaseModel):
     content_type: str = Field("social_media", description="内容类型")
     tone: str = Field("professional", description="语调风格")
     length: str = Field("medium", description="内容长度")
+    bypass_cache: bool = Field(False, description="跳过响应缓存，强制重新生成")
+    mode: str = Field("all", description="生成模式: all 等待全部模型, race 返回最先成功的模型")
+    hedge: bool = Field(False, description="竞速模式下按首选模型的p95延迟错峰发起其余模型")
+    hedge_delay_ms: Optional[int] = Field(None, ge=0, description="竞速模式下的对冲延迟（毫秒），优先于自动p95")
+    include_market_config: bool = Field(False, description="响应中附带完整市场配置，默认只返回市场摘要")
+    stream_deltas: bool = Field(False, description="流式接口中逐段推送模型输出（delta 事件）")
+    reuse: str = Field("off", description="近似重复复用: off 仅在响应中提示相似的历史生成, result 直接返回其结果, seed 作为参考附加到提示词")
+
+class MultiMarketContentRequest(BaseModel):
+    prompt: str = Field(..., description="内容提示")
+    target_markets: Optional[List[str]] = Field(None, min_length=1, description="目标市场列表，默认全部市场")
+    content_type: str = Field("social_media", description="内容类型")
+    tone: str = Field("professional", description="语调风格")
+    length: str = Field("medium", description="内容长度")
+    bypass_cache: bool = Field(False, description="跳过响应缓存，强制重新生成")
+    include_market_config: bool = Field(False, description="响应中附带完整市场配置，默认只返回市场摘要")
+
+class BatchContentRequest(BaseModel):
+    jobs: List[ContentRequest] = Field(..., min_length=1, description="生成任务列表")
+    concurrency: Optional[int] = Field(None, ge=1, description="本批次并发上限，不超过全局上限")
+    stream: bool = Field(False, description="是否按完成顺序以NDJSON流式返回")
+
+class ContentJobRequest(ContentRequest):
+    priority: int = Field(5, ge=0, le=9, description="任务优先级，0最高、9最低")
+    webhook_url: Optional[str] = Field(
+        None, pattern=r"^https?://[^\s/?#]+(?:[/?#]\S*)?$", description="任务完成后回调的 http(s) 地址（POST JSON）"
+    )
 
 class GEORequest(BaseModel):
     prompt: str = Field(..., description="优化提示")
     platform: str = Field("general", description="目标平台")
     goal: str = Field("engagement", description="优化目标")
+    target_market: Optional[str] = Field(None, description="目标市场，提供时附带该市场的优化建议")
+    timeout_ms: Optional[int] = Field(None, ge=1, description="处理时限（毫秒），不超过服务端上限")
 
-class Settings:
-    """配置管理"""
-    def __init__(self):
-        self.google_api_key = "your_google_gemini_api_key"
-        self.anthropic_api_key = "your_anthropic_claude_api_key"
-        self.mota_access_token = "ms-14bd4f7d-1b74-42e5-9ded-fcbbbbd79619"
-        self.mota_api_base_url = "https://api-inference.modelscope.cn/v1"
-        self.host = "0.0.0.0"
-        self.port = 8000
-        self.debug = True
+class GEOScoreRequest(BaseModel):
+    texts: List[str] = Field(..., min_length=1, description="待评分的候选文本")
+    keywords: List[str] = Field(default_factory=list, description="目标关键词")
+    long_tail_keywords: Optional[List[str]] = Field(None, description="长尾关键词，默认取关键词中三个词及以上的短语")
+    platform: str = Field("general", description="目标平台或平台类别")
+    goal: str = Field("engagement", description="优化目标")
+    top_k: Optional[int] = Field(None, ge=1, description="只返回得分最高的前若干条")
+    timeout_ms: Optional[int] = Field(None, ge=1, description="处理时限（毫秒），不超过服务端上限")
+
+class Settings(BaseSettings):
+    """配置管理：从环境变量和 .env 读取，变量名即字段名的大写形式（见 env.example）"""
+    
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
+    
+    # AI模型密钥，your_ 开头的占位密钥走演示模式
+    google_api_key: str = "your_google_gemini_api_key"
+    anthropic_api_key: str = "your_anthropic_claude_api_key"
+    mota_access_token: str = "your_mota_access_token"
+    mota_api_base_url: str = "https://api-inference.modelscope.cn/v1"
+    # 启用的服务商，逗号分隔；未启用的服务商不会创建
+    enabled_providers: str = "gemini,claude,deepseek"
+    
+    # 服务
+    host: str = "0.0.0.0"
+    port: int = 8000
+    log_level: str = "INFO"
+    # debug 为开发模式（单进程热重载）；生产模式按 workers 启动多进程
+    debug: bool = False
+    workers: int = 1
+    keep_alive_timeout: int = 5
+    # 缓存、限流配额的存储: auto（workers > 1 时用 sqlite）/ local / sqlite
+    state_backend: str = "auto"
+    
+    # 模型与接口地址
+    gemini_base_url: str = "https://generativelanguage.googleapis.com"
+    gemini_model: str = "gemini-pro"
+    claude_base_url: str = "https://api.anthropic.com"
+    claude_model: str = "claude-3-5-sonnet-20240620"
+    mota_model: str = "deepseek-ai/DeepSeek-V3.1"
+    max_tokens: int = 2048
+    temperature: float = 0.7
+    
+    # Token预算：输出上限 = 内容长度基准 × 内容类型系数 × 服务商分词密度，不超过 max_tokens；
+    # 提示词估算超过 prompt_token_budget 时逐级精简市场段落（多市场合并调用按市场数放宽）
+    token_budget_enabled: bool = True
+    length_output_tokens: Dict[str, int] = {"short": 300, "medium": 800, "long": 1600}
+    content_type_token_factors: Dict[str, float] = {
+        "social_media": 0.5,
+        "marketing_copy": 0.75,
+        "email_marketing": 1.0,
+        "blog_post": 1.5
+    }
+    prompt_token_budget: int = 1024
+    
+    # HTTP连接池
+    http2: bool = True
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http_connect_timeout: float = 5.0
+    http_read_timeout: float = 60.0
+    http_pool_timeout: float = 10.0
+    
+    # 响应缓存: auto（单进程 memory，多进程 sqlite）/ memory / sqlite / none
+    cache_backend: str = "auto"
+    cache_max_entries: int = 1024
+    cache_ttl_seconds: float = 3600.0
+    database_url: str = "sqlite:///./mcp_server.db"
+    
+    # 并发控制
+    provider_max_concurrency: int = 16
+    batch_max_concurrency: int = 8
+    batch_max_jobs: int = 100
+    # 多市场合并调用的输出上限：按单市场输出上限 × 市场数 计算，不超过此值（截断时未输出完整的市场逐个补生成）
+    multi_market_max_tokens: int = 8192
+    
+    # GEO优化策略数据文件，相对路径相对于本模块所在目录
+    geo_strategy_file: str = "geo_strategies.json"
+    # GEO评分单批上限
+    geo_score_max_texts: int = 5000
+    geo_score_max_keywords: int = 500
+    # GEO分析放到事件循环之外：单条优化和小批量评分用线程池，大批量评分用进程池（0 表示不用进程池）
+    optimizer_threads: int = 4
+    optimizer_processes: int = 2
+    optimizer_process_min_texts: int = 200
+    # 处理时限（秒，含排队），请求可通过 timeout_ms 进一步缩短
+    optimizer_timeout: float = 2.0
+    optimizer_batch_timeout: float = 30.0
+    # 事件循环延迟的采样间隔（秒），0 表示不采样
+    event_loop_lag_interval: float = 0.5
+    
+    # 异步任务队列，任务状态写入 database_url 指向的 SQLite
+    job_workers: int = 4
+    job_queue_max_size: int = 1000
+    job_retention_seconds: float = 7 * 24 * 3600.0
+    job_webhook_timeout: float = 10.0
+    job_webhook_max_attempts: int = 3
+    # 回调地址的主机白名单（含子域名），为空时允许任意公网地址；名单内的主机不做内网地址检查
+    job_webhook_allowed_hosts: List[str] = []
+    # 是否允许回调到回环、内网和链路本地地址
+    job_webhook_allow_private: bool = False
+    job_poll_interval: float = 1.0
+    job_lease_seconds: float = 600.0
+    job_recovery_interval: float = 30.0
+    
+    # 限流：各服务商每分钟请求数和 token 数，按 headroom 留出余量匀速放行
+    provider_rate_limits: Dict[str, Dict[str, float]] = {
+        "gemini": {"rpm": 60, "tpm": 1000000},
+        "claude": {"rpm": 50, "tpm": 80000},
+        "deepseek": {"rpm": 60, "tpm": 200000}
+    }
+    rate_limit_enabled: bool = True
+    rate_limit_headroom: float = 0.9
+    rate_limit_burst_seconds: float = 5.0
+    rate_limit_queue_size: int = 64
+    # 按 API Key（无则按客户端IP）限制入口请求；只有 client_api_keys 中配置的 Key 才单独计数，
+    # 其他 Key 不可信，按客户端IP计数
+    client_rate_limit_rpm: int = 120
+    client_rate_limit_burst: int = 20
+    client_rate_limit_max_clients: int = 10000
+    client_api_keys: List[str] = []
+    # 可信反向代理的地址或网段，来自这些地址的请求按 X-Forwarded-For 取真实客户端IP
+    trusted_proxies: List[str] = []
+    
+    # 响应压缩
+    response_compression: bool = True
+    compression_minimum_size: int = 1024
+    
+    # 近似重复复用：历史生成的 SimHash 索引，按 (市场, 内容类型, 语调, 长度) 分区，持久化到 database_url
+    near_duplicate_enabled: bool = True
+    near_duplicate_threshold: float = 0.90625
+    near_duplicate_max_entries: int = 2000
+    near_duplicate_shingle_size: int = 3
+    near_duplicate_seed_chars: int = 2000
+    
+    # 生成历史：单独的 SQLite 文件，避免与缓存、任务队列争用写锁；请求路径只入队，后台批量写入
+    history_enabled: bool = True
+    history_database_url: str = "sqlite:///./generation_history.db"
+    history_queue_size: int = 10000
+    history_batch_size: int = 500
+    history_read_threads: int = 2
+    history_page_size: int = 20
+    history_max_page_size: int = 100
+    
+    # 流式接口每个请求缓冲的增量事件数，客户端读取慢时暂停读取上游
+    stream_buffer_size: int = 64
+    
+    # 相同的并发请求合并
+    single_flight_enabled: bool = True
+    
+    # 竞速模式
+    latency_window: int = 200
+    hedge_default_delay: float = 2.0
+    
+    # 容错：重试、熔断、自适应超时
+    retry_max_attempts: int = 3
+    retry_base_delay: float = 0.2
+    retry_max_delay: float = 2.0
+    breaker_failure_threshold: int = 5
+    breaker_recovery_timeout: float = 30.0
+    timeout_min: float = 5.0
+    timeout_max: float = 60.0
+    timeout_p99_multiplier: float = 2.0
+    
+    @property
+    def provider_names(self) -> List[str]:
+        return [name.strip().lower() for name in self.enabled_providers.split(",") if name.strip()]
+
+@lru_cache()
+def get_settings() -> Settings:
+    """进程内共享一份配置，只解析一次环境变量和 .env"""
+    return Settings()
+
+logging.getLogger().setLevel(get_settings().log_level.upper())
 
 # ==================== 海外市场配置 ====================
 
@@ -177,176 +403,3827 @@ MARKET_CONFIGS = {
     }
 }
 
+# ==================== 提示词模板 ====================
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """版本化的提示词模板：{market_section} 启动时预编译，{prompt} 请求时拼接"""
+    name: str
+    version: str
+    text: str
+
+MARKET_SECTION_TEMPLATE = (
+    "目标市场: {name} {flag}\n"
+    "        文化特点: {cultural_traits}\n"
+    "        内容偏好: {content_preferences}\n"
+    "        优化建议: {optimization_tips}"
+)
+
+# 提示词超出预算时依次使用的精简市场段落：先省略文化特点，再只保留内容偏好
+COMPACT_MARKET_SECTION_TEMPLATES = (
+    "目标市场: {name} {flag}\n"
+    "        内容偏好: {content_preferences}\n"
+    "        优化建议: {optimization_tips}",
+    "目标市场: {name} {flag}（{content_preferences}）"
+)
+
+PROMPT_TEMPLATES = {
+    "generation": PromptTemplate("generation", "v1", """
+        {market_section}
+        
+        原始提示: {prompt}
+        
+        请根据以上市场特点生成适合的内容。
+        """),
+    "optimization": PromptTemplate("optimization", "v1", """
+        {market_section}
+        
+        原始内容: {prompt}
+        
+        请使用DeepSeek-V3.1模型对以上内容进行优化，使其更适合目标市场。
+        """),
+    "generation_multi": PromptTemplate("generation_multi", "v1", """
+        {market_sections}
+        
+        原始提示: {prompt}
+        
+        请根据以上每个市场的特点分别生成适合的内容。
+        只输出一个 JSON 对象，键为市场代码（{market_codes}），值为该市场的内容字符串，不要输出其他文字。
+        """),
+    "optimization_multi": PromptTemplate("optimization_multi", "v1", """
+        {market_sections}
+        
+        原始内容: {prompt}
+        
+        请使用DeepSeek-V3.1模型对以上内容分别进行优化，使其更适合每个目标市场。
+        只输出一个 JSON 对象，键为市场代码（{market_codes}），值为该市场的优化内容字符串，不要输出其他文字。
+        """)
+}
+
+# 服务商使用的模板
+PROVIDER_TEMPLATES = {
+    "gemini": "generation",
+    "claude": "generation",
+    "deepseek": "optimization"
+}
+
+# 单市场模板对应的多市场模板：一次调用为多个市场生成，输出按市场代码分键的 JSON
+MULTI_MARKET_TEMPLATES = {
+    "generation": "generation_multi",
+    "optimization": "optimization_multi"
+}
+
+class PromptTemplateRegistry:
+    """提示词模板注册表：按 (市场, 服务商) 预编译不变部分，请求时只拼接用户提示"""
+    
+    def __init__(self, markets: Dict[str, dict], templates: Dict[str, PromptTemplate] = PROMPT_TEMPLATES,
+                 provider_templates: Dict[str, str] = PROVIDER_TEMPLATES):
+        self.templates = templates
+        self.provider_templates = provider_templates
+        self.market_sections = {code: self.build_market_section(config) for code, config in markets.items()}
+        # 级别 0 为完整段落，其后为逐级精简的段落
+        self.section_levels = {
+            code: [section] + [self.build_market_section(markets[code], compact) for compact in COMPACT_MARKET_SECTION_TEMPLATES]
+            for code, section in self.market_sections.items()
+        }
+        self.compact_levels = len(COMPACT_MARKET_SECTION_TEMPLATES)
+        self._compiled: Dict[Tuple[str, str, int], Tuple[str, str]] = {}
+        self._compiled_multi: Dict[Tuple[str, Tuple[str, ...], int], Tuple[str, str]] = {}
+        for code, sections in self.section_levels.items():
+            for provider, template_name in provider_templates.items():
+                for level, section in enumerate(sections):
+                    text = templates[template_name].text.replace("{market_section}", section)
+                    prefix, suffix = text.split("{prompt}")
+                    self._compiled[(code, provider, level)] = (prefix, suffix)
+    
+    @staticmethod
+    def build_market_section(market_config: dict, template: str = MARKET_SECTION_TEMPLATE) -> str:
+        """市场特点段落"""
+        return template.format(
+            name=market_config["name"],
+            flag=market_config["flag"],
+            cultural_traits=", ".join(market_config["cultural_traits"]),
+            content_preferences=", ".join(market_config["content_preferences"]),
+            optimization_tips=", ".join(market_config["optimization_tips"])
+        )
+    
+    def render(self, provider: str, market_code: str, prompt: str, level: int = 0) -> str:
+        """拼接用户提示，生成完整提示词；level 为市场段落的精简级别"""
+        prefix, suffix = self._compiled[(market_code, provider, level)]
+        return prefix + prompt + suffix
+    
+    def render_markets(self, provider: str, market_codes: List[str], prompt: str, level: int = 0) -> str:
+        """多市场提示词：各市场段落只出现一次，用户提示也只出现一次；按 (服务商, 市场组合, 精简级别) 编译后复用"""
+        key = (provider, tuple(market_codes), level)
+        compiled = self._compiled_multi.get(key)
+        if compiled is None:
+            template = self.templates[MULTI_MARKET_TEMPLATES[self.provider_templates[provider]]]
+            sections = "\n\n        ".join(
+                f"市场代码: {code}\n        {self.section_levels[code][level]}" for code in market_codes
+            )
+            text = template.text.replace("{market_sections}", sections).replace("{market_codes}", ", ".join(market_codes))
+            prefix, suffix = text.split("{prompt}")
+            compiled = self._compiled_multi[key] = (prefix, suffix)
+        prefix, suffix = compiled
+        return prefix + prompt + suffix
+    
+    def version(self, provider: str) -> str:
+        """模板版本号，参与缓存键计算"""
+        template = self.templates[self.provider_templates[provider]]
+        return f"{template.name}@{template.version}"
+
+prompt_registry = PromptTemplateRegistry(MARKET_CONFIGS)
+
+# ==================== 监控指标 ====================
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """单调递增计数器"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+    
+    def inc(self, amount: float = 1.0, **labels: str):
+        self._values[tuple(labels[name] for name in self.labelnames)] += amount
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+class Gauge(Counter):
+    """可增可减的瞬时值"""
+    
+    kind = "gauge"
+    
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+    
+    def set(self, value: float, **labels: str):
+        self._values[tuple(labels[name] for name in self.labelnames)] = value
+
+class Histogram:
+    """累积分桶直方图"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+    
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[name] for name in self.labelnames)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+    
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += counts[-1]
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Prometheus 文本格式的指标注册表"""
+    
+    def __init__(self):
+        self._metrics: List[Any] = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+class Metrics:
+    """平台的全部监控指标"""
+    
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        register = self.registry.register
+        self.http_requests = register(Counter(
+            "geo_http_requests_total", "HTTP请求数", ("method", "route", "status")))
+        self.http_duration = register(Histogram(
+            "geo_http_request_duration_seconds", "HTTP请求耗时（到响应头发出）", ("method", "route")))
+        self.http_in_flight = register(Gauge(
+            "geo_http_requests_in_flight", "处理中的HTTP请求数"))
+        self.provider_calls = register(Counter(
+            "geo_provider_calls_total", "AI服务商调用数", ("provider", "outcome")))
+        self.provider_duration = register(Histogram(
+            "geo_provider_call_duration_seconds", "AI服务商调用耗时（含重试）", ("provider",)))
+        self.provider_in_flight = register(Gauge(
+            "geo_provider_calls_in_flight", "进行中的AI服务商调用数", ("provider",)))
+        self.prompt_build = register(Histogram(
+            "geo_prompt_build_seconds", "提示词构建耗时", ("provider",), FAST_BUCKETS))
+        self.gather_duration = register(Histogram(
+            "geo_generation_gather_seconds", "多模型并行生成的总耗时"))
+        self.slowest_provider = register(Histogram(
+            "geo_generation_slowest_provider_seconds", "多模型并行生成中最慢模型的耗时"))
+        self.cache_requests = register(Counter(
+            "geo_cache_requests_total", "响应缓存查询数", ("provider", "result")))
+        self.single_flight = register(Counter(
+            "geo_single_flight_requests_total", "请求合并统计", ("role",)))
+        self.rate_limit_wait = register(Histogram(
+            "geo_rate_limit_wait_seconds", "等待服务商配额的时间", ("provider",)))
+        self.rate_limit_queue = register(Gauge(
+            "geo_rate_limit_queue_depth", "等待服务商配额的调用数", ("provider",)))
+        self.rate_limited = register(Counter(
+            "geo_rate_limited_total", "被限流拒绝的请求数", ("scope",)))
+        self.jobs = register(Counter(
+            "geo_jobs_total", "异步生成任务数", ("status",)))
+        self.job_queue_depth = register(Gauge(
+            "geo_job_queue_depth", "排队中的异步生成任务数"))
+        self.job_duration = register(Histogram(
+            "geo_job_duration_seconds", "异步生成任务执行耗时"))
+        self.webhooks = register(Counter(
+            "geo_job_webhooks_total", "任务回调投递数", ("outcome",)))
+        self.optimizer_tasks = register(Counter(
+            "geo_optimizer_tasks_total", "GEO分析任务数", ("pool", "outcome")))
+        self.optimizer_duration = register(Histogram(
+            "geo_optimizer_task_duration_seconds", "GEO分析任务耗时（含排队）", ("pool",)))
+        self.optimizer_in_flight = register(Gauge(
+            "geo_optimizer_tasks_in_flight", "执行中的GEO分析任务数", ("pool",)))
+        self.provider_tokens = register(Counter(
+            "geo_provider_tokens_total", "AI服务商 token 用量（prompt_estimated 为本地估算）", ("provider", "kind")))
+        self.history_records = register(Counter(
+            "geo_history_records_total", "生成历史记录数", ("outcome",)))
+        self.history_queue_depth = register(Gauge(
+            "geo_history_queue_depth", "等待写入的生成历史记录数"))
+        self.multi_market = register(Counter(
+            "geo_multi_market_results_total", "多市场合并调用中各市场的拆分结果", ("provider", "result")))
+        self.event_loop_lag = register(Histogram(
+            "geo_event_loop_lag_seconds", "事件循环调度延迟", (), LAG_BUCKETS))
+
+metrics = Metrics()
+
+class MetricsMiddleware:
+    """记录每个路由的请求数、错误数和耗时"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        started = time.perf_counter()
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                metrics.http_duration.observe(time.perf_counter() - started, method=scope["method"], route=path)
+            await send(message)
+        
+        metrics.http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.http_in_flight.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            metrics.http_requests.inc(method=scope["method"], route=path, status=str(status_code))
+
+class EventLoopLagMonitor:
+    """定时睡眠固定间隔，实际醒来时间超出的部分即事件循环被阻塞的时长"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            metrics.event_loop_lag.observe(max(0.0, loop.time() - started - self.interval))
+
+# ==================== HTTP连接池 ====================
+
+def _http2_available() -> bool:
+    """HTTP/2 依赖可选包 h2，未安装时回退到 HTTP/1.1"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def create_http_client(settings: Settings, base_url: str, headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+    """创建带连接池和 keep-alive 的长连接客户端"""
+    limits = httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry
+    )
+    timeout = httpx.Timeout(
+        settings.http_read_timeout,
+        connect=settings.http_connect_timeout,
+        pool=settings.http_pool_timeout
+    )
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        limits=limits,
+        timeout=timeout,
+        http2=settings.http2 and _http2_available()
+    )
+
+MARKET_CODE_INDEX = {code.upper(): code for code in MARKET_CONFIGS}
+
+# 生成结果中默认只带市场摘要，完整配置可从 /markets 获取
+MARKET_SUMMARIES = {
+    code: {"code": code, "name": config["name"], "flag": config["flag"], "language": config["language"]}
+    for code, config in MARKET_CONFIGS.items()
+}
+
+def resolve_market_code(target_market: str) -> str:
+    """不区分大小写地匹配市场代码（如 "japan" -> "Japan"）"""
+    return MARKET_CODE_INDEX.get(target_market.strip().upper(), target_market.upper())
+
+# ==================== 响应缓存 ====================
+
+def sqlite_path_from_url(database_url: str) -> str:
+    """从 sqlite:///./xxx.db 形式的 DATABASE_URL 中取出文件路径"""
+    prefix = "sqlite:///"
+    if not database_url.startswith(prefix):
+        raise ValueError(f"仅支持 SQLite 数据库: {database_url}")
+    return database_url[len(prefix):] or ":memory:"
+
+class MemoryCacheBackend:
+    """进程内 LRU + TTL 缓存"""
+    
+    name = "memory"
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+    
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    async def set(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def size(self) -> int:
+        return len(self._entries)
+    
+    async def close(self):
+        self._entries.clear()
+
+class SQLiteCacheBackend:
+    """SQLite 磁盘缓存，重启后依然可以命中"""
+    
+    name = "sqlite"
+    evict_every = 64
+    touch_flush_every = 256
+    
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        # 命中时只记下访问时间，写入和淘汰前再批量落盘，读路径不再抢写锁
+        self._touched: Dict[str, float] = {}
+        # 单线程执行器串行访问连接，避免阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache (accessed_at)")
+            self._conn.commit()
+        return self._conn
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def _get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            self._touched.pop(key, None)
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        self._touched[key] = now
+        if len(self._touched) >= self.touch_flush_every:
+            self._flush_touched(conn)
+            conn.commit()
+        return row[0]
+    
+    def _flush_touched(self, conn: sqlite3.Connection):
+        """把缓冲的访问时间批量写回，调用方负责提交"""
+        if not self._touched:
+            return
+        conn.executemany(
+            "UPDATE response_cache SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self._touched.items()]
+        )
+        self._touched.clear()
+    
+    def _set(self, key: str, value: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, now + self.ttl_seconds, now)
+        )
+        self._touched.pop(key, None)
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            # 淘汰按 accessed_at 排序，先把缓冲的访问时间写回
+            self._flush_touched(conn)
+            conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+        conn.commit()
+    
+    def _size(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+    
+    def _close(self):
+        if self._conn is not None:
+            self._flush_touched(self._conn)
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+    
+    async def get(self, key: str) -> Optional[str]:
+        return await self._run(self._get, key)
+    
+    async def set(self, key: str, value: str):
+        await self._run(self._set, key, value)
+    
+    async def size(self) -> int:
+        return await self._run(self._size)
+    
+    async def close(self):
+        await self._run(self._close)
+
+class ResponseCache:
+    """内容寻址的响应缓存：键为服务商、模型、生成参数和完整提示词的哈希"""
+    
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+    
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str, **params: Any) -> str:
+        payload = json.dumps([provider, model, params, prompt], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    async def get(self, key: str, provider: str) -> Optional[str]:
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses[provider] += 1
+        else:
+            self.hits[provider] += 1
+        return value
+    
+    async def set(self, key: str, value: str):
+        await self.backend.set(key, value)
+    
+    async def stats(self) -> Dict[str, Any]:
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            "backend": self.backend.name,
+            "size": await self.backend.size(),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "providers": {
+                provider: {"hits": self.hits[provider], "misses": self.misses[provider]}
+                for provider in sorted(set(self.hits) | set(self.misses))
+            }
+        }
+    
+    async def close(self):
+        await self.backend.close()
+
+def create_response_cache(settings: Settings) -> Optional[ResponseCache]:
+    """按配置创建缓存，cache_backend 为 none 时关闭缓存"""
+    backend_name = settings.cache_backend
+    if backend_name == "none":
+        return None
+    if backend_name == "auto":
+        backend_name = "sqlite" if use_shared_state(settings) else "memory"
+    if backend_name == "sqlite":
+        backend = SQLiteCacheBackend(
+            sqlite_path_from_url(settings.database_url),
+            settings.cache_max_entries,
+            settings.cache_ttl_seconds
+        )
+    elif backend_name == "memory":
+        backend = MemoryCacheBackend(settings.cache_max_entries, settings.cache_ttl_seconds)
+    else:
+        raise ValueError(f"未知的缓存后端: {settings.cache_backend}")
+    return ResponseCache(backend)
+
+# ==================== 共享状态 ====================
+
+def use_shared_state(settings: Settings) -> bool:
+    """多进程部署时缓存、限流配额需要跨进程共享；auto 按 worker 数判断"""
+    if settings.state_backend == "auto":
+        return settings.workers > 1
+    if settings.state_backend not in ("local", "sqlite"):
+        raise ValueError(f"未知的共享状态后端: {settings.state_backend}")
+    return settings.state_backend == "sqlite"
+
+class TokenBucket:
+    """令牌桶：按速率匀速补充；允许单次申请超过容量，超出部分记为欠额"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, amount: float) -> float:
+        """放行这次申请还需等待的秒数"""
+        self._refill()
+        needed = min(amount, self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+    
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+    
+    def drain(self, seconds: float):
+        """清空并欠下 seconds 秒的额度"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+# 一次配额申请中的一个桶：(键, 申请量, 每秒补充速率, 容量)
+QuotaLimit = Tuple[str, float, float, float]
+
+class LocalQuotaStore:
+    """进程内的令牌桶集合，单 worker 部署使用"""
+    
+    name = "local"
+    
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+    
+    def _bucket(self, key: str, rate: float, capacity: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+    
+    async def start(self):
+        pass
+    
+    async def take(self, limits: List[QuotaLimit]) -> float:
+        """所有桶都有余量时一并扣减并返回 0，否则不扣减，返回需要等待的秒数"""
+        buckets = [(self._bucket(key, rate, capacity), amount) for key, amount, rate, capacity in limits]
+        wait = max(bucket.delay(amount) for bucket, amount in buckets)
+        if wait == 0:
+            for bucket, amount in buckets:
+                bucket.consume(amount)
+        return wait
+    
+    async def drain(self, key: str, seconds: float, rate: float, capacity: float):
+        self._bucket(key, rate, capacity).drain(seconds)
+    
+    async def close(self):
+        pass
+
+class SQLiteQuotaStore:
+    """SQLite 中的令牌桶，同一台机器上的多个 worker 进程共享配额"""
+    
+    name = "sqlite"
+    prune_every = 1024
+    idle_seconds = 3600.0
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._takes = 0
+        # 单线程执行器串行访问连接，避免阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota-store")
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # 自动提交模式，由 BEGIN IMMEDIATE 显式加写锁，保证读改写在进程间原子
+            self._conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._conn
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    @staticmethod
+    def _tokens(conn: sqlite3.Connection, key: str, rate: float, capacity: float, now: float) -> float:
+        row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+    
+    def _take(self, limits: List[QuotaLimit]) -> float:
+        with self._transaction() as conn:
+            now = time.time()
+            wait = 0.0
+            remaining = []
+            for key, amount, rate, capacity in limits:
+                tokens = self._tokens(conn, key, rate, capacity, now)
+                needed = min(amount, capacity)
+                if tokens < needed:
+                    wait = max(wait, (needed - tokens) / rate)
+                remaining.append((key, tokens - amount, now))
+            if wait == 0:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)", remaining
+                )
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                conn.execute("DELETE FROM rate_limit_buckets WHERE updated_at < ?", (now - self.idle_seconds,))
+        return wait
+    
+    def _drain(self, key: str, seconds: float, rate: float, capacity: float):
+        with self._transaction() as conn:
+            now = time.time()
+            tokens = min(self._tokens(conn, key, rate, capacity, now), 0.0) - seconds * rate
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now)
+            )
+    
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    async def start(self):
+        await self._run(self._connect)
+    
+    async def take(self, limits: List[QuotaLimit]) -> float:
+        """所有桶都有余量时一并扣减并返回 0，否则不扣减，返回需要等待的秒数"""
+        return await self._run(self._take, limits)
+    
+    async def drain(self, key: str, seconds: float, rate: float, capacity: float):
+        await self._run(self._drain, key, seconds, rate, capacity)
+    
+    async def close(self):
+        await self._run(self._close)
+
+def create_quota_store(settings: Settings):
+    """限流配额的存储：单进程在内存中，多进程部署放到 SQLite"""
+    if use_shared_state(settings):
+        return SQLiteQuotaStore(sqlite_path_from_url(settings.database_url))
+    return LocalQuotaStore(settings.client_rate_limit_max_clients + len(settings.provider_rate_limits) * 2)
+
+# ==================== 流式解析 ====================
+
+class StreamError(Exception):
+    """上游在流中返回的错误事件"""
+    pass
+
+class SSEParser:
+    """增量解析 Server-Sent Events 字节流
+    
+    字节块可能在 UTF-8 多字节字符或 JSON 帧中间截断：解码用增量解码器保留残余字节，
+    未完成的行和事件以片段列表暂存，凑齐后才拼接一次，拼接量与数据量成线性。
+    """
+    
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._line: List[str] = []
+        self._data: List[str] = []
+        self._event = ""
+    
+    def feed(self, chunk: bytes) -> List[Tuple[str, str]]:
+        """喂入一块字节，返回其中完整的 (事件名, 数据) 列表"""
+        return self._split(self._decoder.decode(chunk))
+    
+    def close(self) -> List[Tuple[str, str]]:
+        """流结束：冲刷残余字节和最后一个没有空行结尾的事件"""
+        events = self._split(self._decoder.decode(b"", final=True))
+        if self._line:
+            self._process_line("".join(self._line), events)
+            self._line = []
+        self._process_line("", events)
+        return events
+    
+    def _split(self, text: str) -> List[Tuple[str, str]]:
+        events: List[Tuple[str, str]] = []
+        start = 0
+        while True:
+            end = text.find("\n", start)
+            if end < 0:
+                break
+            if self._line:
+                self._line.append(text[start:end])
+                line = "".join(self._line)
+                self._line = []
+            else:
+                line = text[start:end]
+            self._process_line(line, events)
+            start = end + 1
+        if start < len(text):
+            self._line.append(text[start:])
+        return events
+    
+    def _process_line(self, line: str, events: List[Tuple[str, str]]):
+        if line.endswith("\r"):
+            line = line[:-1]
+        if not line:
+            if self._data:
+                events.append((self._event or "message", "\n".join(self._data)))
+            self._data = []
+            self._event = ""
+            return
+        if line.startswith(":"):
+            return
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+
+async def iter_sse(response: httpx.Response) -> AsyncIterator[Tuple[str, str]]:
+    """按需读取响应体并产出 SSE 事件；消费方不取下一个事件时不再读取网络，背压传导到上游连接"""
+    parser = SSEParser()
+    async for chunk in response.aiter_bytes():
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
+
+# ==================== Token预算 ====================
+
+# 各服务商分词器的粗略特征：(每个 token 的 ASCII 字符数, 每个非 ASCII 字符的 token 数)
+PROVIDER_TOKEN_PROFILES: Dict[str, Tuple[float, float]] = {
+    "gemini": (4.0, 1.0),
+    "claude": (3.5, 1.3),
+    "deepseek": (4.0, 0.7)
+}
+DEFAULT_TOKEN_PROFILE = (4.0, 1.0)
+
+# 当前请求的 token 报告：{服务商: {用量项: 数量}}，由生成入口设置，并发的各模型调用共享同一个字典
+current_token_usage: contextvars.ContextVar = contextvars.ContextVar("current_token_usage", default=None)
+
+def track_tokens(provider: str, **counts: Optional[int]):
+    """累加到当前请求的 token 报告；不在生成请求中时忽略"""
+    usage = current_token_usage.get()
+    if usage is None:
+        return
+    entry = usage.setdefault(provider, {})
+    for key, value in counts.items():
+        if value is not None:
+            entry[key] = entry.get(key, 0) + value
+
+@contextmanager
+def token_report(usage: Optional[Dict[str, Dict[str, int]]] = None) -> Iterator[Dict[str, Dict[str, int]]]:
+    """在此范围内创建的模型调用任务把用量累加到返回的字典（传入时继续累加到该字典）"""
+    usage = {} if usage is None else usage
+    token = current_token_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_token_usage.reset(token)
+
+class TokenBudget:
+    """按服务商估算提示词 token 数、分配输出上限，并用上游返回的实际用量校准估算
+    
+    校准系数为实际/估算比值的指数滑动平均，限制在 0.5 到 2 之间，避免个别异常响应带偏。
+    """
+    
+    def __init__(self, settings: Settings, profiles: Dict[str, Tuple[float, float]] = PROVIDER_TOKEN_PROFILES,
+                 smoothing: float = 0.1):
+        self.settings = settings
+        self.profiles = profiles
+        self.smoothing = smoothing
+        self._calibration: Dict[str, float] = {}
+    
+    def _raw_count(self, provider: str, text: str) -> int:
+        return estimate_tokens(text, *self.profiles.get(provider, DEFAULT_TOKEN_PROFILE))
+    
+    def count(self, provider: str, text: str) -> int:
+        """该服务商分词器下的估算 token 数"""
+        return math.ceil(self._raw_count(provider, text) * self._calibration.get(provider, 1.0))
+    
+    def max_tokens(self, provider: str, content_type: Optional[str], length: Optional[str]) -> int:
+        """按 内容类型 × 长度 分配输出上限；未开启或长度未知时使用 max_tokens"""
+        base = self.settings.length_output_tokens.get((length or "").strip().lower())
+        if not self.settings.token_budget_enabled or base is None:
+            return self.settings.max_tokens
+        factor = self.settings.content_type_token_factors.get((content_type or "").strip().lower(), 1.0)
+        # 同样长度的内容，每个 token 字符数越少的分词器需要越多 token
+        density = DEFAULT_TOKEN_PROFILE[0] / self.profiles.get(provider, DEFAULT_TOKEN_PROFILE)[0]
+        return max(1, min(self.settings.max_tokens, math.ceil(base * factor * density)))
+    
+    def fit(self, provider: str, render: Callable[[int], str], levels: int, markets: int = 1) -> Tuple[str, int]:
+        """渲染提示词；估算超出输入预算时逐级精简市场段落，返回 (提示词, 精简级别)"""
+        built_prompt = render(0)
+        if not self.settings.token_budget_enabled:
+            return built_prompt, 0
+        budget = self.settings.prompt_token_budget * markets
+        level = 0
+        while level < levels and self.count(provider, built_prompt) > budget:
+            level += 1
+            built_prompt = render(level)
+        return built_prompt, level
+    
+    def observe(self, provider: str, built_prompt: str, actual: int):
+        """用上游返回的提示词 token 数校准估算"""
+        estimated = self._raw_count(provider, built_prompt)
+        if estimated <= 0 or actual <= 0:
+            return
+        ratio = min(2.0, max(0.5, actual / estimated))
+        previous = self._calibration.get(provider)
+        self._calibration[provider] = ratio if previous is None else previous + self.smoothing * (ratio - previous)
+    
+    def status(self, provider: str) -> Dict[str, Any]:
+        return {"calibration": round(self._calibration.get(provider, 1.0), 3)}
+
 # ==================== AI模型服务 ====================
 
-class GeminiService:
-    """Google Gemini服务"""
+class BaseAIService(ABC):
+    """AI服务基类 - 每个服务商持有一个长连接HTTP客户端"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, base_url: str, settings: Optional[Settings] = None):
         self.api_key = api_key
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
+        self.base_url = base_url
+        self.settings = settings or get_settings()
+        self.templates = prompt_registry
+        self.cache: Optional[ResponseCache] = None
+        self.token_budget: Optional[TokenBudget] = None
+        self._client: Optional[httpx.AsyncClient] = None
     
-    async def generate_content(self, prompt: str, market_config: dict) -> str:
-        """生成内容"""
+    @property
+    def is_configured(self) -> bool:
+        """是否配置了真实密钥，占位密钥走演示模式"""
+        return bool(self.api_key) and not self.api_key.startswith("your_")
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """共享的连接池客户端，未经 startup 使用时按需创建"""
+        if self._client is None or self._client.is_closed:
+            self._client = create_http_client(self.settings, self.base_url, self._default_headers())
+        return self._client
+    
+    async def start(self):
+        """预建连接池；演示模式不访问上游，不创建连接"""
+        if self.is_configured:
+            self.client
+    
+    async def aclose(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def _default_headers(self) -> Dict[str, str]:
+        return {}
+    
+    def _max_tokens(self, max_tokens: Optional[int]) -> int:
+        return self.settings.max_tokens if max_tokens is None else max_tokens
+    
+    def count_tokens(self, text: str) -> int:
+        return self.token_budget.count(self.name, text) if self.token_budget is not None else estimate_tokens(text)
+    
+    def _fit(self, render: Callable[[int], str], markets: int = 1) -> str:
+        """渲染提示词，超出输入预算时精简市场段落，并记入本次请求的 token 报告"""
+        with metrics.prompt_build.time(provider=self.name):
+            if self.token_budget is None:
+                built_prompt, level = render(0), 0
+            else:
+                built_prompt, level = self.token_budget.fit(self.name, render, self.templates.compact_levels, markets)
+        track_tokens(self.name, calls=1, prompt_estimated=self.count_tokens(built_prompt), compacted=int(level > 0))
+        return built_prompt
+    
+    def _record_usage(self, built_prompt: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        """记录上游返回的实际用量：计入请求报告和监控指标，并校准估算"""
+        if prompt_tokens is not None:
+            metrics.provider_tokens.inc(self.count_tokens(built_prompt), provider=self.name, kind="prompt_estimated")
+            metrics.provider_tokens.inc(prompt_tokens, provider=self.name, kind="prompt")
+            if self.token_budget is not None:
+                self.token_budget.observe(self.name, built_prompt, prompt_tokens)
+        if completion_tokens is not None:
+            metrics.provider_tokens.inc(completion_tokens, provider=self.name, kind="completion")
+        track_tokens(self.name, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    
+    async def _cached_request(self, built_prompt: str, use_cache: bool = True,
+                              upstream: Optional[Callable[[str], Awaitable[str]]] = None,
+                              max_tokens: Optional[int] = None) -> str:
+        """先查响应缓存，未命中再调用上游并写回"""
+        send = upstream or (lambda text: self._request(text, max_tokens))
+        if self.cache is None or not use_cache:
+            return await send(built_prompt)
+        
+        key = ResponseCache.make_key(
+            self.name,
+            self.model,
+            built_prompt,
+            template=self.templates.version(self.name),
+            max_tokens=self._max_tokens(max_tokens),
+            temperature=self.settings.temperature
+        )
+        # 缓存只是加速手段：读写出错（如数据库被锁、文件损坏）按未命中处理，不影响生成结果
         try:
-            # 构建市场特定的提示词
-            market_prompt = self._build_market_prompt(prompt, market_config)
-            
-            # 这里应该是实际的API调用
-            # 为了演示，返回模拟结果
-            return f"🤖 Gemini生成内容 ({market_config['name']}):\n{market_prompt}\n\n这是针对{market_config['name']}市场优化的内容，考虑了当地文化特点和内容偏好。"
+            cached = await self.cache.get(key, self.name)
         except Exception as e:
-            logger.error(f"Gemini生成失败: {e}")
-            return f"Gemini生成失败: {str(e)}"
+            logger.warning(f"{self.name} 响应缓存读取失败，按未命中处理: {e}")
+            metrics.cache_requests.inc(provider=self.name, result="error")
+            cached = None
+        else:
+            metrics.cache_requests.inc(provider=self.name, result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+        
+        text = await send(built_prompt)
+        try:
+            await self.cache.set(key, text)
+        except Exception as e:
+            logger.warning(f"{self.name} 响应缓存写入失败: {e}")
+        return text
     
-    def _build_market_prompt(self, prompt: str, market_config: dict) -> str:
-        """构建市场特定的提示词"""
-        return f"""
-        目标市场: {market_config['name']} {market_config['flag']}
-        文化特点: {', '.join(market_config['cultural_traits'])}
-        内容偏好: {', '.join(market_config['content_preferences'])}
-        优化建议: {', '.join(market_config['optimization_tips'])}
+    async def complete(self, prompt: str, market_code: str, use_cache: bool = True,
+                       upstream: Optional[Callable[[str], Awaitable[str]]] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        """生成内容，失败时抛出异常，供竞速等需要区分成败的调用方使用
         
-        原始提示: {prompt}
+        upstream 包装缓存未命中时的上游调用（容错、限流），默认直接请求；max_tokens 默认取配置
+        """
+        built_prompt = self._fit(lambda level: self.templates.render(self.name, market_code, prompt, level))
+        track_tokens(self.name, max_tokens=self._max_tokens(max_tokens))
+        if not self.is_configured:
+            # 未配置密钥时返回演示结果
+            return self._demo_response(built_prompt, MARKET_CONFIGS[market_code])
+        return await self._cached_request(built_prompt, use_cache, upstream, max_tokens)
+    
+    async def complete_markets(self, prompt: str, market_codes: List[str], use_cache: bool = True,
+                               upstream: Optional[Callable[[str], Awaitable[str]]] = None,
+                               max_tokens: Optional[int] = None) -> str:
+        """一次调用为多个市场生成，返回按市场代码分键的 JSON 文本，由调用方拆分校验"""
+        built_prompt = self._fit(
+            lambda level: self.templates.render_markets(self.name, market_codes, prompt, level), len(market_codes)
+        )
+        track_tokens(self.name, max_tokens=self._max_tokens(max_tokens))
+        if not self.is_configured:
+            # 演示模式逐市场返回与单市场调用相同的示例内容
+            return json.dumps({
+                code: self._demo_response(self.templates.render(self.name, code, prompt), MARKET_CONFIGS[code])
+                for code in market_codes
+            }, ensure_ascii=False)
+        return await self._cached_request(built_prompt, use_cache, upstream, max_tokens)
+    
+    async def _stream_request(self, built_prompt: str, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """请求上游的流式接口，产出文本增量；流结束（含中断）时记录流中报告的实际用量"""
+        path, body = self._stream_call(built_prompt, max_tokens)
+        usage: Dict[str, int] = {}
+        try:
+            async with self.client.stream("POST", path, json=body) as response:
+                if response.is_error:
+                    await response.aread()
+                    response.raise_for_status()
+                async for event, data in iter_sse(response):
+                    delta = self._parse_stream_event(event, data, usage)
+                    if delta:
+                        yield delta
+        finally:
+            if usage:
+                self._record_usage(built_prompt, usage.get("prompt"), usage.get("completion"))
+    
+    @abstractmethod
+    def _demo_response(self, built_prompt: str, market_config: dict) -> str:
+        raise NotImplementedError
+    
+    @abstractmethod
+    async def _request(self, built_prompt: str, max_tokens: Optional[int] = None) -> str:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def _stream_call(self, built_prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """流式接口的路径和请求体"""
+        raise NotImplementedError
+    
+    def _usage(self, data: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+        """从响应中取出 (提示词 token 数, 输出 token 数)，没有时为 None"""
+        return None, None
+    
+    @staticmethod
+    def _update_usage(usage: Dict[str, int], prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        """流中的用量是累计值，后到的覆盖先到的"""
+        if prompt_tokens is not None:
+            usage["prompt"] = prompt_tokens
+        if completion_tokens is not None:
+            usage["completion"] = completion_tokens
+    
+    @abstractmethod
+    def _parse_stream_event(self, event: str, data: str, usage: Dict[str, int]) -> Optional[str]:
+        """从一个 SSE 事件中取出文本增量，没有文本时返回 None；事件带有用量时更新 usage 的 prompt、completion"""
+        raise NotImplementedError
+
+class GeminiService(BaseAIService):
+    """Google Gemini服务"""
+    
+    name = "gemini"
+    error_label = "Gemini生成失败"
+    
+    def __init__(self, api_key: str, settings: Optional[Settings] = None):
+        settings = settings or get_settings()
+        super().__init__(api_key, settings.gemini_base_url, settings)
+        self.model = settings.gemini_model
+    
+    async def generate_content(self, prompt: str, market_code: str, use_cache: bool = True) -> str:
+        """生成内容"""
+        try:
+            return await self.complete(prompt, market_code, use_cache)
+        except Exception as e:
+            logger.error(f"{self.error_label}: {e}")
+            return f"{self.error_label}: {str(e)}"
+    
+    def _demo_response(self, built_prompt: str, market_config: dict) -> str:
+        return f"🤖 Gemini生成内容 ({market_config['name']}):\n{built_prompt}\n\n这是针对{market_config['name']}市场优化的内容，考虑了当地文化特点和内容偏好。"
+    
+    def _body(self, built_prompt: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "contents": [{"parts": [{"text": built_prompt}]}],
+            "generationConfig": {
+                "maxOutputTokens": self._max_tokens(max_tokens),
+                "temperature": self.settings.temperature
+            }
+        }
+    
+    async def _request(self, built_prompt: str, max_tokens: Optional[int] = None) -> str:
+        """调用 generateContent 接口"""
+        response = await self.client.post(f"/v1beta/models/{self.model}:generateContent", json=self._body(built_prompt, max_tokens))
+        response.raise_for_status()
+        data = response.json()
+        self._record_usage(built_prompt, *self._usage(data))
+        parts = data["candidates"][0]["content"]["parts"]
+        return "".join(part.get("text", "") for part in parts)
+    
+    def _usage(self, data: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+        usage = data.get("usageMetadata") or {}
+        return usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+    
+    def _stream_call(self, built_prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """streamGenerateContent 接口，alt=sse 时每个 data 帧是一个完整的响应片段"""
+        return f"/v1beta/models/{self.model}:streamGenerateContent?alt=sse", self._body(built_prompt, max_tokens)
+    
+    def _parse_stream_event(self, event: str, data: str, usage: Dict[str, int]) -> Optional[str]:
+        """usageMetadata 为截至当前片段的累计值，以最后一个为准"""
+        payload = json.loads(data)
+        if "error" in payload:
+            raise StreamError(payload["error"].get("message", data))
+        self._update_usage(usage, *self._usage(payload))
+        candidates = payload.get("candidates") or []
+        if not candidates:
+            return None
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+    
+    def _default_headers(self) -> Dict[str, str]:
+        return {"x-goog-api-key": self.api_key}
+
+class ClaudeService(BaseAIService):
+    """Anthropic Claude服务"""
+    
+    name = "claude"
+    error_label = "Claude生成失败"
+    
+    def __init__(self, api_key: str, settings: Optional[Settings] = None):
+        settings = settings or get_settings()
+        super().__init__(api_key, settings.claude_base_url, settings)
+        self.model = settings.claude_model
+    
+    async def generate_content(self, prompt: str, market_code: str, use_cache: bool = True) -> str:
+        """生成内容"""
+        try:
+            return await self.complete(prompt, market_code, use_cache)
+        except Exception as e:
+            logger.error(f"{self.error_label}: {e}")
+            return f"{self.error_label}: {str(e)}"
+    
+    def _demo_response(self, built_prompt: str, market_config: dict) -> str:
+        return f"🧠 Claude生成内容 ({market_config['name']}):\n{built_prompt}\n\n这是使用Claude模型针对{market_config['name']}市场优化的内容。"
+    
+    def _body(self, built_prompt: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_tokens": self._max_tokens(max_tokens),
+            "temperature": self.settings.temperature,
+            "messages": [{"role": "user", "content": built_prompt}]
+        }
+    
+    async def _request(self, built_prompt: str, max_tokens: Optional[int] = None) -> str:
+        """调用 Messages 接口"""
+        response = await self.client.post("/v1/messages", json=self._body(built_prompt, max_tokens))
+        response.raise_for_status()
+        data = response.json()
+        self._record_usage(built_prompt, *self._usage(data))
+        return "".join(block.get("text", "") for block in data["content"] if block.get("type") == "text")
+    
+    def _usage(self, data: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+        usage = data.get("usage") or {}
+        return usage.get("input_tokens"), usage.get("output_tokens")
+    
+    def _stream_call(self, built_prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        return "/v1/messages", {**self._body(built_prompt, max_tokens), "stream": True}
+    
+    def _parse_stream_event(self, event: str, data: str, usage: Dict[str, int]) -> Optional[str]:
+        """文本在 content_block_delta 事件的 text_delta 中；输入用量在 message_start，
+        累计输出用量在 message_delta，其余事件（ping 等）忽略"""
+        if event == "content_block_delta":
+            delta = json.loads(data)["delta"]
+            return delta.get("text") if delta.get("type") == "text_delta" else None
+        if event == "message_start":
+            self._update_usage(usage, *self._usage(json.loads(data).get("message") or {}))
+        elif event == "message_delta":
+            self._update_usage(usage, None, (json.loads(data).get("usage") or {}).get("output_tokens"))
+        elif event == "error":
+            raise StreamError(json.loads(data).get("error", {}).get("message", data))
+        return None
+    
+    def _default_headers(self) -> Dict[str, str]:
+        return {"x-api-key": self.api_key, "anthropic-version": "2023-06-01"}
+
+class MotaService(BaseAIService):
+    """DeepSeek服务（通过ModelScope）"""
+    
+    name = "deepseek"
+    error_label = "DeepSeek优化失败"
+    
+    def __init__(self, access_token: str, api_base_url: str, settings: Optional[Settings] = None):
+        super().__init__(access_token, api_base_url, settings)
+        self.access_token = access_token
+        self.api_base_url = api_base_url
+        self.model = self.settings.mota_model
+    
+    async def optimize_content(self, prompt: str, market_code: str, use_cache: bool = True) -> str:
+        """优化内容"""
+        try:
+            return await self.complete(prompt, market_code, use_cache)
+        except Exception as e:
+            logger.error(f"{self.error_label}: {e}")
+            return f"{self.error_label}: {str(e)}"
+    
+    def _demo_response(self, built_prompt: str, market_config: dict) -> str:
+        return f"🔍 DeepSeek优化内容 ({market_config['name']}):\n{built_prompt}\n\n这是使用DeepSeek-V3.1模型针对{market_config['name']}市场优化的内容。"
+    
+    def _body(self, built_prompt: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_tokens": self._max_tokens(max_tokens),
+            "temperature": self.settings.temperature,
+            "messages": [{"role": "user", "content": built_prompt}]
+        }
+    
+    async def _request(self, built_prompt: str, max_tokens: Optional[int] = None) -> str:
+        """调用 OpenAI 兼容的 chat/completions 接口"""
+        response = await self.client.post("/chat/completions", json=self._body(built_prompt, max_tokens))
+        response.raise_for_status()
+        data = response.json()
+        self._record_usage(built_prompt, *self._usage(data))
+        return data["choices"][0]["message"]["content"] or ""
+    
+    def _usage(self, data: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+        usage = data.get("usage") or {}
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    
+    def _stream_call(self, built_prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        return "/chat/completions", {**self._body(built_prompt, max_tokens), "stream": True}
+    
+    def _parse_stream_event(self, event: str, data: str, usage: Dict[str, int]) -> Optional[str]:
+        """OpenAI 兼容格式：增量在 choices[0].delta.content，以 [DONE] 结束；用量在带 usage 的片段中（通常是最后一个）"""
+        if data == "[DONE]":
+            return None
+        payload = json.loads(data)
+        if "error" in payload:
+            raise StreamError(payload["error"].get("message", data))
+        self._update_usage(usage, *self._usage(payload))
+        choices = payload.get("choices") or []
+        if not choices:
+            return None
+        return (choices[0].get("delta") or {}).get("content")
+    
+    def _default_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+# 服务商名称到服务的构造函数，顺序即响应中的模型顺序
+PROVIDER_FACTORIES: Dict[str, Callable[[Settings], BaseAIService]] = {
+    "gemini": lambda settings: GeminiService(settings.google_api_key, settings),
+    "claude": lambda settings: ClaudeService(settings.anthropic_api_key, settings),
+    "deepseek": lambda settings: MotaService(settings.mota_access_token, settings.mota_api_base_url, settings)
+}
+
+# ==================== 容错与熔断 ====================
+
+class ProviderUnavailableError(Exception):
+    """服务商熔断中，调用被直接跳过"""
+    pass
+
+class ProviderFailureError(Exception):
+    """所有服务商均调用失败"""
+    
+    def __init__(self, message: str, errors: Dict[str, str]):
+        super().__init__(message)
+        self.errors = errors
+
+def is_retryable(error: BaseException) -> bool:
+    """超时、网络错误、429 和 5xx 可以重试；其余错误（如鉴权失败）重试也无济于事"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+class LatencyTracker:
+    """滑动窗口内的调用延迟统计（秒）"""
+    
+    def __init__(self, window: int = 200, min_samples: int = 10):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.min_samples = min_samples
+    
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        """样本不足时返回 None"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """熔断器：连续失败 N 次后打开，冷却后半开放行一个探测请求"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+    
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+    
+    def retry_after(self) -> float:
+        """距离下次半开探测的秒数"""
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+    
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+    
+    def release(self):
+        """探测请求被取消或因非服务端原因失败时，归还探测名额"""
+        self._probing = False
+
+class ProviderGuard:
+    """单个服务商的容错层：熔断、抖动退避重试、按延迟分位数自适应超时"""
+    
+    def __init__(self, name: str, settings: Settings, limiter: Optional["ProviderRateLimiter"] = None):
+        self.name = name
+        self.settings = settings
+        self.latency = LatencyTracker(settings.latency_window)
+        self.breaker = CircuitBreaker(settings.breaker_failure_threshold, settings.breaker_recovery_timeout)
+        self.limiter = limiter
+    
+    @property
+    def available(self) -> bool:
+        """熔断打开且尚未到探测时间，或半开状态下已有探测请求在途时为 False"""
+        breaker = self.breaker
+        if breaker.state == CircuitBreaker.HALF_OPEN:
+            return not breaker._probing
+        return breaker.state != CircuitBreaker.OPEN or breaker.retry_after() == 0
+    
+    def timeout(self) -> float:
+        """超时取 p99 延迟的倍数，并限制在上下限之间；样本不足时用上限"""
+        p99 = self.latency.percentile(0.99)
+        if p99 is None:
+            return self.settings.timeout_max
+        return min(self.settings.timeout_max, max(self.settings.timeout_min, p99 * self.settings.timeout_p99_multiplier))
+    
+    def backoff(self, attempt: int) -> float:
+        """指数退避 + 全抖动"""
+        ceiling = min(self.settings.retry_max_delay, self.settings.retry_base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+    
+    async def call(self, func: Callable[[], Awaitable[str]], cost: int = 0,
+                   slots: Optional[asyncio.Semaphore] = None) -> str:
+        """cost 为本次调用预估的 token 数，每次尝试前先申请配额再占用并发名额 slots，两者的等待都不计入超时"""
+        if not self.breaker.allow_request():
+            raise ProviderUnavailableError(f"{self.name} 熔断中，{self.breaker.retry_after():.0f}秒后重新探测")
+        
+        attempt = 0
+        while True:
+            try:
+                if self.limiter is not None:
+                    await self.limiter.acquire(cost)
+                if slots is not None:
+                    await slots.acquire()
+                try:
+                    started = time.perf_counter()
+                    result = await asyncio.wait_for(func(), timeout=self.timeout())
+                finally:
+                    if slots is not None:
+                        slots.release()
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as error:
+                if self.limiter is not None and isinstance(error, httpx.HTTPStatusError) \
+                        and error.response.status_code == 429:
+                    # 上游已限流，暂停放行，避免重试继续撞限额
+                    await self.limiter.pause(retry_after_seconds(error.response.headers.get("retry-after")))
+                if not is_retryable(error):
+                    self.breaker.release()
+                    raise
+                attempt += 1
+                if attempt >= self.settings.retry_max_attempts or self.breaker.state == CircuitBreaker.OPEN:
+                    self.breaker.record_failure()
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"{self.name} 调用失败，{delay:.2f}秒后第{attempt}次重试: {error!r}")
+                await asyncio.sleep(delay)
+                continue
+            self.latency.record(time.perf_counter() - started)
+            self.breaker.record_success()
+            return result
+    
+    def status(self) -> Dict[str, Any]:
+        p50 = self.latency.percentile(0.5)
+        status = {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "timeout_seconds": round(self.timeout(), 3),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None
+        }
+        if self.limiter is not None:
+            status["rate_limit"] = self.limiter.status()
+        return status
+
+# ==================== 限流与调度 ====================
+
+# 当前请求的调用方（API Key 或客户端IP），用于在服务商配额上公平排队
+current_caller: contextvars.ContextVar = contextvars.ContextVar("current_caller", default="anonymous")
+
+class RateLimitedError(Exception):
+    """配额等待队列已满或调用方超出限额"""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def retry_after_seconds(value: Optional[str], default: float = 1.0) -> float:
+    """解析 Retry-After 头（秒数），无法解析时使用默认值"""
+    try:
+        return max(0.0, float(value)) if value else default
+    except ValueError:
+        return default
+
+def estimate_tokens(text: str, ascii_chars_per_token: float = 4.0, tokens_per_other_char: float = 1.0) -> int:
+    """粗略估算 token 数：默认 ASCII 约4个字符一个 token，其余字符各算一个"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / ascii_chars_per_token + (len(text) - ascii_chars) * tokens_per_other_char)
+
+class ProviderRateLimiter:
+    """单个服务商的请求数和 token 数配额，等待中的调用按调用方轮转放行"""
+    
+    def __init__(self, name: str, rpm: float, tpm: float, settings: Settings, store):
+        self.name = name
+        self.store = store
+        self.queue_size = settings.rate_limit_queue_size
+        self.request_rate = rpm * settings.rate_limit_headroom / 60
+        self.token_rate = tpm * settings.rate_limit_headroom / 60
+        self.request_capacity = max(1.0, self.request_rate * settings.rate_limit_burst_seconds)
+        self.token_capacity = max(1.0, self.token_rate * settings.rate_limit_burst_seconds)
+        self._waiters: "OrderedDict[str, Deque[Tuple[asyncio.Future, int]]]" = OrderedDict()
+        self._waiting = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+    
+    def _limits(self, cost: int) -> List[QuotaLimit]:
+        """rpm 或 tpm 不大于 0 时不限制对应的桶"""
+        limits = [
+            (f"provider:{self.name}:requests", 1, self.request_rate, self.request_capacity),
+            (f"provider:{self.name}:tokens", cost, self.token_rate, self.token_capacity)
+        ]
+        return [limit for limit in limits if limit[2] > 0]
+    
+    def retry_after(self) -> float:
+        """按当前排队长度估算的可重试时间；不限请求数时无从估算，退回默认值"""
+        if self.request_rate <= 0:
+            return retry_after_seconds(None)
+        return (self._waiting + 1) / self.request_rate
+    
+    @property
+    def saturated(self) -> bool:
+        return self._waiting >= self.queue_size
+    
+    async def acquire(self, cost: int):
+        """等待配额；排队已满时抛出 RateLimitedError"""
+        limits = self._limits(cost)
+        if not limits:
+            return
+        if not self._waiting and await self.store.take(limits) == 0:
+            metrics.rate_limit_wait.observe(0.0, provider=self.name)
+            return
+        if self.saturated:
+            metrics.rate_limited.inc(scope=self.name)
+            raise RateLimitedError(f"{self.name} 配额排队已满", self.retry_after())
+        
+        caller = current_caller.get()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(caller, deque()).append((future, cost))
+        self._waiting += 1
+        metrics.rate_limit_queue.set(self._waiting, provider=self.name)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        
+        started = time.perf_counter()
+        await future
+        metrics.rate_limit_wait.observe(time.perf_counter() - started, provider=self.name)
+    
+    async def _dispatch(self):
+        """每次取队首调用方的第一个请求，配额足够时放行并把该调用方移到队尾"""
+        while self._waiters:
+            caller, queue = next(iter(self._waiters.items()))
+            future, cost = queue[0]
+            if not future.done():
+                delay = await self.store.take(self._limits(cost))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                if not future.done():
+                    future.set_result(None)
+            queue.popleft()
+            self._waiting -= 1
+            metrics.rate_limit_queue.set(self._waiting, provider=self.name)
+            if queue:
+                self._waiters.move_to_end(caller)
+            else:
+                del self._waiters[caller]
+    
+    async def pause(self, seconds: float):
+        """上游返回 429 时暂停放行"""
+        limits = self._limits(0)
+        if not limits:
+            return
+        logger.warning(f"{self.name} 触发上游限流，暂停放行 {seconds:.1f} 秒")
+        # 优先清空请求数桶；不限请求数时清空 token 桶
+        key, _, rate, capacity = limits[0]
+        await self.store.drain(key, seconds, rate, capacity)
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            "queued": self._waiting,
+            "callers": len(self._waiters),
+            "rpm": round(self.request_rate * 60),
+            "tpm": round(self.token_rate * 60),
+            "store": self.store.name
+        }
+
+class ClientRateLimiter:
+    """入口限流：每个调用方一个令牌桶，超出时返回需等待的秒数"""
+    
+    def __init__(self, settings: Settings, store):
+        self.store = store
+        self.rate = settings.client_rate_limit_rpm / 60
+        self.capacity = max(1, settings.client_rate_limit_burst)
+    
+    async def check(self, caller: str) -> float:
+        """放行时返回 0，否则返回建议的 Retry-After 秒数"""
+        if self.rate <= 0:
+            return 0.0
+        return await self.store.take([(f"client:{caller}", 1, self.rate, self.capacity)])
+
+def create_rate_limiters(settings: Settings, store) -> Dict[str, ProviderRateLimiter]:
+    return {
+        name: ProviderRateLimiter(name, limits["rpm"], limits["tpm"], settings, store)
+        for name, limits in settings.provider_rate_limits.items()
+    }
+
+def _key_digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+@lru_cache(maxsize=8)
+def _known_key_digests(api_keys: Tuple[str, ...]) -> frozenset:
+    return frozenset(_key_digest(key) for key in api_keys)
+
+@lru_cache(maxsize=8)
+def _trusted_networks(proxies: Tuple[str, ...]) -> Tuple[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], ...]:
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+def _is_trusted_proxy(address: str, settings: Settings) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _trusted_networks(tuple(settings.trusted_proxies)))
+
+def client_address(request: Request, settings: Settings) -> str:
+    """客户端IP；直连地址是可信代理时，从 X-Forwarded-For 末尾向前取第一个不可信的地址"""
+    address = request.client.host if request.client else "unknown"
+    if not settings.trusted_proxies or not _is_trusted_proxy(address, settings):
+        return address
+    # 代理依次把上一跳追加在末尾，只有可信代理追加的部分可信，更靠前的内容可能由客户端伪造
+    hops = [hop.strip() for hop in ",".join(request.headers.getlist("x-forwarded-for")).split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop, settings):
+            return hop
+    return hops[0] if hops else address
+
+def client_identity(request: Request, settings: Settings) -> str:
+    """调用方标识：已配置的 API Key 优先，其次客户端IP；未配置的 Key 可以随意更换，不能作为标识"""
+    api_key = request.headers.get("x-api-key")
+    if not api_key:
+        authorization = request.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            api_key = authorization[7:].strip()
+    if api_key and settings.client_api_keys:
+        digest = _key_digest(api_key)
+        if digest in _known_key_digests(tuple(settings.client_api_keys)):
+            return "key:" + digest[:16]
+    return "ip:" + client_address(request, settings)
+
+# ==================== 近似重复检索 ====================
+
+FINGERPRINT_BITS = 64
+# 第 j 张表把字节映射为其第 j 位，translate 后计数即得整列该位为 1 的个数
+_BIT_TABLES = [bytes((value >> bit) & 1 for value in range(256)) for bit in range(8)]
+
+def simhash(text: str, shingle_size: int = 1) -> int:
+    """64 位 SimHash：按评分用的分词规则切词（忽略大小写、空白和标点），
+    取 shingle_size 个词的连续片段，逐位统计各片段哈希的多数票"""
+    tokens = _tokenize(text)
+    if len(tokens) <= shingle_size:
+        shingles = {" ".join(tokens)}
+    else:
+        shingles = {" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles)
+    fingerprint = 0
+    for byte in range(8):
+        # 按字节取出所有哈希的同一列，逐位计数都在 C 层完成
+        column = digests[byte::8]
+        for bit in range(8):
+            if column.translate(_BIT_TABLES[bit]).count(1) * 2 > len(shingles):
+                fingerprint |= 1 << (byte * 8 + bit)
+    return fingerprint
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+@dataclass
+class NearDuplicateEntry:
+    """一次历史生成：提示词指纹和各模型的结果"""
+    id: str
+    partition: str
+    fingerprint: int
+    prompt: str
+    content: Dict[str, Optional[str]]
+    created_at: float
+    used_at: float
+
+@dataclass(frozen=True)
+class NearDuplicateMatch:
+    entry: NearDuplicateEntry
+    distance: int
+    
+    @property
+    def similarity(self) -> float:
+        return 1 - self.distance / FINGERPRINT_BITS
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.entry.id,
+            "similarity": round(self.similarity, 3),
+            "prompt": self.entry.prompt,
+            "generated_at": datetime.fromtimestamp(self.entry.created_at).isoformat()
+        }
+
+class NearDuplicateIndex:
+    """历史生成的 SimHash 近似重复索引，按 (市场, 内容类型, 语调, 长度) 分区
+    
+    指纹切成 max_distance + 1 段，汉明距离不超过 max_distance 的两个指纹至少有一段完全相同，
+    查询只比对同段同值的候选，不随条目数线性增长。内存中按 LRU 保留 max_entries 条，
+    增删同步写入 SQLite，重启时直接载入指纹，无需重新计算。
+    """
+    
+    def __init__(self, path: str, max_entries: int, max_distance: int, shingle_size: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+        self.hits = 0
+        self.misses = 0
+        self.write_errors = 0
+        self._pending: Set[asyncio.Task] = set()
+        bands = max_distance + 1
+        width = FINGERPRINT_BITS // bands
+        # 各段的 (起始位, 掩码)，最后一段包含余下的位
+        self._bands = [
+            (index * width, (1 << (width if index < bands - 1 else FINGERPRINT_BITS - index * width)) - 1)
+            for index in range(bands)
+        ]
+        self._tables: List[Dict[Tuple[str, int], Set[str]]] = [defaultdict(set) for _ in self._bands]
+        self._entries: "OrderedDict[str, NearDuplicateEntry]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        # 单线程执行器串行访问连接，避免阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="near-duplicates")
+    
+    def fingerprint(self, text: str) -> int:
+        return simhash(text, self.shingle_size)
+    
+    def _band_keys(self, partition: str, fingerprint: int) -> List[Tuple[str, int]]:
+        return [(partition, (fingerprint >> shift) & mask) for shift, mask in self._bands]
+    
+    def find(self, partition: str, fingerprint: int) -> Optional[NearDuplicateMatch]:
+        """同一分区内汉明距离最小且不超过阈值的历史生成"""
+        best: Optional[NearDuplicateMatch] = None
+        seen: Set[str] = set()
+        for table, key in zip(self._tables, self._band_keys(partition, fingerprint)):
+            for entry_id in table.get(key, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                entry = self._entries[entry_id]
+                distance = hamming_distance(fingerprint, entry.fingerprint)
+                if distance <= self.max_distance and (best is None or distance < best.distance):
+                    best = NearDuplicateMatch(entry, distance)
+        if best is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best
+    
+    def _insert(self, entry: NearDuplicateEntry):
+        self._entries[entry.id] = entry
+        for table, key in zip(self._tables, self._band_keys(entry.partition, entry.fingerprint)):
+            table[key].add(entry.id)
+    
+    def _remove(self, entry_id: str) -> NearDuplicateEntry:
+        entry = self._entries.pop(entry_id)
+        for table, key in zip(self._tables, self._band_keys(entry.partition, entry.fingerprint)):
+            ids = table[key]
+            ids.discard(entry_id)
+            if not ids:
+                del table[key]
+        return entry
+    
+    def add(self, partition: str, prompt: str, fingerprint: int, content: Dict[str, Optional[str]]) -> NearDuplicateEntry:
+        """记录一次生成；同一分区中指纹相同的旧条目被替换，超出容量时淘汰最久未用的条目"""
+        same_band = self._tables[0].get(self._band_keys(partition, fingerprint)[0], ())
+        removed = [entry_id for entry_id in same_band if self._entries[entry_id].fingerprint == fingerprint]
+        for entry_id in removed:
+            self._remove(entry_id)
+        now = time.time()
+        entry = NearDuplicateEntry(uuid.uuid4().hex, partition, fingerprint, prompt, content, now, now)
+        self._insert(entry)
+        while len(self._entries) > self.max_entries:
+            removed.append(self._remove(next(iter(self._entries))).id)
+        self._persist(self._save, entry, removed)
+        return entry
+    
+    def touch(self, entry: NearDuplicateEntry):
+        """复用时刷新 LRU 顺序"""
+        entry.used_at = time.time()
+        if entry.id in self._entries:
+            self._entries.move_to_end(entry.id)
+            self._persist(self._touch, entry.id, entry.used_at)
+    
+    def _persist(self, func, *args):
+        """写盘在后台按提交顺序执行，不占用请求耗时；失败只记录日志，内存中的索引照常使用"""
+        task = asyncio.ensure_future(self._run(func, *args))
+        self._pending.add(task)
+        task.add_done_callback(self._persisted)
+    
+    def _persisted(self, task: asyncio.Task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.write_errors += 1
+            logger.warning(f"近似重复索引写入失败: {task.exception()}")
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS near_duplicates ("
+                "id TEXT PRIMARY KEY, partition TEXT NOT NULL, fingerprint TEXT NOT NULL, prompt TEXT NOT NULL, "
+                "content TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_near_duplicates_used ON near_duplicates (used_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS near_duplicate_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def _load(self) -> List[NearDuplicateEntry]:
+        conn = self._connect()
+        # 片段长度变化后旧指纹不可比，清空后重新积累
+        row = conn.execute("SELECT value FROM near_duplicate_meta WHERE key = 'shingle_size'").fetchone()
+        if row is None or int(row[0]) != self.shingle_size:
+            conn.execute("DELETE FROM near_duplicates")
+            conn.execute(
+                "INSERT OR REPLACE INTO near_duplicate_meta (key, value) VALUES ('shingle_size', ?)",
+                (str(self.shingle_size),)
+            )
+        # 超出容量的旧条目在载入时一并清理
+        conn.execute(
+            "DELETE FROM near_duplicates WHERE id IN ("
+            "SELECT id FROM near_duplicates ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        conn.commit()
+        rows = conn.execute(
+            "SELECT id, partition, fingerprint, prompt, content, created_at, used_at FROM near_duplicates ORDER BY used_at"
+        ).fetchall()
+        return [
+            NearDuplicateEntry(row[0], row[1], int(row[2], 16), row[3], json.loads(row[4]), row[5], row[6])
+            for row in rows
+        ]
+    
+    def _save(self, entry: NearDuplicateEntry, removed: List[str]):
+        conn = self._connect()
+        if removed:
+            conn.executemany("DELETE FROM near_duplicates WHERE id = ?", [(entry_id,) for entry_id in removed])
+        conn.execute(
+            "INSERT OR REPLACE INTO near_duplicates (id, partition, fingerprint, prompt, content, created_at, used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (entry.id, entry.partition, format(entry.fingerprint, "016x"), entry.prompt,
+             json.dumps(entry.content, ensure_ascii=False), entry.created_at, entry.used_at)
+        )
+        conn.commit()
+    
+    def _touch(self, entry_id: str, used_at: float):
+        conn = self._connect()
+        conn.execute("UPDATE near_duplicates SET used_at = ? WHERE id = ?", (used_at, entry_id))
+        conn.commit()
+    
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    async def start(self):
+        """从磁盘载入指纹，按最近使用顺序重建 LRU"""
+        for entry in await self._run(self._load):
+            self._insert(entry)
+        logger.info(f"近似重复索引已载入 {len(self._entries)} 条")
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "write_errors": self.write_errors
+        }
+    
+    async def close(self):
+        """等待尚未完成的写盘后关闭连接"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self._run(self._close)
+
+def create_near_duplicate_index(settings: Settings) -> Optional[NearDuplicateIndex]:
+    """相似度阈值换算为指纹汉明距离上限"""
+    if not settings.near_duplicate_enabled:
+        return None
+    max_distance = int((1 - settings.near_duplicate_threshold) * FINGERPRINT_BITS)
+    if not 0 <= max_distance < FINGERPRINT_BITS // 2:
+        raise ValueError(f"近似重复相似度阈值需在 0.5 到 1 之间: {settings.near_duplicate_threshold}")
+    return NearDuplicateIndex(
+        sqlite_path_from_url(settings.database_url),
+        settings.near_duplicate_max_entries,
+        max_distance,
+        settings.near_duplicate_shingle_size
+    )
+
+# ==================== 生成历史 ====================
+
+# 全文索引使用 trigram 分词：中日文没有空格分词，按三字符子串索引才能检索任意片段；
+# trigram 需要 SQLite 3.34 及以上，更早的版本退回 unicode61 分词，检索按整词匹配
+FTS_TRIGRAM_MIN_SQLITE = (3, 34, 0)
+HISTORY_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS generations ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, market TEXT NOT NULL, "
+    "content_type TEXT NOT NULL, tone TEXT NOT NULL, length TEXT NOT NULL, mode TEXT NOT NULL, "
+    "prompt TEXT NOT NULL, content TEXT NOT NULL, errors TEXT NOT NULL, durations TEXT NOT NULL, "
+    "tokens TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_market ON generations (market, id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5("
+    "prompt, content, content='generations', content_rowid='id', tokenize='{tokenize}')",
+    "CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN "
+    "INSERT INTO generations_fts (rowid, prompt, content) VALUES (new.id, new.prompt, new.content); END"
+)
+HISTORY_COLUMNS = (
+    "id, created_at, market, content_type, tone, length, mode, prompt, content, errors, durations, tokens"
+)
+HISTORY_INSERT = (
+    "INSERT INTO generations (created_at, market, content_type, tone, length, mode, prompt, content, "
+    "errors, durations, tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# trigram 分词下短于 3 个字符的词无法走索引：另建二字索引，记录提示词和内容中相邻两个字符（字母、数字或文字）
+# 的去重集合，只记录是否出现，不存位置和原文
+FTS_MIN_TERM_CHARS = 3
+HISTORY_BIGRAM_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS generations_bigram USING fts5("
+    "grams, content='', detail='none', tokenize='unicode61 remove_diacritics 0')"
+)
+_BIGRAM_RUN_PATTERN = re.compile(r"[^\W_]{2,}")
+
+def text_bigrams(text: str) -> Set[str]:
+    """文本中相邻两个字符组成的片段（不区分大小写），跨越空白、标点的组合不计"""
+    grams: Set[str] = set()
+    for run in _BIGRAM_RUN_PATTERN.findall(text.lower()):
+        grams.update(run[i:i + 2] for i in range(len(run) - 1))
+    return grams
+
+class GenerationHistory:
+    """生成历史的 SQLite 持久化和全文检索
+    
+    写入为后台批量写：请求路径只把记录放入有界队列，不等待磁盘；写线程每次取出队列中已有的全部记录
+    （不超过 batch_size）在一个事务中写入，负载越高每批越大。写入和查询使用独立的连接和线程，
+    WAL 模式下查询不被写入阻塞。列表和检索都按 id 倒序做键集分页，游标为上一页最后一条的 id，
+    翻页代价与页码无关。
+    """
+    
+    def __init__(self, path: str, queue_size: int, batch_size: int, read_threads: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._queue_size = queue_size
+        self._writer: Optional[asyncio.Task] = None
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._read_local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        # 写连接只在单个写线程中使用；查询线程各自持有只读连接
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix="history-reader")
+        self.tokenizer = "trigram" if sqlite3.sqlite_version_info >= FTS_TRIGRAM_MIN_SQLITE else "unicode61"
+    
+    def _connect_writer(self) -> sqlite3.Connection:
+        if self._write_conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                for statement in HISTORY_SCHEMA:
+                    conn.execute(statement.format(tokenize=self.tokenizer))
+                conn.commit()
+                # 已有的库沿用建表时的分词方式
+                sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'generations_fts'").fetchone()[0]
+                self.tokenizer = "trigram" if "trigram" in sql else "unicode61"
+                if self.tokenizer == "trigram":
+                    self._create_bigram_index(conn)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._write_conn = conn
+        return self._write_conn
+    
+    def _create_bigram_index(self, conn: sqlite3.Connection):
+        """建立二字索引；在已有数据的库上首次建立时为已有记录补建"""
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'generations_bigram'").fetchone()
+        conn.execute(HISTORY_BIGRAM_SCHEMA)
+        conn.commit()
+        if exists:
+            return
+        cursor = conn.execute("SELECT id, prompt, content FROM generations")
+        with conn:
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                conn.executemany(
+                    "INSERT INTO generations_bigram (rowid, grams) VALUES (?, ?)",
+                    [(row_id, " ".join(text_bigrams(f"{prompt} {content}"))) for row_id, prompt, content in rows]
+                )
+    
+    def _connect_reader(self) -> sqlite3.Connection:
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON")
+            self._read_local.conn = conn
+            self._read_conns.append(conn)
+        return conn
+    
+    async def _write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, func, *args)
+    
+    async def _read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, func, *args)
+    
+    def record(self, entry: Dict[str, Any]) -> bool:
+        """放入写队列后立即返回；队列已满时丢弃并计数，不阻塞请求"""
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.history_records.inc(outcome="dropped")
+            return False
+        metrics.history_queue_depth.set(self._queue.qsize())
+        return True
+    
+    def _insert_batch(self, batch: List[Dict[str, Any]]):
+        conn = self._connect_writer()
+        rows = [
+            (
+                entry["created_at"], entry["market"], entry["content_type"], entry["tone"], entry["length"],
+                entry["mode"], entry["prompt"], json.dumps(entry["content"], ensure_ascii=False),
+                json.dumps(entry["errors"], ensure_ascii=False), json.dumps(entry["durations"]),
+                json.dumps(entry["tokens"])
+            )
+            for entry in batch
+        ]
+        with conn:
+            if self.tokenizer != "trigram":
+                conn.executemany(HISTORY_INSERT, rows)
+                return
+            # 二字索引需要新记录的 id，逐条插入取 lastrowid，仍在同一个事务中
+            grams = []
+            for row in rows:
+                row_id = conn.execute(HISTORY_INSERT, row).lastrowid
+                grams.append((row_id, " ".join(text_bigrams(f"{row[6]} {row[7]}"))))
+            conn.executemany("INSERT INTO generations_bigram (rowid, grams) VALUES (?, ?)", grams)
+    
+    async def _write_loop(self):
+        """取出队列中已有的记录成批写入；收到 None 时写完剩余记录后退出"""
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            batch: List[Dict[str, Any]] = []
+            while entry is not None:
+                batch.append(entry)
+                if len(batch) >= self.batch_size or self._queue.empty():
+                    break
+                entry = self._queue.get_nowait()
+            stopping = entry is None
+            metrics.history_queue_depth.set(self._queue.qsize())
+            if not batch:
+                continue
+            try:
+                await self._write(self._insert_batch, batch)
+            except Exception as e:
+                logger.error(f"生成历史写入失败（{len(batch)} 条）: {e}")
+                metrics.history_records.inc(len(batch), outcome="error")
+                continue
+            self.written += len(batch)
+            metrics.history_records.inc(len(batch), outcome="written")
+    
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": row["id"],
+            "created_at": datetime.fromtimestamp(row["created_at"]).isoformat(),
+            "market": row["market"],
+            "content_type": row["content_type"],
+            "tone": row["tone"],
+            "length": row["length"],
+            "mode": row["mode"],
+            "prompt": row["prompt"],
+            "content": json.loads(row["content"]),
+            "errors": json.loads(row["errors"]),
+            "durations": json.loads(row["durations"]),
+            "tokens": json.loads(row["tokens"])
+        }
+    
+    def _page(self, rows: List[sqlite3.Row], limit: int) -> Dict[str, Any]:
+        items = [self._decode(row) for row in rows[:limit]]
+        return {
+            "items": items,
+            "count": len(items),
+            "next_cursor": str(items[-1]["id"]) if len(rows) > limit else None
+        }
+    
+    def _list(self, market: Optional[str], before: Optional[int], limit: int) -> Dict[str, Any]:
+        conditions: List[str] = []
+        params: List[Any] = []
+        if market is not None:
+            conditions.append("market = ?")
+            params.append(market)
+        if before is not None:
+            conditions.append("id < ?")
+            params.append(before)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self._connect_reader().execute(
+            f"SELECT {HISTORY_COLUMNS} FROM generations {where}ORDER BY id DESC LIMIT ?", (*params, limit + 1)
+        ).fetchall()
+        return self._page(rows, limit)
+    
+    def _search(self, query: str, market: Optional[str], before: Optional[int], limit: int) -> Dict[str, Any]:
+        """各词之间为“且”；三个字符及以上的词走 trigram 索引，两个字符的词走二字索引，都不做全表扫描"""
+        terms = query.split()
+        if not terms:
+            return self._page([], limit)
+        # unicode61 分词按整词索引，任意长度的词都走全文索引
+        min_chars = FTS_MIN_TERM_CHARS if self.tokenizer == "trigram" else 1
+        phrases = ['"' + term.replace('"', '""') + '"' for term in terms if len(term) >= min_chars]
+        grams: List[str] = []
+        for term in terms:
+            if len(term) >= min_chars:
+                continue
+            if len(term) < 2 or not text_bigrams(term):
+                raise ValueError(f"检索词 {term} 过短：至少 2 个字符，2 个字符的词只能包含字母、数字或文字")
+            grams.append(f'"{term.lower()}"')
+        
+        # 由一个索引给出候选并按 rowid 倒序分页，另一个索引的子查询只求值一次后过滤；
+        # 子查询条件不能写在全文索引表的 rowid 上，否则会对子查询的每个结果各执行一次 MATCH
+        driver = "generations_fts" if phrases else "generations_bigram"
+        conditions: List[str] = []
+        params: List[Any] = []
+        if phrases:
+            conditions.append("generations_fts MATCH ?")
+            params.append(" AND ".join(phrases))
+        if grams:
+            conditions.append(
+                "generations_bigram MATCH ?" if driver == "generations_bigram" else
+                "g.id IN (SELECT rowid FROM generations_bigram WHERE generations_bigram MATCH ?)"
+            )
+            params.append(" AND ".join(grams))
+        if market is not None:
+            conditions.append("g.market = ?")
+            params.append(market)
+        if before is not None:
+            conditions.append(f"{driver}.rowid < ?")
+            params.append(before)
+        columns = ", ".join(f"g.{column.strip()}" for column in HISTORY_COLUMNS.split(","))
+        rows = self._connect_reader().execute(
+            f"SELECT {columns} FROM {driver} JOIN generations g ON g.id = {driver}.rowid "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {driver}.rowid DESC LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+        return self._page(rows, limit)
+    
+    def _get(self, generation_id: int) -> Optional[Dict[str, Any]]:
+        row = self._connect_reader().execute(
+            f"SELECT {HISTORY_COLUMNS} FROM generations WHERE id = ?", (generation_id,)
+        ).fetchone()
+        return self._decode(row) if row is not None else None
+    
+    async def recent(self, market: Optional[str] = None, before: Optional[int] = None, limit: int = 20) -> Dict[str, Any]:
+        return await self._read(self._list, market, before, limit)
+    
+    async def search(self, query: str, market: Optional[str] = None, before: Optional[int] = None,
+                     limit: int = 20) -> Dict[str, Any]:
+        return await self._read(self._search, query, market, before, limit)
+    
+    async def get(self, generation_id: int) -> Optional[Dict[str, Any]]:
+        return await self._read(self._get, generation_id)
+    
+    async def start(self) -> bool:
+        """建表后启动写线程，队列在事件循环内创建；当前 SQLite 不支持 FTS5 时返回 False"""
+        try:
+            await self._write(self._connect_writer)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite {sqlite3.sqlite_version} 无法创建生成历史全文索引，生成历史已关闭: {e}")
+            self._read_executor.shutdown(wait=False)
+            self._write_executor.shutdown(wait=False)
+            return False
+        if self.tokenizer != "trigram":
+            logger.warning(f"SQLite {sqlite3.sqlite_version} 不支持 trigram 分词，生成历史检索按整词匹配")
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._writer = asyncio.ensure_future(self._write_loop())
+        return True
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+    
+    def _close(self):
+        if self._write_conn is not None:
+            self._write_conn.close()
+            self._write_conn = None
+        for conn in self._read_conns:
+            conn.close()
+        self._read_conns = []
+    
+    async def close(self):
+        """写完队列中剩余的记录再关闭连接"""
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+            self._writer = None
+        self._read_executor.shutdown(wait=True)
+        await self._write(self._close)
+        self._write_executor.shutdown(wait=False)
+
+def create_generation_history(settings: Settings) -> Optional[GenerationHistory]:
+    if not settings.history_enabled:
+        return None
+    return GenerationHistory(
+        sqlite_path_from_url(settings.history_database_url),
+        settings.history_queue_size,
+        settings.history_batch_size,
+        settings.history_read_threads
+    )
+
+# ==================== 海外内容生成器 ====================
+
+# 每个服务商调用结束时的回调 (服务商, 结果)，由需要进度通知的调用方设置，并发的各模型调用共享
+provider_progress: contextvars.ContextVar = contextvars.ContextVar("provider_progress", default=None)
+
+class SingleFlight:
+    """请求合并：相同键的并发调用共享同一个执行任务，不重复请求上游"""
+    
+    def __init__(self):
+        self._flights: Dict[str, "asyncio.Future[Any]"] = {}
+        self._waiters: Dict[str, int] = defaultdict(int)
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """返回 (结果, 是否复用了在途调用)；异常会传递给所有等待方"""
+        task = self._flights.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        
+        self._waiters[key] += 1
+        try:
+            # shield 保证单个等待方被取消时不会取消共享任务
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+                if not task.done():
+                    # 最后一个等待方也已离开，共享任务没有存在的必要
+                    task.cancel()
+                    self._forget(key, task)
+    
+    def _forget(self, key: str, task: "asyncio.Future[Any]"):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+    
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r"\s*")
+
+def split_market_output(text: str, market_codes: List[str]) -> Dict[str, str]:
+    """从多市场调用的输出中取出各市场的内容
+    
+    容忍代码块包裹和前后的说明文字；逐个键值解析，输出被截断时保留已完整的市场。
+    市场代码不区分大小写，值为空或不是字符串的市场视为缺失。
+    """
+    wanted = {code.upper(): code for code in market_codes}
+    result: Dict[str, str] = {}
+    index = text.find("{")
+    if index < 0:
+        return result
+    
+    def skip(position: int) -> int:
+        return _JSON_WHITESPACE.match(text, position).end()
+    
+    try:
+        index = skip(index + 1)
+        while index < len(text) and text[index] == '"':
+            key, index = _JSON_DECODER.raw_decode(text, index)
+            index = skip(index)
+            if not text.startswith(":", index):
+                break
+            value, index = _JSON_DECODER.raw_decode(text, skip(index + 1))
+            code = wanted.get(key.strip().upper())
+            if code is not None and isinstance(value, str) and value.strip():
+                result[code] = value.strip()
+            index = skip(index)
+            if not text.startswith(",", index):
+                break
+            index = skip(index + 1)
+    except ValueError:
+        pass
+    return result
+
+class OverseasContentGenerator:
+    """海外内容生成器"""
+    
+    def __init__(self, settings: Optional[Settings] = None):
+        self.settings = settings or get_settings()
+        unknown = set(self.settings.provider_names) - set(PROVIDER_FACTORIES)
+        if unknown:
+            raise ValueError(f"未知的服务商: {', '.join(sorted(unknown))}")
+        # 响应中的模型顺序固定，与启用顺序无关
+        self.provider_names = [name for name in PROVIDER_FACTORIES if name in self.settings.provider_names]
+        if not self.provider_names:
+            raise ValueError("至少需要启用一个服务商")
+        self.cache = create_response_cache(self.settings)
+        self.quota_store = create_quota_store(self.settings)
+        self.rate_limiters = create_rate_limiters(self.settings, self.quota_store) if self.settings.rate_limit_enabled else {}
+        self.guards = {
+            name: ProviderGuard(name, self.settings, self.rate_limiters.get(name)) for name in self.provider_names
+        }
+        self.single_flight = SingleFlight()
+        self.near_duplicates = create_near_duplicate_index(self.settings)
+        self.token_budget = TokenBudget(self.settings)
+        self.history = create_generation_history(self.settings)
+        self._providers: Optional[Dict[str, BaseAIService]] = None
+        self._provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._batch_semaphore: Optional[asyncio.Semaphore] = None
+    
+    @property
+    def providers(self) -> Dict[str, BaseAIService]:
+        """首次使用时才创建启用的服务商"""
+        if self._providers is None:
+            self._providers = {}
+            for name in self.provider_names:
+                service = PROVIDER_FACTORIES[name](self.settings)
+                service.cache = self.cache
+                service.token_budget = self.token_budget
+                self._providers[name] = service
+        return self._providers
+    
+    @property
+    def services(self) -> List[BaseAIService]:
+        return list(self.providers.values())
+    
+    async def startup(self):
+        """启动各服务商的连接池，预先创建并发控制和共享状态的连接，请求路径上不再做初始化"""
+        self._provider_semaphores = {
+            name: asyncio.Semaphore(self.settings.provider_max_concurrency) for name in self.provider_names
+        }
+        self._batch_semaphore = asyncio.Semaphore(self.settings.batch_max_concurrency)
+        await asyncio.gather(*(service.start() for service in self.services), self.quota_store.start())
+        if self.near_duplicates is not None:
+            await self.near_duplicates.start()
+        if self.history is not None and not await self.history.start():
+            self.history = None
+        logger.info("AI服务连接池已启动")
+    
+    async def shutdown(self):
+        """关闭连接池，释放 keep-alive 连接"""
+        if self._providers is not None:
+            await asyncio.gather(*(service.aclose() for service in self.services), return_exceptions=True)
+        if self.cache is not None:
+            await self.cache.close()
+        await self.quota_store.close()
+        if self.near_duplicates is not None:
+            await self.near_duplicates.close()
+        if self.history is not None:
+            await self.history.close()
+        logger.info("AI服务连接池已关闭")
+    
+    def _provider_calls(self, prompt: str, market_code: str, use_cache: bool = True,
+                        durations: Optional[Dict[str, float]] = None, content_type: Optional[str] = None,
+                        length: Optional[str] = None) -> Dict[str, Awaitable[str]]:
+        """各服务商的调用协程，键为响应中的模型名，失败时抛出异常"""
+        return {
+            name: self._call_provider(name, prompt, market_code, use_cache, durations,
+                                      content_type=content_type, length=length)
+            for name in self.providers
+        }
+    
+    async def _call_provider(self, provider: str, prompt: str, market_code: str, use_cache: bool = True,
+                             durations: Optional[Dict[str, float]] = None,
+                             on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+                             content_type: Optional[str] = None, length: Optional[str] = None) -> str:
+        """经过限流、并发限制和容错层调用服务商，失败时抛出异常
+        
+        传入 on_delta 时改用上游的流式接口，每收到一段文本就回调一次，仍返回完整文本；
+        输出上限按 content_type × length 分配，未提供时使用 max_tokens
+        """
+        service = self.providers[provider]
+        max_tokens = self.token_budget.max_tokens(provider, content_type, length)
+        return await self._guarded_call(
+            provider,
+            lambda upstream: service.complete(prompt, market_code, use_cache, upstream, max_tokens),
+            durations, on_delta, max_tokens
+        )
+    
+    async def _call_provider_markets(self, provider: str, prompt: str, market_codes: List[str], use_cache: bool = True,
+                                     max_tokens: Optional[int] = None) -> str:
+        """一次调用为多个市场生成，返回未拆分的 JSON 文本，失败时抛出异常"""
+        service = self.providers[provider]
+        return await self._guarded_call(
+            provider,
+            lambda upstream: service.complete_markets(prompt, market_codes, use_cache, upstream, max_tokens),
+            max_tokens=max_tokens
+        )
+    
+    async def _guarded_call(self, provider: str, complete: Callable[[Callable[[str], Awaitable[str]]], Awaitable[str]],
+                            durations: Optional[Dict[str, float]] = None,
+                            on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+                            max_tokens: Optional[int] = None) -> str:
+        """complete 接收包装好的上游调用，缓存未命中时才经过容错和限流"""
+        semaphore = self._provider_semaphores[provider]
+        guard = self.guards[provider]
+        if not guard.available:
+            # 熔断中的服务商立即跳过，不占用并发名额
+            metrics.provider_calls.inc(provider=provider, outcome="skipped")
+            self._notify_progress(provider, "skipped")
+            raise ProviderUnavailableError(f"{provider} 熔断中，{guard.breaker.retry_after():.0f}秒后重新探测")
+        
+        service = self.providers[provider]
+        
+        async def upstream(built_prompt: str) -> str:
+            # 只有缓存未命中的上游请求才经过容错和限流
+            cost = service.count_tokens(built_prompt) + service._max_tokens(max_tokens)
+            if on_delta is not None:
+                return await guard.call(
+                    lambda: self._stream_upstream(service, built_prompt, on_delta, max_tokens), cost, semaphore
+                )
+            return await guard.call(lambda: service._request(built_prompt, max_tokens), cost, semaphore)
+        
+        started = time.perf_counter()
+        outcome = "error"
+        metrics.provider_in_flight.inc(provider=provider)
+        try:
+            result = await complete(upstream)
+            outcome = "ok"
+            return result
+        except ProviderUnavailableError:
+            # 检查之后其他请求抢到了半开探测名额，与熔断跳过同样处理
+            outcome = "skipped"
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.provider_in_flight.dec(provider=provider)
+            metrics.provider_calls.inc(provider=provider, outcome=outcome)
+            metrics.provider_duration.observe(elapsed, provider=provider)
+            if durations is not None:
+                durations[provider] = elapsed
+            self._notify_progress(provider, outcome)
+    
+    @staticmethod
+    def _notify_progress(provider: str, outcome: str):
+        hook = provider_progress.get()
+        if hook is not None:
+            hook(provider, outcome)
+    
+    @staticmethod
+    async def _stream_upstream(service: BaseAIService, built_prompt: str,
+                               on_delta: Callable[[str], Awaitable[None]], max_tokens: Optional[int] = None) -> str:
+        """流式请求上游，逐段回调；on_delta 等待期间不再读取上游，回调慢则上游随之放慢"""
+        parts: List[str] = []
+        try:
+            async for delta in service._stream_request(built_prompt, max_tokens):
+                parts.append(delta)
+                await on_delta(delta)
+        except Exception as error:
+            if parts:
+                # 已推送过增量的调用不能重试，否则消费方会收到重复内容
+                raise StreamError(f"{service.name} 流式输出中断: {error}") from error
+            raise
+        return "".join(parts)
+    
+    def _error_text(self, provider: str, error: BaseException) -> str:
+        """与各服务原有格式一致的失败说明"""
+        label = self.providers[provider].error_label
+        logger.error(f"{label}: {error}")
+        return f"{label}: {str(error)}"
+    
+    async def generate_content(self, request: ContentRequest) -> Dict[str, Any]:
+        """生成海外内容，相同的并发请求合并为一次上游调用"""
+        if not self.settings.single_flight_enabled:
+            return await self._generate_content(request)
+        result, shared = await self.single_flight.do(self._coalesce_key(request), lambda: self._generate_content(request))
+        metrics.single_flight.inc(role="follower" if shared else "leader")
+        result = dict(result)
+        if shared:
+            result["coalesced"] = True
+        return result
+    
+    @staticmethod
+    def _coalesce_key(request: ContentRequest) -> str:
+        """归一化请求：忽略提示词首尾及连续空白、市场和类型的大小写"""
+        return json.dumps([
+            " ".join(request.prompt.split()),
+            resolve_market_code(request.target_market),
+            request.content_type.strip().lower(),
+            request.tone.strip().lower(),
+            request.length.strip().lower(),
+            request.mode,
+            request.hedge,
+            request.hedge_delay_ms,
+            request.bypass_cache,
+            request.include_market_config,
+            request.reuse
+        ], ensure_ascii=False)
+    
+    async def _generate_content(self, request: ContentRequest) -> Dict[str, Any]:
+        try:
+            market_code = resolve_market_code(request.target_market)
+            if market_code not in MARKET_CONFIGS:
+                raise ValueError(f"不支持的市场: {market_code}")
+            if request.mode not in ("all", "race"):
+                raise ValueError(f"不支持的生成模式: {request.mode}")
+            if request.reuse not in ("off", "result", "seed"):
+                raise ValueError(f"不支持的复用方式: {request.reuse}")
+            
+            market_config = MARKET_CONFIGS[market_code]
+            logger.info(f"开始生成海外内容 - 市场: {market_code}, 类型: {request.content_type}, 模式: {request.mode}")
+            
+            if request.mode == "race":
+                return await self._generate_race(request, market_code)
+            
+            # 查找近似重复的历史生成：可直接复用结果，或作为参考附加到提示词
+            partition = self._near_duplicate_partition(market_code, request)
+            fingerprint = 0
+            similar: Optional[NearDuplicateMatch] = None
+            if self.near_duplicates is not None:
+                fingerprint = self.near_duplicates.fingerprint(request.prompt)
+                similar = self.near_duplicates.find(partition, fingerprint)
+            if similar is not None and request.reuse == "result" and not request.bypass_cache:
+                self.near_duplicates.touch(similar.entry)
+                return {
+                    "success": True,
+                    "market": self._market_payload(market_code, request),
+                    "content": similar.entry.content,
+                    "errors": {},
+                    "optimization_tips": market_config["optimization_tips"],
+                    "reused": similar.summary(),
+                    "generated_at": datetime.now().isoformat()
+                }
+            prompt = request.prompt
+            if similar is not None and request.reuse == "seed":
+                prompt = self._seeded_prompt(prompt, similar.entry)
+            
+            # 并行调用多个AI模型（复用各服务商的连接池）
+            durations: Dict[str, float] = {}
+            with token_report() as usage, metrics.gather_duration.time():
+                calls = self._provider_calls(
+                    prompt, market_code, not request.bypass_cache, durations, request.content_type, request.length
+                )
+                results = await asyncio.gather(*calls.values(), return_exceptions=True)
+            if durations:
+                metrics.slowest_provider.observe(max(durations.values()))
+            
+            # 构建响应，失败的模型单独列在 errors 中
+            content: Dict[str, Optional[str]] = {}
+            errors: Dict[str, str] = {}
+            for name, result in zip(calls, results):
+                if isinstance(result, Exception):
+                    content[name] = None
+                    errors[name] = self._error_text(name, result)
+                else:
+                    content[name] = result
+            if len(errors) == len(content):
+                raise ProviderFailureError("所有模型均生成失败", errors)
+            if self.near_duplicates is not None and not errors:
+                self.near_duplicates.add(partition, request.prompt, fingerprint, content)
+            
+            response = {
+                "success": True,
+                "market": self._market_payload(market_code, request),
+                "content": content,
+                "errors": errors,
+                "optimization_tips": market_config["optimization_tips"],
+                "tokens": usage,
+                "generated_at": datetime.now().isoformat()
+            }
+            if similar is not None:
+                response["similar"] = similar.summary()
+            self._record_history(request, market_code, "all", content, errors, durations, usage)
+            
+            logger.info(f"海外内容生成成功 - 市场: {market_code}, 类型: {request.content_type}")
+            return response
+        
+        except Exception as e:
+            logger.error(f"海外内容生成失败: {e}")
+            response = {
+                "success": False,
+                "error": str(e),
+                "generated_at": datetime.now().isoformat()
+            }
+            if isinstance(e, ProviderFailureError):
+                response["errors"] = e.errors
+            return response
+    
+    async def generate_multi_market(self, request: MultiMarketContentRequest) -> Dict[str, Any]:
+        """一次调用为多个市场生成
+        
+        每个服务商只请求一次，用户提示和说明不再按市场重复；输出按市场拆分校验后分发为各市场的结果，
+        缺失、无效或整体失败的 (服务商, 市场) 自动回退为单市场调用。
+        """
+        market_codes: List[str] = []
+        for market in request.target_markets or list(MARKET_CONFIGS):
+            code = resolve_market_code(market)
+            if code not in MARKET_CONFIGS:
+                return {"success": False, "error": f"不支持的市场: {code}", "generated_at": datetime.now().isoformat()}
+            if code not in market_codes:
+                market_codes.append(code)
+        logger.info(f"开始多市场生成 - 市场: {', '.join(market_codes)}, 类型: {request.content_type}")
+        
+        use_cache = not request.bypass_cache
+        names = list(self.providers)
+        with token_report() as usage:
+            combined = await asyncio.gather(
+                *(self._call_provider_markets(name, request.prompt, market_codes, use_cache,
+                                              self._multi_market_max_tokens(name, request, len(market_codes)))
+                  for name in names),
+                return_exceptions=True
+            )
+        
+        content: Dict[str, Dict[str, Optional[str]]] = {code: {} for code in market_codes}
+        errors: Dict[str, Dict[str, str]] = {code: {} for code in market_codes}
+        fallback: List[Tuple[str, str]] = []
+        for name, result in zip(names, combined):
+            if isinstance(result, Exception):
+                logger.warning(f"{name} 多市场调用失败，逐市场补生成: {result}")
+                parsed: Dict[str, str] = {}
+            else:
+                parsed = split_market_output(result, market_codes)
+            for code in market_codes:
+                if code in parsed:
+                    content[code][name] = parsed[code]
+                    metrics.multi_market.inc(provider=name, result="split")
+                else:
+                    fallback.append((name, code))
+                    metrics.multi_market.inc(provider=name, result="fallback")
+        
+        if fallback:
+            with token_report(usage):
+                results = await asyncio.gather(
+                    *(self._call_provider(name, request.prompt, code, use_cache,
+                                          content_type=request.content_type, length=request.length)
+                      for name, code in fallback),
+                    return_exceptions=True
+                )
+            for (name, code), result in zip(fallback, results):
+                if isinstance(result, Exception):
+                    content[code][name] = None
+                    errors[code][name] = self._error_text(name, result)
+                else:
+                    content[code][name] = result
+        
+        generated_at = datetime.now().isoformat()
+        markets: Dict[str, Dict[str, Any]] = {}
+        for code in market_codes:
+            if len(errors[code]) == len(names):
+                markets[code] = {"success": False, "error": "所有模型均生成失败", "errors": errors[code], "generated_at": generated_at}
+                continue
+            self._record_history(request, code, "multi_market", content[code], errors[code])
+            markets[code] = {
+                "success": True,
+                "market": self._market_payload(code, request),
+                "content": {name: content[code][name] for name in names},
+                "errors": errors[code],
+                "optimization_tips": MARKET_CONFIGS[code]["optimization_tips"],
+                "generated_at": generated_at
+            }
+        fallback_markets: Dict[str, List[str]] = {}
+        for name, code in fallback:
+            fallback_markets.setdefault(code, []).append(name)
+        return {
+            "success": any(result["success"] for result in markets.values()),
+            "markets": markets,
+            "upstream_calls": {"combined": len(names), "fallback": len(fallback)},
+            "fallback": fallback_markets,
+            "tokens": usage,
+            "generated_at": generated_at
+        }
+    
+    def _record_history(self, request: Union[ContentRequest, MultiMarketContentRequest], market_code: str, mode: str,
+                        content: Dict[str, Optional[str]], errors: Dict[str, str],
+                        durations: Optional[Dict[str, float]] = None,
+                        tokens: Optional[Dict[str, Dict[str, int]]] = None):
+        """成功的生成写入历史：只放入写队列，不等待磁盘"""
+        if self.history is None:
+            return
+        self.history.record({
+            "created_at": time.time(),
+            "market": market_code,
+            "content_type": request.content_type,
+            "tone": request.tone,
+            "length": request.length,
+            "mode": mode,
+            "prompt": request.prompt,
+            "content": content,
+            "errors": errors,
+            "durations": {name: round(seconds, 3) for name, seconds in (durations or {}).items()},
+            "tokens": tokens or {}
+        })
+    
+    def _multi_market_max_tokens(self, provider: str, request: MultiMarketContentRequest, markets: int) -> int:
+        """合并调用的输出上限为各市场预算之和，不超过 multi_market_max_tokens"""
+        per_market = self.token_budget.max_tokens(provider, request.content_type, request.length)
+        return min(per_market * markets, self.settings.multi_market_max_tokens)
+    
+    @staticmethod
+    def _near_duplicate_partition(market_code: str, request: ContentRequest) -> str:
+        return "|".join([
+            market_code,
+            request.content_type.strip().lower(),
+            request.tone.strip().lower(),
+            request.length.strip().lower()
+        ])
+    
+    def _seeded_prompt(self, prompt: str, entry: NearDuplicateEntry) -> str:
+        """把相似需求的历史结果（取第一个成功的模型）作为参考附加到提示词"""
+        seed = next((text for text in entry.content.values() if text), "")
+        return (
+            f"{prompt}\n\n参考以下相近需求的历史生成结果，保持风格一致，并按本次需求调整：\n"
+            f"{seed[:self.settings.near_duplicate_seed_chars]}"
+        )
+    
+    async def _generate_race(self, request: ContentRequest, market_code: str) -> Dict[str, Any]:
+        """竞速模式：返回最先成功的模型结果"""
+        market_config = MARKET_CONFIGS[market_code]
+        with token_report() as usage:
+            winner, content, errors = await self._race(
+                request.prompt, market_code, not request.bypass_cache, self._hedge_delay(request),
+                request.content_type, request.length
+            )
+        if winner is None:
+            return {
+                "success": False,
+                "mode": "race",
+                "error": "所有模型均生成失败",
+                "errors": errors,
+                "generated_at": datetime.now().isoformat()
+            }
+        
+        logger.info(f"海外内容竞速生成成功 - 市场: {market_code}, 胜出模型: {winner}")
+        self._record_history(request, market_code, "race", {winner: content}, errors, tokens=usage)
+        return {
+            "success": True,
+            "mode": "race",
+            "market": self._market_payload(market_code, request),
+            "winner": winner,
+            "content": {winner: content},
+            "errors": errors,
+            "optimization_tips": market_config["optimization_tips"],
+            "tokens": usage,
+            "generated_at": datetime.now().isoformat()
+        }
+    
+    @staticmethod
+    def _market_payload(market_code: str, request: Union[ContentRequest, MultiMarketContentRequest]) -> dict:
+        return MARKET_CONFIGS[market_code] if request.include_market_config else MARKET_SUMMARIES[market_code]
+    
+    def _race_order(self) -> List[str]:
+        """按观测到的中位延迟排序，尚无样本的模型排在前面以便采样，熔断中的排在最后"""
+        return sorted(
+            self.providers,
+            key=lambda name: (not self.guards[name].available, self.guards[name].latency.percentile(0.5) or 0.0)
+        )
+    
+    def _hedge_delay(self, request: ContentRequest) -> Optional[float]:
+        """对冲延迟：显式指定优先，否则取首选模型的 p95 延迟；未开启对冲时同时发起"""
+        if request.hedge_delay_ms is not None:
+            return request.hedge_delay_ms / 1000
+        if not request.hedge:
+            return None
+        p95 = self.guards[self._race_order()[0]].latency.percentile(0.95)
+        return p95 if p95 is not None else self.settings.hedge_default_delay
+    
+    async def _race(self, prompt: str, market_code: str, use_cache: bool, hedge_delay: Optional[float],
+                    content_type: Optional[str] = None,
+                    length: Optional[str] = None) -> Tuple[Optional[str], Optional[str], Dict[str, str]]:
+        """依次（或同时）发起各模型，返回 (胜出模型, 内容, 失败信息)，并取消其余调用"""
+        order = self._race_order()
+        tasks: Dict[asyncio.Future, str] = {}
+        errors: Dict[str, str] = {}
+        try:
+            for index, name in enumerate(order):
+                call = self._call_provider(name, prompt, market_code, use_cache, content_type=content_type, length=length)
+                tasks[asyncio.ensure_future(call)] = name
+                is_last = index == len(order) - 1
+                if hedge_delay is None and not is_last:
+                    continue
+                winner = await self._first_success(tasks, errors, None if is_last else hedge_delay)
+                if winner is not None:
+                    return winner[0], winner[1], errors
+            return None, None, errors
+        finally:
+            # 取消落后的调用，及时释放连接和配额
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    async def _first_success(self, tasks: Dict[asyncio.Future, str], errors: Dict[str, str],
+                             timeout: Optional[float]) -> Optional[Tuple[str, str]]:
+        """等待第一个成功结果；超时或在途调用全部失败时返回 None"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        pending = {task for task in tasks if not task.done()}
+        while pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is None:
+                    return tasks[task], task.result()
+                errors[tasks[task]] = self._error_text(tasks[task], error)
+        return None
+    
+    async def generate_content_stream(self, request: ContentRequest) -> AsyncIterator[Dict[str, Any]]:
+        """流式生成海外内容：哪个模型先完成就先推送哪个"""
+        market_code = resolve_market_code(request.target_market)
+        if market_code not in MARKET_CONFIGS:
+            yield {"event": "error", "error": f"不支持的市场: {market_code}"}
+            return
+        
+        market_config = MARKET_CONFIGS[market_code]
+        logger.info(f"开始流式生成海外内容 - 市场: {market_code}, 类型: {request.content_type}")
+        
+        # 各模型的增量和结果汇入同一个有界队列，队列满时模型一侧暂停读取上游
+        events: asyncio.Queue = asyncio.Queue(maxsize=self.settings.stream_buffer_size)
+        
+        async def run(name: str):
+            streamed = False
+            
+            async def on_delta(text: str):
+                nonlocal streamed
+                streamed = True
+                await events.put({"event": "delta", "provider": name, "text": text})
+            
+            try:
+                content = await self._call_provider(
+                    name, request.prompt, market_code, not request.bypass_cache,
+                    on_delta=on_delta if request.stream_deltas else None,
+                    content_type=request.content_type, length=request.length
+                )
+            except Exception as error:
+                await events.put({"event": "result", "provider": name, "content": None, "error": self._error_text(name, error)})
+                return
+            if request.stream_deltas and not streamed:
+                # 命中缓存或演示模式没有增量，整段作为一个增量推送
+                await events.put({"event": "delta", "provider": name, "text": content})
+            await events.put({"event": "result", "provider": name, "content": content})
+        
+        providers = list(self.providers)
+        with token_report() as usage:
+            tasks = [asyncio.ensure_future(run(name)) for name in providers]
+        yield {"event": "start", "market": self._market_payload(market_code, request), "providers": providers}
+        
+        content: Dict[str, Optional[str]] = {}
+        errors: Dict[str, str] = {}
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await events.get()
+                if event["event"] == "result":
+                    remaining -= 1
+                    content[event["provider"]] = event["content"]
+                    if event["content"] is None:
+                        errors[event["provider"]] = event["error"]
+                yield event
+        finally:
+            # 客户端断开时取消尚未完成的调用
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        
+        if len(errors) < len(content):
+            self._record_history(request, market_code, "stream", content, errors, tokens=usage)
+        yield {
+            "event": "done",
+            "optimization_tips": market_config["optimization_tips"],
+            "tokens": usage,
+            "generated_at": datetime.now().isoformat()
+        }
+    
+    async def iter_batch(self, jobs: List[ContentRequest], concurrency: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """批量生成，按完成顺序产出带序号的结果"""
+        global_slots = self._batch_semaphore
+        local_slots = asyncio.Semaphore(min(concurrency or self.settings.batch_max_concurrency, self.settings.batch_max_concurrency))
+        
+        async def run(index: int, job: ContentRequest):
+            async with local_slots, global_slots:
+                return index, await self.generate_content(job)
+        
+        tasks = [asyncio.ensure_future(run(index, job)) for index, job in enumerate(jobs)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, result = await next_done
+                yield {"index": index, **result}
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    async def generate_batch(self, jobs: List[ContentRequest], concurrency: Optional[int] = None) -> Dict[str, Any]:
+        """批量生成并汇总结果"""
+        results = [item async for item in self.iter_batch(jobs, concurrency)]
+        results.sort(key=lambda item: item["index"])
+        return {
+            "success": True,
+            "count": len(results),
+            "succeeded": sum(1 for item in results if item["success"]),
+            "results": results,
+            "generated_at": datetime.now().isoformat()
+        }
+    
+    def saturation_retry_after(self) -> Optional[float]:
+        """有服务商的配额排队已满时返回建议的 Retry-After 秒数"""
+        waits = [limiter.retry_after() for limiter in self.rate_limiters.values() if limiter.saturated]
+        return max(waits) if waits else None
+    
+    def provider_status(self) -> Dict[str, Any]:
+        """各服务商的熔断状态和自适应超时"""
+        return {
+            name: {**guard.status(), "tokens": self.token_budget.status(name)} for name, guard in self.guards.items()
+        }
+    
+    def get_supported_markets(self) -> Dict[str, Any]:
+        """获取支持的市场列表"""
+        return {
+            "markets": MARKET_CONFIGS,
+            "count": len(MARKET_CONFIGS),
+            "supported_content_types": ["social_media", "marketing_copy", "blog_post", "email_marketing"],
+            "supported_tones": ["professional", "casual", "friendly", "formal"]
+        }
+
+# ==================== 异步任务队列 ====================
+
+class JobQueueFullError(Exception):
+    """任务队列已满"""
+
+class WebhookURLError(ValueError):
+    """回调地址不在允许范围内"""
+
+def _non_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return not ip.is_global
+
+def check_webhook_url(url: str, settings: Settings) -> bool:
+    """按白名单和内网地址限制检查回调地址，返回是否还需要在投递前检查域名解析结果"""
+    host = (urlsplit(url).hostname or "").rstrip(".").lower()
+    allowed = [name.lower().lstrip(".") for name in settings.job_webhook_allowed_hosts]
+    if any(host == name or host.endswith("." + name) for name in allowed):
+        return False
+    if allowed:
+        raise WebhookURLError(f"回调主机 {host} 不在白名单中")
+    if settings.job_webhook_allow_private:
+        return False
+    if host == "localhost" or host.endswith(".localhost"):
+        raise WebhookURLError("不允许回调到本机地址")
+    try:
+        blocked = _non_public_address(host)
+    except ValueError:
+        # 域名在投递前解析后再检查
+        return True
+    if blocked:
+        raise WebhookURLError(f"不允许回调到非公网地址 {host}")
+    return False
+
+class JobStore:
+    """异步任务状态的 SQLite 持久化，也是多进程共享的任务队列"""
+    
+    def __init__(self, path: str, retention_seconds: float):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        # 单线程执行器串行访问连接，避免阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # 自动提交模式，认领任务时由 BEGIN IMMEDIATE 显式加写锁
+            self._conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, "
+                "request TEXT NOT NULL, webhook_url TEXT, webhook_status TEXT, "
+                "result TEXT, error TEXT, created_at REAL NOT NULL, "
+                "started_at REAL, finished_at REAL, lease_expires_at REAL)"
+            )
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(generation_jobs)")}
+            if "lease_expires_at" not in columns:
+                self._conn.execute("ALTER TABLE generation_jobs ADD COLUMN lease_expires_at REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, priority, created_at)")
+        return self._conn
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def _insert(self, job: Dict[str, Any]):
+        self._connect().execute(
+            "INSERT INTO generation_jobs (id, status, priority, request, webhook_url, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job["id"], job["status"], job["priority"], job["request"], job["webhook_url"], job["created_at"])
+        )
+    
+    def _update(self, job_id: str, fields: Dict[str, Any], expected_status: Optional[str]) -> bool:
+        conn = self._connect()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        if expected_status is None:
+            cursor = conn.execute(f"UPDATE generation_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        else:
+            cursor = conn.execute(
+                f"UPDATE generation_jobs SET {assignments} WHERE id = ? AND status = ?",
+                (*fields.values(), job_id, expected_status)
+            )
+        return cursor.rowcount > 0
+    
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT * FROM generation_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+    
+    def _claim(self, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """认领优先级最高的排队任务；加写锁保证同一任务只被一个进程认领"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM generation_jobs WHERE status = 'queued' ORDER BY priority, created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                now = time.time()
+                conn.execute(
+                    "UPDATE generation_jobs SET status = 'running', started_at = ?, lease_expires_at = ? WHERE id = ?",
+                    (now, now + lease_seconds, row["id"])
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if row is None:
+            return None
+        return {**dict(row), "status": "running", "started_at": now, "lease_expires_at": now + lease_seconds}
+    
+    def _recover(self) -> int:
+        """租约过期的执行中任务（所在进程已退出）重新排队，并清理过期的已结束任务"""
+        conn = self._connect()
+        now = time.time()
+        cursor = conn.execute(
+            "UPDATE generation_jobs SET status = 'queued', started_at = NULL, lease_expires_at = NULL "
+            "WHERE status = 'running' AND lease_expires_at < ?",
+            (now,)
+        )
+        conn.execute(
+            "DELETE FROM generation_jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+            (now - self.retention_seconds,)
+        )
+        return cursor.rowcount
+    
+    def _requeue(self, job_ids: List[str]):
+        self._connect().executemany(
+            "UPDATE generation_jobs SET status = 'queued', started_at = NULL, lease_expires_at = NULL "
+            "WHERE id = ? AND status = 'running'",
+            [(job_id,) for job_id in job_ids]
+        )
+    
+    def _count_queued(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued'").fetchone()[0]
+    
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    async def start(self):
+        await self._run(self._connect)
+    
+    async def insert(self, job: Dict[str, Any]):
+        await self._run(self._insert, job)
+    
+    async def update(self, job_id: str, expected_status: Optional[str] = None, **fields) -> bool:
+        """更新任务字段；指定 expected_status 时仅在状态匹配时更新"""
+        return await self._run(self._update, job_id, fields, expected_status)
+    
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._get, job_id)
+    
+    async def claim(self, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        return await self._run(self._claim, lease_seconds)
+    
+    async def recover(self) -> int:
+        return await self._run(self._recover)
+    
+    async def requeue(self, job_ids: List[str]):
+        await self._run(self._requeue, job_ids)
+    
+    async def count_queued(self) -> int:
+        return await self._run(self._count_queued)
+    
+    async def close(self):
+        await self._run(self._close)
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(value).isoformat() if value is not None else None
+
+class GenerationJobQueue:
+    """有界优先级队列：提交即返回任务ID，各进程的工作协程从 SQLite 认领任务执行，完成后可轮询或回调"""
+    
+    def __init__(self, generator: OverseasContentGenerator, store: JobStore):
+        self.generator = generator
+        self.settings = generator.settings
+        self.store = store
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._cancelled: Set[str] = set()
+        self._recovered_at = 0.0
+        self._webhook_client: Optional[httpx.AsyncClient] = None
+        self._webhook_tasks: Set[asyncio.Task] = set()
+    
+    async def start(self):
+        """启动工作协程，并恢复租约已过期的任务"""
+        self._wakeup = asyncio.Event()
+        await self.store.start()
+        await self._maintain()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.settings.job_workers)]
+    
+    async def stop(self):
+        """停止工作协程；本进程执行中的任务放回队列，由下次启动或其他进程继续执行"""
+        running = list(self._running)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if running:
+            await self.store.requeue(running)
+        if self._webhook_tasks:
+            await asyncio.gather(*self._webhook_tasks, return_exceptions=True)
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+            self._webhook_client = None
+        await self.store.close()
+    
+    async def submit(self, request: ContentJobRequest) -> Dict[str, Any]:
+        """持久化并入队，立即返回任务信息"""
+        if self._wakeup is None:
+            raise RuntimeError("任务队列未启动")
+        queued = await self.store.count_queued()
+        if queued >= self.settings.job_queue_max_size:
+            metrics.jobs.inc(status="rejected")
+            raise JobQueueFullError(f"任务队列已满（{self.settings.job_queue_max_size}）")
+        
+        if request.webhook_url:
+            check_webhook_url(request.webhook_url, self.settings)
+        content_request = ContentRequest(**request.model_dump(exclude={"priority", "webhook_url"}))
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "priority": request.priority,
+            "request": content_request.model_dump_json(),
+            "webhook_url": request.webhook_url,
+            "created_at": time.time()
+        }
+        await self.store.insert(job)
+        self._wakeup.set()
+        metrics.jobs.inc(status="queued")
+        metrics.job_queue_depth.set(queued + 1)
+        return self._public(job)
+    
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self.store.get(job_id)
+        return self._public(job) if job is not None else None
+    
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消排队中或执行中的任务，已结束的任务原样返回"""
+        job = await self.store.get(job_id)
+        if job is None:
+            return None
+        if job["status"] in ("queued", "running"):
+            if await self.store.update(job_id, expected_status=job["status"], status="cancelled", finished_at=time.time()):
+                metrics.jobs.inc(status="cancelled")
+                # 在其他进程执行的任务无法中断，其结果会因状态已变化而被丢弃
+                task = self._running.get(job_id)
+                if task is not None:
+                    self._cancelled.add(job_id)
+                    task.cancel()
+            job = await self.store.get(job_id)
+        return self._public(job)
+    
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        result = job.get("result")
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "priority": job["priority"],
+            "created_at": _timestamp(job.get("created_at")),
+            "started_at": _timestamp(job.get("started_at")),
+            "finished_at": _timestamp(job.get("finished_at")),
+            "result": json.loads(result) if result else None,
+            "error": job.get("error"),
+            "webhook": {"url": job["webhook_url"], "status": job.get("webhook_status")} if job.get("webhook_url") else None
+        }
+    
+    async def _maintain(self):
+        """定期回收失联进程的任务并刷新队列深度"""
+        now = time.monotonic()
+        if self._recovered_at and now - self._recovered_at < self.settings.job_recovery_interval:
+            return
+        self._recovered_at = now
+        recovered = await self.store.recover()
+        if recovered:
+            logger.info(f"恢复未完成的异步任务: {recovered} 个")
+        metrics.job_queue_depth.set(await self.store.count_queued())
+    
+    async def _worker(self):
+        while True:
+            # 先清除唤醒标记再认领，认领之后提交的任务一定能唤醒等待
+            self._wakeup.clear()
+            try:
+                await self._maintain()
+                job = await self.store.claim(self.settings.job_lease_seconds)
+            except Exception as e:
+                logger.error(f"认领异步任务失败: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.settings.job_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            job_id = job["id"]
+            task = asyncio.ensure_future(self._execute(job))
+            self._running[job_id] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                # 被取消的是任务本身时继续处理下一个，工作协程被取消时退出
+                if not task.cancelled() or job_id not in self._cancelled:
+                    raise
+            except Exception as e:
+                logger.error(f"异步任务 {job_id} 执行异常: {e}")
+            finally:
+                self._running.pop(job_id, None)
+                self._cancelled.discard(job_id)
+    
+    async def _execute(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        started_at = job["started_at"]
+        # 后台任务作为独立调用方参与配额排队，不挤占在线请求
+        current_caller.set("jobs")
+        request = ContentRequest.model_validate_json(job["request"])
+        try:
+            result = await self.generator.generate_content(request)
+        except Exception as e:
+            result = {"success": False, "error": str(e), "generated_at": datetime.now().isoformat()}
+        
+        status = "succeeded" if result.get("success") else "failed"
+        finished_at = time.time()
+        metrics.job_duration.observe(finished_at - started_at)
+        # 执行期间已被取消或租约过期被回收的任务不再覆盖状态
+        if not await self.store.update(
+            job_id, expected_status="running", status=status, result=dumps_json(result).decode("utf-8"),
+            error=result.get("error"), finished_at=finished_at, lease_expires_at=None
+        ):
+            return
+        metrics.jobs.inc(status=status)
+        
+        if job["webhook_url"]:
+            task = asyncio.ensure_future(self._deliver_webhook(job_id, job["webhook_url"]))
+            self._webhook_tasks.add(task)
+            task.add_done_callback(self._webhook_tasks.discard)
+    
+    async def _deliver_webhook(self, job_id: str, url: str):
+        """POST 任务结果到回调地址，失败按指数退避重试"""
+        if self._webhook_client is None:
+            self._webhook_client = create_http_client(self.settings, "")
+        if not await self._webhook_target_allowed(job_id, url):
+            metrics.webhooks.inc(outcome="blocked")
+            await self.store.update(job_id, webhook_status="blocked")
+            return
+        payload = dumps_json(await self.get(job_id))
+        headers = {"Content-Type": "application/json", "X-GEO-Job-Id": job_id}
+        
+        for attempt in range(self.settings.job_webhook_max_attempts):
+            try:
+                response = await self._webhook_client.post(
+                    url, content=payload, headers=headers, timeout=self.settings.job_webhook_timeout
+                )
+                response.raise_for_status()
+                metrics.webhooks.inc(outcome="delivered")
+                await self.store.update(job_id, webhook_status="delivered")
+                return
+            except Exception as e:
+                logger.warning(f"任务 {job_id} 回调失败（第{attempt + 1}次）: {e}")
+                if attempt + 1 < self.settings.job_webhook_max_attempts:
+                    await asyncio.sleep(self.settings.retry_base_delay * 2 ** attempt)
+        
+        metrics.webhooks.inc(outcome="failed")
+        await self.store.update(job_id, webhook_status="failed")
+    
+    async def _webhook_target_allowed(self, job_id: str, url: str) -> bool:
+        """提交后配置可能已变化、域名也可能解析到内网，投递前按当前配置和解析结果再检查一次"""
+        try:
+            if not check_webhook_url(url, self.settings):
+                return True
+            parsed = urlsplit(url)
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+            infos = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)
+        except WebhookURLError as e:
+            logger.warning(f"任务 {job_id} 回调地址被拒绝: {e}")
+            return False
+        except OSError:
+            # 解析失败交给投递重试
+            return True
+        blocked = sorted({info[4][0] for info in infos if _non_public_address(info[4][0])})
+        if blocked:
+            logger.warning(f"任务 {job_id} 回调地址解析到非公网地址 {', '.join(blocked)}，已拒绝")
+            return False
+        return True
+
+def create_job_queue(generator: OverseasContentGenerator) -> GenerationJobQueue:
+    settings = generator.settings
+    store = JobStore(sqlite_path_from_url(settings.database_url), settings.job_retention_seconds)
+    return GenerationJobQueue(generator, store)
+
+# ==================== GEO评分 ====================
+
+@lru_cache()
+def _numpy():
+    """NumPy 是可选依赖且导入较慢，首次评分时才导入；未安装时返回 None，走纯 Python 计算"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# 中日文不以空格分词，按单字切分；其余文字按连续的字母数字切分
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(f"[{_CJK_CHARS}]|[^\\W_{_CJK_CHARS}]+(?:['’][^\\W_{_CJK_CHARS}]+)*")
+CJK_PATTERN = re.compile(f"[{_CJK_CHARS}]")
+SENTENCE_PATTERN = re.compile(r"[.!?。！？…]+|\n\s*\n")
+HASHTAG_PATTERN = re.compile(r"(?<![\w#])#\w+")
+
+# 目标市场语言中常见的行动号召短语
+CTA_PHRASES = [
+    "learn more", "shop now", "buy now", "order now", "sign up", "get started", "book now", "try it",
+    "subscribe", "download", "register", "contact us", "click", "link in bio", "limited time", "don't miss",
+    "jetzt kaufen", "mehr erfahren", "jetzt bestellen", "anmelden", "en savoir plus", "acheter",
+    "commandez", "inscrivez-vous", "découvrez", "今すぐ", "詳しくは", "購入", "登録", "お申し込み",
+    "立即", "了解更多", "点击", "购买", "注册", "下单"
+]
+
+# 各平台的理想正文长度（字符数），平台名不区分大小写，未知平台按所属类别
+PLATFORM_LENGTH_RANGES = {
+    "twitter": (70, 280),
+    "facebook": (40, 500),
+    "linkedin": (150, 1300),
+    "instagram": (100, 2200),
+    "tiktok": (50, 300),
+    "google": (1000, 10000),
+    "bing": (1000, 10000),
+    "yahoo": (1000, 10000),
+    "youtube": (200, 5000),
+    "medium": (2000, 15000),
+    "reddit": (100, 4000),
+    "quora": (300, 4000),
+    "amazon": (500, 2000),
+    "ebay": (200, 2000),
+    "shopify": (300, 3000),
+    "etsy": (200, 2000),
+    "social_media": (50, 500),
+    "search_engine": (1000, 10000),
+    "content_platform": (300, 5000),
+    "ecommerce": (200, 2000),
+    "general": (100, 3000)
+}
+
+# 各平台类别下评分项的权重
+SCORE_WEIGHTS = {
+    "social_media": {"keywords": 0.15, "long_tail": 0.05, "readability": 0.2, "hashtags": 0.2, "cta": 0.15, "length": 0.25},
+    "search_engine": {"keywords": 0.3, "long_tail": 0.25, "readability": 0.2, "hashtags": 0.0, "cta": 0.05, "length": 0.2},
+    "content_platform": {"keywords": 0.2, "long_tail": 0.15, "readability": 0.25, "hashtags": 0.05, "cta": 0.1, "length": 0.25},
+    "ecommerce": {"keywords": 0.25, "long_tail": 0.15, "readability": 0.15, "hashtags": 0.0, "cta": 0.25, "length": 0.2},
+    "general": {"keywords": 0.2, "long_tail": 0.1, "readability": 0.25, "hashtags": 0.1, "cta": 0.15, "length": 0.2}
+}
+
+# 优化目标对应加倍权重的评分项
+GOAL_EMPHASIS = {
+    "engagement": "hashtags",
+    "conversion": "cta",
+    "awareness": "keywords",
+    "traffic": "long_tail"
+}
+
+# 关键词密度的理想区间，超过上限视为堆砌
+KEYWORD_DENSITY_RANGE = (0.01, 0.03)
+KEYWORD_STUFFING_SPAN = 0.05
+# 可读性：每句词数、平均词长的舒适上限
+SENTENCE_WORDS_COMFORT = 20.0
+WORD_LENGTH_COMFORT = 6.0
+HASHTAG_MAX = 5
+# 估算词数时中日文约两个字一个词
+CJK_CHARS_PER_WORD = 2.0
+
+class _ScalarMath:
+    """与 NumPy 同名的标量运算，让评分公式在无 NumPy 时逐条复用"""
+    
+    @staticmethod
+    def clip(value, low, high):
+        return max(low, min(high, value))
+    
+    @staticmethod
+    def maximum(a, b):
+        return max(a, b)
+    
+    @staticmethod
+    def minimum(a, b):
+        return min(a, b)
+    
+    @staticmethod
+    def where(condition, a, b):
+        return a if condition else b
+
+def _tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+class GEOScorer:
+    """批量计算文本的 GEO 指标并排序
+    
+    所有文本与关键词、长尾词、行动号召短语共享一张词表，每条文本只做一遍分词和词组查表，
+    词频矩阵和各项得分在 NumPy 中按整批向量化计算。
+    """
+    
+    def __init__(self, platform_groups: Dict[str, List[str]]):
+        self.groups = {name.lower(): group for group, names in platform_groups.items() for name in names}
+        self.groups.update({group: group for group in platform_groups})
+        self.cta_phrases = [tuple(_tokenize(phrase)) for phrase in CTA_PHRASES]
+    
+    def platform_group(self, platform: str) -> str:
+        return self.groups.get(platform.lower(), "general")
+    
+    def weights(self, group: str, goal: str, has_keywords: bool, has_long_tail: bool) -> Dict[str, float]:
+        """按平台类别和目标取权重；未提供关键词时对应项不参与评分，权重归一化"""
+        weights = dict(SCORE_WEIGHTS[group])
+        emphasis = GOAL_EMPHASIS.get(goal)
+        if emphasis and weights[emphasis]:
+            weights[emphasis] *= 2
+        if not has_keywords:
+            weights["keywords"] = 0.0
+        if not has_long_tail:
+            weights["long_tail"] = 0.0
+        total = sum(weights.values())
+        return {name: value / total for name, value in weights.items()}
+    
+    def score(self, texts: List[str], keywords: List[str], long_tail_keywords: Optional[List[str]] = None,
+              platform: str = "general", goal: str = "engagement", top_k: Optional[int] = None) -> Dict[str, Any]:
+        """为一批文本打分，按总分从高到低返回（top_k 只保留前若干条）"""
+        keywords, keyword_phrases = self._phrases(keywords)
+        if long_tail_keywords is None:
+            # 未指定长尾词时取关键词中三个词及以上的短语
+            long_tail_phrases = [phrase for phrase in keyword_phrases if self._phrase_words(phrase) >= 3]
+        else:
+            long_tail_phrases = self._phrases(long_tail_keywords)[1]
+        
+        vocabulary: Dict[Tuple[str, ...], int] = {}
+        for phrase in keyword_phrases + long_tail_phrases + self.cta_phrases:
+            vocabulary.setdefault(phrase, len(vocabulary))
+        keyword_ids = [vocabulary[phrase] for phrase in keyword_phrases]
+        long_tail_ids = [vocabulary[phrase] for phrase in long_tail_phrases]
+        cta_ids = sorted({vocabulary[phrase] for phrase in self.cta_phrases})
+        keyword_lengths = [len(phrase) for phrase in keyword_phrases]
+        
+        # 按词组首词索引可能的词组长度，分词后只在首词命中处查表
+        prefixes: Dict[str, Set[int]] = defaultdict(set)
+        for phrase in vocabulary:
+            prefixes[phrase[0]].add(len(phrase))
+        features = [self._features(text, vocabulary, prefixes) for text in texts]
+        group = self.platform_group(platform)
+        length_range = PLATFORM_LENGTH_RANGES.get(platform.lower(), PLATFORM_LENGTH_RANGES[group])
+        weights = self.weights(group, goal, bool(keyword_ids), bool(long_tail_ids))
+        
+        np = _numpy()
+        if np is not None and texts:
+            rows = self._score_vectorized(np, features, len(vocabulary), keyword_ids, keyword_lengths,
+                                          long_tail_ids, cta_ids, length_range, weights)
+        else:
+            rows = [
+                self._score_one(_ScalarMath, feature, keyword_ids, keyword_lengths, long_tail_ids, cta_ids,
+                                length_range, weights)
+                for feature in features
+            ]
+        
+        results = []
+        for index, (row, feature) in enumerate(zip(rows, features)):
+            counts = feature["counts"]
+            results.append({
+                "index": index,
+                "score": round(row["score"], 1),
+                "metrics": {
+                    "words": round(feature["words"], 1),
+                    "characters": feature["characters"],
+                    "sentences": feature["sentences"],
+                    "keyword_density": round(row["keyword_density"] * 100, 2),
+                    "keyword_coverage": round(row["keyword_coverage"], 3),
+                    "long_tail_coverage": round(row["long_tail_coverage"], 3),
+                    "readability": round(row["readability"] * 100, 1),
+                    "hashtags": feature["hashtags"],
+                    "has_cta": row["cta"] > 0,
+                    "length_fit": round(row["length"], 3)
+                },
+                "matched_keywords": [
+                    keyword for keyword, phrase in zip(keywords, keyword_phrases) if counts.get(vocabulary[phrase])
+                ]
+            })
+        results.sort(key=lambda item: item["score"], reverse=True)
+        for rank, item in enumerate(results, 1):
+            item["rank"] = rank
         
-        请根据以上市场特点生成适合的内容。
-        """
-
-class ClaudeService:
-    """Anthropic Claude服务"""
+        return {
+            "platform": platform,
+            "platform_group": group,
+            "goal": goal,
+            "weights": {name: round(value, 3) for name, value in weights.items()},
+            "engine": "numpy" if np is not None else "python",
+            "count": len(texts),
+            "results": results[:top_k] if top_k else results
+        }
     
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.base_url = "https://api.anthropic.com/v1/messages"
+    @staticmethod
+    def _phrases(keywords: List[str]) -> Tuple[List[str], List[Tuple[str, ...]]]:
+        """分词后去重，丢弃空关键词；返回保留的原始关键词及对应词组"""
+        kept, phrases = [], []
+        for keyword in keywords:
+            tokens = tuple(_tokenize(keyword))
+            if tokens and tokens not in phrases:
+                kept.append(keyword)
+                phrases.append(tokens)
+        return kept, phrases
     
-    async def generate_content(self, prompt: str, market_config: dict) -> str:
-        """生成内容"""
-        try:
-            # 构建市场特定的提示词
-            market_prompt = self._build_market_prompt(prompt, market_config)
-            
-            # 这里应该是实际的API调用
-            # 为了演示，返回模拟结果
-            return f"🧠 Claude生成内容 ({market_config['name']}):\n{market_prompt}\n\n这是使用Claude模型针对{market_config['name']}市场优化的内容。"
-        except Exception as e:
-            logger.error(f"Claude生成失败: {e}")
-            return f"Claude生成失败: {str(e)}"
+    @staticmethod
+    def _phrase_words(phrase: Tuple[str, ...]) -> float:
+        cjk = sum(1 for token in phrase if CJK_PATTERN.match(token))
+        return len(phrase) - cjk + cjk / CJK_CHARS_PER_WORD
+    
+    @staticmethod
+    def _features(text: str, vocabulary: Dict[Tuple[str, ...], int], prefixes: Dict[str, Set[int]]) -> Dict[str, Any]:
+        """单条文本的原始特征和词表中各词组的出现次数"""
+        tokens = _tokenize(text)
+        # 中日文每个字单独成词，其余词数和字符数可直接相减得到
+        cjk = len(CJK_PATTERN.findall(text))
+        latin_words = len(tokens) - cjk
+        counts: Dict[int, int] = defaultdict(int)
+        for start, token in enumerate(tokens):
+            sizes = prefixes.get(token)
+            if sizes:
+                for size in sizes:
+                    term = vocabulary.get(tuple(tokens[start:start + size]))
+                    if term is not None:
+                        counts[term] += 1
+        return {
+            "counts": counts,
+            "tokens": len(tokens),
+            "words": latin_words + cjk / CJK_CHARS_PER_WORD,
+            "latin_chars": sum(map(len, tokens)) - cjk,
+            "latin_words": latin_words,
+            "characters": len(text.strip()),
+            "sentences": max(1, sum(1 for part in SENTENCE_PATTERN.split(text) if part.strip())),
+            "hashtags": len(HASHTAG_PATTERN.findall(text))
+        }
     
-    def _build_market_prompt(self, prompt: str, market_config: dict) -> str:
-        """构建市场特定的提示词"""
-        return f"""
-        目标市场: {market_config['name']} {market_config['flag']}
-        文化特点: {', '.join(market_config['cultural_traits'])}
-        内容偏好: {', '.join(market_config['content_preferences'])}
-        优化建议: {', '.join(market_config['optimization_tips'])}
+    @staticmethod
+    def _formulas(xp, tokens, words, latin_chars, latin_words, characters, sentences, hashtags,
+                  keyword_hits, keyword_coverage, long_tail_coverage, cta, length_range, weights):
+        """各项得分（0~1）与总分（0~100）；xp 为 numpy 或 _ScalarMath，输入为整批数组或单条标量"""
+        low, high = KEYWORD_DENSITY_RANGE
+        density = keyword_hits / xp.maximum(tokens, 1)
+        density_score = xp.where(
+            density < low, density / low,
+            xp.clip(1 - (density - high) / KEYWORD_STUFFING_SPAN, 0.0, 1.0)
+        )
+        keywords_score = 0.5 * density_score + 0.5 * keyword_coverage
         
-        原始提示: {prompt}
+        sentence_words = words / sentences
+        word_length = latin_chars / xp.maximum(latin_words, 1)
+        readability = (
+            0.7 * xp.clip(1 - (sentence_words - SENTENCE_WORDS_COMFORT) / (2 * SENTENCE_WORDS_COMFORT), 0.0, 1.0)
+            + 0.3 * xp.clip(1 - (word_length - WORD_LENGTH_COMFORT) / WORD_LENGTH_COMFORT, 0.0, 1.0)
+        )
         
-        请根据以上市场特点生成适合的内容。
-        """
-
-class MotaService:
-    """DeepSeek服务（通过ModelScope）"""
-    
-    def __init__(self, access_token: str, api_base_url: str):
-        self.access_token = access_token
-        self.api_base_url = api_base_url
+        hashtag_score = xp.where(hashtags > HASHTAG_MAX, HASHTAG_MAX / xp.maximum(hashtags, 1), xp.minimum(hashtags, 1))
+        cta_score = xp.minimum(cta, 1)
+        
+        shortest, longest = length_range
+        length_score = xp.where(
+            characters < shortest, characters / shortest,
+            xp.where(characters > longest, longest / xp.maximum(characters, 1), 1.0)
+        )
+        
+        score = 100 * (
+            weights["keywords"] * keywords_score
+            + weights["long_tail"] * long_tail_coverage
+            + weights["readability"] * readability
+            + weights["hashtags"] * hashtag_score
+            + weights["cta"] * cta_score
+            + weights["length"] * length_score
+        )
+        return {
+            "score": score,
+            "keyword_density": density,
+            "keyword_coverage": keyword_coverage,
+            "long_tail_coverage": long_tail_coverage,
+            "readability": readability,
+            "cta": cta_score,
+            "length": length_score
+        }
     
-    async def optimize_content(self, prompt: str, market_config: dict) -> str:
-        """优化内容"""
-        try:
-            # 构建优化提示词
-            optimization_prompt = self._build_optimization_prompt(prompt, market_config)
-            
-            # 这里应该是实际的API调用
-            # 为了演示，返回模拟结果
-            return f"🔍 DeepSeek优化内容 ({market_config['name']}):\n{optimization_prompt}\n\n这是使用DeepSeek-V3.1模型针对{market_config['name']}市场优化的内容。"
-        except Exception as e:
-            logger.error(f"DeepSeek优化失败: {e}")
-            return f"DeepSeek优化失败: {str(e)}"
+    def _score_one(self, xp, feature: Dict[str, Any], keyword_ids: List[int], keyword_lengths: List[int],
+                   long_tail_ids: List[int], cta_ids: List[int], length_range: Tuple[int, int],
+                   weights: Dict[str, float]) -> Dict[str, float]:
+        counts = feature["counts"]
+        keyword_hits = sum(counts.get(term, 0) * size for term, size in zip(keyword_ids, keyword_lengths))
+        keyword_coverage = sum(1 for term in keyword_ids if counts.get(term)) / max(len(keyword_ids), 1)
+        long_tail_coverage = sum(1 for term in long_tail_ids if counts.get(term)) / max(len(long_tail_ids), 1)
+        cta = sum(counts.get(term, 0) for term in cta_ids)
+        return self._formulas(
+            xp, feature["tokens"], feature["words"], feature["latin_chars"], feature["latin_words"],
+            feature["characters"], feature["sentences"], feature["hashtags"], keyword_hits, keyword_coverage,
+            long_tail_coverage, cta, length_range, weights
+        )
     
-    def _build_optimization_prompt(self, prompt: str, market_config: dict) -> str:
-        """构建优化提示词"""
-        return f"""
-        目标市场: {market_config['name']} {market_config['flag']}
-        文化特点: {', '.join(market_config['cultural_traits'])}
-        内容偏好: {', '.join(market_config['content_preferences'])}
-        优化建议: {', '.join(market_config['optimization_tips'])}
+    def _score_vectorized(self, np, features: List[Dict[str, Any]], vocabulary_size: int, keyword_ids: List[int],
+                          keyword_lengths: List[int], long_tail_ids: List[int], cta_ids: List[int],
+                          length_range: Tuple[int, int], weights: Dict[str, float]) -> List[Dict[str, float]]:
+        """整批文本一次性组装成 文本×词表 的词频矩阵，各项得分按列向量运算"""
+        documents = len(features)
+        rows = [document for document, feature in enumerate(features) for term in feature["counts"]]
+        terms = [term for feature in features for term in feature["counts"]]
+        hits = [count for feature in features for count in feature["counts"].values()]
+        matrix = np.zeros((documents, max(vocabulary_size, 1)), dtype=np.float64)
+        if rows:
+            matrix[np.asarray(rows), np.asarray(terms)] = np.asarray(hits, dtype=np.float64)
         
-        原始内容: {prompt}
+        def column(name: str):
+            return np.fromiter((feature[name] for feature in features), dtype=np.float64, count=documents)
         
-        请使用DeepSeek-V3.1模型对以上内容进行优化，使其更适合目标市场。
-        """
+        def coverage(ids: List[int]):
+            if not ids:
+                return np.zeros(documents)
+            return (matrix[:, ids] > 0).mean(axis=1)
+        
+        keyword_hits = matrix[:, keyword_ids] @ np.asarray(keyword_lengths, dtype=np.float64) if keyword_ids else np.zeros(documents)
+        columns = self._formulas(
+            np, column("tokens"), column("words"), column("latin_chars"), column("latin_words"),
+            column("characters"), column("sentences"), column("hashtags"), keyword_hits, coverage(keyword_ids),
+            coverage(long_tail_ids), matrix[:, cta_ids].sum(axis=1), length_range, weights
+        )
+        values = {name: array.tolist() for name, array in columns.items()}
+        return [{name: values[name][document] for name in values} for document in range(documents)]
 
-# ==================== 海外内容生成器 ====================
+# ==================== GEO优化器 ====================
 
-class OverseasContentGenerator:
-    """海外内容生成器"""
+@dataclass(frozen=True)
+class GEOGuidance:
+    """一个 (平台类别, 具体平台, 目标, 市场) 组合的优化策略和建议，启动时生成后只读复用"""
+    group: str
+    platform: str
+    strategy: str
+    tips: Tuple[str, ...]
+    prompt_suffix: str
+
+class GEOGuidanceIndex:
+    """GEO优化策略索引：从数据文件加载并校验一次，按 (平台类别, 具体平台, 目标, 市场) 预先组合好全部结果"""
     
-    def __init__(self):
-        self.settings = Settings()
-        self.gemini_service = GeminiService(self.settings.google_api_key)
-        self.claude_service = ClaudeService(self.settings.anthropic_api_key)
-        self.mota_service = MotaService(self.settings.mota_access_token, self.settings.mota_api_base_url)
+    def __init__(self, data: Dict[str, Any], platforms: Dict[str, List[str]], goals: Dict[str, str],
+                 markets: Dict[str, dict]):
+        self.version = data.get("version", "v1")
+        self._validate(data, platforms, goals)
+        groups = data["groups"]
+        fallback = data["fallback"]
+        
+        # 平台名（原样和小写）及平台类别名 -> (平台类别, 具体平台)，具体平台为空表示类别级
+        self._platform_keys: Dict[str, Tuple[str, str]] = {}
+        for group, names in platforms.items():
+            self._platform_keys[group] = (group, "")
+            for name in names:
+                self._platform_keys[name] = (group, name)
+                self._platform_keys[name.lower()] = (group, name)
+        self._platform_keys.setdefault("general", ("general", ""))
+        
+        # 市场维度为空表示不附带市场建议；目标为空对应未知目标，使用兜底策略
+        market_notes = {"": ("", ())}
+        for code, config in markets.items():
+            market_notes[code] = (
+                f"面向{config['name']}{config['flag']}受众：{'、'.join(config['content_preferences'])}",
+                tuple(config["optimization_tips"])
+            )
+        
+        self._entries: Dict[Tuple[str, str, str, str], GEOGuidance] = {}
+        for group, platform in set(self._platform_keys.values()):
+            group_data = groups[group]
+            platform_data = group_data.get("platforms", {}).get(platform, {}) if platform else {}
+            for goal in [*goals, ""]:
+                base = group_data["strategies"][goal] if goal else fallback["strategy"]
+                tips = tuple(platform_data.get("tips", ())) + tuple(group_data["tips"] if goal else fallback["tips"])
+                for market, (market_note, market_tips) in market_notes.items():
+                    strategy = "；".join(part for part in (base, platform_data.get("strategy", ""), market_note) if part)
+                    self._entries[(group, platform, goal, market)] = GEOGuidance(
+                        group=group,
+                        platform=platform,
+                        strategy=strategy,
+                        tips=tips + market_tips,
+                        prompt_suffix=f"\n\n优化策略: {strategy}\n\n请根据以上策略优化内容。"
+                    )
+        self._goals = frozenset(goals)
+        self._markets = frozenset(markets)
     
-    async def generate_content(self, request: ContentRequest) -> Dict[str, Any]:
-        """生成海外内容"""
-        try:
-            market_code = request.target_market.upper()
-            if market_code not in MARKET_CONFIGS:
-                raise ValueError(f"不支持的市场: {market_code}")
-            
-            market_config = MARKET_CONFIGS[market_code]
-            logger.info(f"开始生成海外内容 - 市场: {market_code}, 类型: {request.content_type}")
-            
-            # 并行调用多个AI模型
-            tasks = [
-                self.gemini_service.generate_content(request.prompt, market_config),
-                self.claude_service.generate_content(request.prompt, market_config),
-                self.mota_service.optimize_content(request.prompt, market_config)
-            ]
-            
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # 构建响应
-            response = {
-                "success": True,
-                "market": market_config,
-                "content": {
-                    "gemini": results[0] if not isinstance(results[0], Exception) else str(results[0]),
-                    "claude": results[1] if not isinstance(results[1], Exception) else str(results[1]),
-                    "deepseek": results[2] if not isinstance(results[2], Exception) else str(results[2])
-                },
-                "optimization_tips": market_config["optimization_tips"],
-                "generated_at": datetime.now().isoformat()
-            }
-            
-            logger.info(f"海外内容生成成功 - 市场: {market_code}, 类型: {request.content_type}")
-            return response
-            
-        except Exception as e:
-            logger.error(f"海外内容生成失败: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "generated_at": datetime.now().isoformat()
-            }
+    @classmethod
+    def load(cls, path: str, platforms: Dict[str, List[str]], goals: Dict[str, str],
+             markets: Dict[str, dict]) -> "GEOGuidanceIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data, platforms, goals, markets)
     
-    def get_supported_markets(self) -> Dict[str, Any]:
-        """获取支持的市场列表"""
-        return {
-            "markets": MARKET_CONFIGS,
-            "count": len(MARKET_CONFIGS),
-            "supported_content_types": ["social_media", "marketing_copy", "blog_post", "email_marketing"],
-            "supported_tones": ["professional", "casual", "friendly", "formal"]
-        }
-
-# ==================== GEO优化器 ====================
+    @staticmethod
+    def _validate(data: Dict[str, Any], platforms: Dict[str, List[str]], goals: Dict[str, str]):
+        """数据文件需覆盖全部平台类别和目标，平台名必须在 GEOOptimizer.platforms 中"""
+        def check_tips(tips: Any, where: str):
+            if not isinstance(tips, list) or not tips or not all(isinstance(tip, str) and tip for tip in tips):
+                raise ValueError(f"GEO策略数据 {where}.tips 必须是非空字符串列表")
+        
+        fallback = data.get("fallback")
+        if not isinstance(fallback, dict) or not isinstance(fallback.get("strategy"), str):
+            raise ValueError("GEO策略数据缺少 fallback.strategy")
+        check_tips(fallback.get("tips"), "fallback")
+        
+        groups = data.get("groups", {})
+        for group in [*platforms, "general"]:
+            group_data = groups.get(group)
+            if not isinstance(group_data, dict):
+                raise ValueError(f"GEO策略数据缺少平台类别 {group}")
+            strategies = group_data.get("strategies", {})
+            missing = [goal for goal in goals if not isinstance(strategies.get(goal), str) or not strategies[goal]]
+            if missing:
+                raise ValueError(f"GEO策略数据 {group} 缺少目标: {', '.join(missing)}")
+            check_tips(group_data.get("tips"), group)
+            for name, platform_data in group_data.get("platforms", {}).items():
+                if name not in platforms.get(group, []):
+                    raise ValueError(f"GEO策略数据中的平台 {name} 不属于 {group}")
+                if not isinstance(platform_data.get("strategy"), str) or not platform_data["strategy"]:
+                    raise ValueError(f"GEO策略数据 {group}.{name} 缺少 strategy")
+                check_tips(platform_data.get("tips"), f"{group}.{name}")
+        unknown = set(groups) - set(platforms) - {"general"}
+        if unknown:
+            raise ValueError(f"GEO策略数据包含未知平台类别: {', '.join(sorted(unknown))}")
+    
+    def lookup(self, platform: str, goal: str, market: Optional[str] = None) -> GEOGuidance:
+        """平台可以是类别名或具体平台名（不区分大小写），未知平台按通用类别，未知目标使用兜底策略"""
+        key = self._platform_keys.get(platform) or self._platform_keys.get(platform.lower()) or ("general", "")
+        return self._entries[(
+            key[0],
+            key[1],
+            goal if goal in self._goals else "",
+            market if market in self._markets else ""
+        )]
+    
+    def __len__(self) -> int:
+        return len(self._entries)
 
 class GEOOptimizer:
     """GEO优化器"""
     
-    def __init__(self):
+    def __init__(self, settings: Optional[Settings] = None):
+        self.settings = settings or get_settings()
         self.platforms = {
             "social_media": ["Facebook", "Twitter", "LinkedIn", "Instagram", "TikTok"],
             "search_engine": ["Google", "Bing", "Yahoo"],
@@ -360,24 +4237,27 @@ class GEOOptimizer:
             "awareness": "提高品牌知名度和曝光",
             "traffic": "增加网站流量和访问"
         }
+        
+        path = self.settings.geo_strategy_file
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        self.guidance = GEOGuidanceIndex.load(path, self.platforms, self.goals, MARKET_CONFIGS)
+        self.scorer = GEOScorer(self.platforms)
     
     def optimize_content(self, request: GEORequest) -> Dict[str, Any]:
         """优化内容"""
         try:
-            platform = request.platform
-            goal = request.goal
-            
-            # 构建优化策略
-            optimization_strategy = self._build_strategy(platform, goal)
+            guidance = self.guidance.lookup(request.platform, request.goal, request.target_market)
             
             return {
                 "success": True,
                 "original_prompt": request.prompt,
-                "platform": platform,
-                "goal": goal,
-                "strategy": optimization_strategy,
-                "optimized_prompt": self._optimize_prompt(request.prompt, optimization_strategy),
-                "tips": self._get_optimization_tips(platform, goal)
+                "platform": request.platform,
+                "platform_group": guidance.group,
+                "goal": request.goal,
+                "strategy": guidance.strategy,
+                "optimized_prompt": request.prompt + guidance.prompt_suffix,
+                "tips": guidance.tips
             }
         except Exception as e:
             return {
@@ -385,66 +4265,222 @@ class GEOOptimizer:
                 "error": str(e)
             }
     
-    def _build_strategy(self, platform: str, goal: str) -> str:
-        """构建优化策略"""
-        strategies = {
-            "social_media": {
-                "engagement": "使用互动性强的语言，添加话题标签，鼓励用户评论和分享",
-                "conversion": "突出产品价值，添加行动号召，使用紧迫感语言",
-                "awareness": "强调品牌特色，使用视觉元素，讲述品牌故事",
-                "traffic": "提供有价值的内容，添加链接，使用好奇心驱动"
-            },
-            "search_engine": {
-                "engagement": "优化关键词密度，使用长尾关键词，提高内容相关性",
-                "conversion": "优化着陆页，使用转化关键词，提高页面速度",
-                "awareness": "使用品牌关键词，优化标题和描述，提高搜索排名",
-                "traffic": "优化SEO元素，使用热门关键词，提高点击率"
+    def score_content(self, request: GEOScoreRequest) -> Dict[str, Any]:
+        """批量评分候选文本并排序"""
+        try:
+            result = self.scorer.score(
+                request.texts, request.keywords, request.long_tail_keywords,
+                request.platform, request.goal, request.top_k
+            )
+            return {"success": True, **result, "generated_at": datetime.now().isoformat()}
+        except Exception as e:
+            logger.error(f"GEO评分失败: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "generated_at": datetime.now().isoformat()
             }
-        }
+
+# ==================== GEO分析执行 ====================
+
+class OptimizerTimeoutError(Exception):
+    pass
+
+def _score_in_worker(request: GEOScoreRequest) -> Dict[str, Any]:
+    """进程池中执行批量评分；子进程以 spawn 方式导入本模块，使用其中的 geo_optimizer"""
+    return geo_optimizer.score_content(request)
+
+def _warm_up_worker() -> bool:
+    return True
+
+class OptimizerExecutor:
+    """在事件循环之外执行 CPU 密集的 GEO 分析，按请求截止时间等待
+    
+    线程池适合毫秒级的单条优化；大批量评分会长时间占用 GIL，放到进程池中才不拖慢事件循环。
+    超时只放弃等待：尚未开始的任务会被取消，已在执行的任务跑完后结果丢弃。
+    """
+    
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._threads = ThreadPoolExecutor(max_workers=settings.optimizer_threads, thread_name_prefix="geo-optimizer")
+        self._processes: Optional[ProcessPoolExecutor] = None
+    
+    async def start(self):
+        if self.settings.optimizer_processes > 0 and self._processes is None:
+            # spawn 启动的子进程不继承事件循环、连接池和各个执行器线程的状态
+            self._processes = ProcessPoolExecutor(
+                max_workers=self.settings.optimizer_processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            # 提前拉起子进程，避免首个大批量请求承担进程启动和模块导入的耗时
+            for _ in range(self.settings.optimizer_processes):
+                self._processes.submit(_warm_up_worker)
+    
+    async def shutdown(self):
+        self._threads.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
+            self._processes = None
+    
+    def _deadline(self, default: float, timeout_ms: Optional[int]) -> float:
+        if timeout_ms is None:
+            return default
+        return min(default, timeout_ms / 1000)
+    
+    async def _run(self, pool_name: str, executor, timeout: float, func, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        metrics.optimizer_in_flight.inc(pool=pool_name)
+        outcome = "success"
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(executor, func, *args), timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise OptimizerTimeoutError(f"GEO分析超过处理时限 {timeout:.3g} 秒")
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            metrics.optimizer_in_flight.dec(pool=pool_name)
+            metrics.optimizer_tasks.inc(pool=pool_name, outcome=outcome)
+            metrics.optimizer_duration.observe(time.perf_counter() - started, pool=pool_name)
+    
+    async def optimize(self, optimizer: "GEOOptimizer", request: GEORequest) -> Dict[str, Any]:
+        timeout = self._deadline(self.settings.optimizer_timeout, request.timeout_ms)
+        return await self._run("thread", self._threads, timeout, optimizer.optimize_content, request)
+    
+    async def score(self, optimizer: "GEOOptimizer", request: GEOScoreRequest) -> Dict[str, Any]:
+        """小批量在线程池中评分，达到 optimizer_process_min_texts 条时交给进程池"""
+        timeout = self._deadline(self.settings.optimizer_batch_timeout, request.timeout_ms)
+        if self._processes is not None and len(request.texts) >= self.settings.optimizer_process_min_texts:
+            return await self._run("process", self._processes, timeout, _score_in_worker, request)
+        return await self._run("thread", self._threads, timeout, optimizer.score_content, request)
+
+# ==================== JSON响应 ====================
+
+def dumps_json(payload: Any) -> bytes:
+    """序列化为 UTF-8 JSON 字节（中文不转义），优先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """直接序列化为 UTF-8 字节的 JSON 响应，不做 \\u 转义"""
+    
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain")
+
+class CompressionMiddleware:
+    """按 Accept-Encoding 压缩一次性返回的响应；流式响应和已压缩的响应原样透传"""
+    
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        return strategies.get(platform, {}).get(goal, "通用优化策略")
-    
-    def _optimize_prompt(self, prompt: str, strategy: str) -> str:
-        """优化提示词"""
-        return f"{prompt}\n\n优化策略: {strategy}\n\n请根据以上策略优化内容。"
-    
-    def _get_optimization_tips(self, platform: str, goal: str) -> List[str]:
-        """获取优化建议"""
-        tips = {
-            "social_media": [
-                "使用视觉元素增加吸引力",
-                "添加相关话题标签",
-                "鼓励用户互动和分享",
-                "保持内容简洁明了"
-            ],
-            "search_engine": [
-                "优化关键词密度",
-                "使用长尾关键词",
-                "提高内容质量",
-                "优化页面加载速度"
-            ]
-        }
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        encoding = next(
+            (token for token in accepted_encodings(accept_encoding)
+             if token == "gzip" or (token == "br" and brotli is not None)),
+            None
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message = None
         
-        return tips.get(platform, ["通用优化建议"])
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            
+            start, start_message = start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            body = message.get("body", b"")
+            if (message.get("more_body", False) or "content-encoding" in headers
+                    or len(body) < self.minimum_size
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                await send(start)
+                await send(message)
+                return
+            
+            compressed = brotli.compress(body, quality=4) if encoding == "br" else gzip.compress(body, 6)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """解析 Accept-Encoding，按权重从高到低返回可接受的编码"""
+    weighted = []
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if token and quality > 0:
+            weighted.append((quality, token.strip().lower()))
+    weighted.sort(key=lambda item: -item[0])
+    return [token for _, token in weighted]
 
 # ==================== FastAPI应用 ====================
 
+# 初始化服务
+content_generator = OverseasContentGenerator()
+job_queue = create_job_queue(content_generator)
+client_rate_limiter = ClientRateLimiter(content_generator.settings, content_generator.quota_store)
+geo_optimizer = GEOOptimizer()
+optimizer_executor = OptimizerExecutor(content_generator.settings)
+loop_lag_monitor = EventLoopLagMonitor(content_generator.settings.event_loop_lag_interval)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动和关闭长连接池"""
+    await content_generator.startup()
+    await job_queue.start()
+    await optimizer_executor.start()
+    loop_lag_monitor.start()
+    prepare_static_responses()
+    try:
+        yield
+    finally:
+        await loop_lag_monitor.stop()
+        await job_queue.stop()
+        await optimizer_executor.shutdown()
+        await content_generator.shutdown()
+
 app = FastAPI(
     title="🌍 GEO 智能内容中台",
     description="海外运营专用内容生成平台",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
+if content_generator.settings.response_compression:
+    app.add_middleware(CompressionMiddleware, minimum_size=content_generator.settings.compression_minimum_size)
+app.add_middleware(MetricsMiddleware)
 
-# 初始化服务
-content_generator = OverseasContentGenerator()
-geo_optimizer = GEOOptimizer()
-
-# ==================== API路由 ====================
+# ==================== 页面 ====================
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    """主页面"""
-    return """
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -479,10 +4515,7 @@ async def root():
     </html>
     """
 
-@app.get("/overseas", response_class=HTMLResponse)
-async def overseas_page():
-    """海外内容生成页面"""
-    return """
+OVERSEAS_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -574,6 +4607,21 @@ async def overseas_page():
         </div>
         
         <script>
+        const PROVIDER_LABELS = {
+            gemini: '🤖 Gemini内容',
+            claude: '🧠 Claude内容',
+            deepseek: '🔍 DeepSeek优化'
+        };
+        
+        function parseSSE(frame) {
+            const event = { type: 'message', data: '' };
+            for (const line of frame.split('\\n')) {
+                if (line.startsWith('event:')) event.type = line.slice(6).trim();
+                else if (line.startsWith('data:')) event.data += line.slice(5).trim();
+            }
+            return event;
+        }
+        
         async function generateContent() {
             const prompt = document.getElementById('prompt').value;
             const market = document.getElementById('market').value;
@@ -589,10 +4637,37 @@ async def overseas_page():
             resultDiv.style.display = 'block';
             resultDiv.textContent = '正在生成内容...';
             
+            // 各模型结果到达即渲染，无需等待最慢的模型
+            let header = '';
+            let footer = '';
+            const sections = {};
+            const render = () => {
+                let result = header;
+                for (const [provider, text] of Object.entries(sections)) {
+                    result += `${PROVIDER_LABELS[provider] || provider}:\n${text}\n\n`;
+                }
+                resultDiv.textContent = result + footer;
+            };
+            const handleEvent = (event) => {
+                const data = JSON.parse(event.data);
+                if (event.type === 'start') {
+                    header = `⏳ 生成中...\n\n目标市场: ${data.market.name} ${data.market.flag}\n\n`;
+                    for (const provider of data.providers) sections[provider] = '等待中...';
+                } else if (event.type === 'result') {
+                    sections[data.provider] = data.error ? `❌ ${data.error}` : data.content;
+                } else if (event.type === 'done') {
+                    header = header.replace('⏳ 生成中...', '✅ 生成成功！') + `生成时间: ${data.generated_at}\n\n`;
+                    footer = `💡 优化建议:\n${data.optimization_tips.join('\\n')}`;
+                } else if (event.type === 'error') {
+                    header = `❌ 生成失败: ${data.error}\n\n`;
+                }
+                render();
+            };
+            
             try {
-                const response = await fetch('/api/v1/overseas_content/generate', {
+                const response = await fetch('/api/v1/overseas_content/generate/stream', {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
+                    headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
                     body: JSON.stringify({
                         prompt: prompt,
                         target_market: market,
@@ -600,21 +4675,23 @@ async def overseas_page():
                         tone: tone
                     })
                 });
+                if (!response.ok || !response.body) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
                 
-                const data = await response.json();
-                
-                if (data.success) {
-                    let result = `✅ 生成成功！\n\n`;
-                    result += `目标市场: ${data.market.name} ${data.market.flag}\n`;
-                    result += `生成时间: ${data.generated_at}\n\n`;
-                    result += `🤖 Gemini内容:\n${data.content.gemini}\n\n`;
-                    result += `🧠 Claude内容:\n${data.content.claude}\n\n`;
-                    result += `🔍 DeepSeek优化:\n${data.content.deepseek}\n\n`;
-                    result += `💡 优化建议:\n${data.optimization_tips.join('\n')}`;
-                    
-                    resultDiv.textContent = result;
-                } else {
-                    resultDiv.textContent = `❌ 生成失败: ${data.error}`;
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        const frame = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        if (frame.trim()) handleEvent(parseSSE(frame));
+                    }
                 }
             } catch (error) {
                 resultDiv.textContent = `❌ 请求失败: ${error.message}`;
@@ -625,48 +4702,650 @@ async def overseas_page():
     </html>
     """
 
-@app.post("/api/v1/overseas_content/generate")
+# ==================== 静态响应 ====================
+
+class PrecomputedResponse:
+    """启动时序列化并预压缩的静态响应，带强 ETag，条件请求直接返回 304"""
+    
+    def __init__(self, body: bytes, media_type: str, max_age: int = 300):
+        self.media_type = media_type
+        self.cache_control = f"public, max-age={max_age}"
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # 每种编码是不同的表示，各自使用独立的强 ETag
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, 9), f'"{digest}-gz"')
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+    
+    def _negotiate(self, accept_encoding: str) -> str:
+        for encoding in accepted_encodings(accept_encoding):
+            if encoding in self.variants:
+                return encoding
+            if encoding == "*":
+                return "br" if "br" in self.variants else "gzip"
+        return "identity"
+    
+    def respond(self, request: Request) -> Response:
+        encoding = self._negotiate(request.headers.get("accept-encoding", ""))
+        body, etag = self.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or
+                              any(tag.strip() in self.etags for tag in if_none_match.split(","))):
+            return Response(status_code=304, headers=headers)
+        
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+static_responses: Dict[str, PrecomputedResponse] = {}
+
+def prepare_static_responses():
+    """启动时构建所有静态响应"""
+    static_responses["index"] = PrecomputedResponse(INDEX_HTML.encode("utf-8"), "text/html; charset=utf-8")
+    static_responses["overseas"] = PrecomputedResponse(OVERSEAS_HTML.encode("utf-8"), "text/html; charset=utf-8")
+    static_responses["markets"] = PrecomputedResponse(
+        dumps_json(content_generator.get_supported_markets()), "application/json"
+    )
+
+def get_static_response(name: str) -> PrecomputedResponse:
+    if name not in static_responses:
+        prepare_static_responses()
+    return static_responses[name]
+
+# 健康检查只有时间戳会变化，预先序列化其余部分，请求时只拼接时间戳
+_HEALTH_TIMESTAMP = "__timestamp__"
+_HEALTH_PREFIX, _HEALTH_SUFFIX = dumps_json({
+    "status": "healthy",
+    "timestamp": _HEALTH_TIMESTAMP,
+    "version": "1.0.0",
+    "features": [
+        "海外内容生成",
+        "多AI模型集成",
+        "GEO优化功能"
+    ]
+}).split(_HEALTH_TIMESTAMP.encode("utf-8"))
+
+def health_response() -> Response:
+    body = _HEALTH_PREFIX + datetime.now().isoformat().encode("ascii") + _HEALTH_SUFFIX
+    return Response(content=body, media_type="application/json", headers={"Cache-Control": "no-cache"})
+
+# ==================== API路由 ====================
+
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    """主页面"""
+    return get_static_response("index").respond(request)
+
+@app.get("/overseas", response_class=HTMLResponse)
+async def overseas_page(request: Request):
+    """海外内容生成页面"""
+    return get_static_response("overseas").respond(request)
+
+def _too_many_requests(message: str, retry_after: float) -> HTTPException:
+    return HTTPException(status_code=429, detail=message, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+async def enforce_client_rate_limit(request: Request):
+    """按调用方限流，并记录调用方供服务商配额公平排队"""
+    caller = client_identity(request, content_generator.settings)
+    current_caller.set(caller)
+    retry_after = await client_rate_limiter.check(caller)
+    if retry_after > 0:
+        metrics.rate_limited.inc(scope="client")
+        raise _too_many_requests("请求过于频繁，请稍后重试", retry_after)
+
+async def enforce_provider_backpressure(request: Request):
+    """服务商配额排队已满时直接拒绝新的生成请求"""
+    await enforce_client_rate_limit(request)
+    retry_after = content_generator.saturation_retry_after()
+    if retry_after is not None:
+        metrics.rate_limited.inc(scope="ingress")
+        raise _too_many_requests("AI服务商配额繁忙，请稍后重试", retry_after)
+
+@app.post("/api/v1/overseas_content/generate", dependencies=[Depends(enforce_provider_backpressure)])
 async def generate_overseas_content(request: ContentRequest):
     """生成海外内容"""
     result = await content_generator.generate_content(request)
-    return JSONResponse(content=result)
+    return FastJSONResponse(content=result)
+
+def _sse_event(event: Dict[str, Any]) -> bytes:
+    """编码为 Server-Sent Events 帧"""
+    return b"event: " + event["event"].encode("ascii") + b"\ndata: " + dumps_json(event) + b"\n\n"
+
+@app.post("/api/v1/overseas_content/generate/stream", dependencies=[Depends(enforce_provider_backpressure)])
+async def generate_overseas_content_stream(request: ContentRequest):
+    """流式生成海外内容（SSE），每个模型完成即推送"""
+    async def event_stream():
+        async for event in content_generator.generate_content_stream(request):
+            yield _sse_event(event)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/v1/overseas_content/generate/markets", dependencies=[Depends(enforce_provider_backpressure)])
+async def generate_overseas_content_markets(request: MultiMarketContentRequest):
+    """一次调用为多个市场生成海外内容，按市场拆分返回"""
+    result = await content_generator.generate_multi_market(request)
+    return FastJSONResponse(content=result)
+
+@app.post("/api/v1/overseas_content/batch", dependencies=[Depends(enforce_provider_backpressure)])
+async def generate_overseas_content_batch(request: BatchContentRequest):
+    """批量生成海外内容（多提示 × 多市场）"""
+    max_jobs = content_generator.settings.batch_max_jobs
+    if len(request.jobs) > max_jobs:
+        raise HTTPException(status_code=400, detail=f"单批最多支持 {max_jobs} 个任务")
+    
+    if request.stream:
+        async def ndjson_stream():
+            async for item in content_generator.iter_batch(request.jobs, request.concurrency):
+                yield dumps_json(item) + b"\n"
+        return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+    
+    result = await content_generator.generate_batch(request.jobs, request.concurrency)
+    return FastJSONResponse(content=result)
+
+@app.post("/api/v1/overseas_content/jobs", status_code=202, dependencies=[Depends(enforce_client_rate_limit)])
+async def submit_generation_job(request: ContentJobRequest):
+    """提交异步生成任务，立即返回任务ID"""
+    try:
+        job = await job_queue.submit(request)
+    except WebhookURLError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return FastJSONResponse(content=job, status_code=202)
+
+@app.get("/api/v1/overseas_content/jobs/{job_id}")
+async def get_generation_job(job_id: str):
+    """查询异步生成任务的状态和结果"""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return FastJSONResponse(content=job)
+
+@app.delete("/api/v1/overseas_content/jobs/{job_id}")
+async def cancel_generation_job(job_id: str):
+    """取消排队中或执行中的异步生成任务"""
+    job = await job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return FastJSONResponse(content=job)
+
+def _history_cursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    if not cursor.isdigit():
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    return int(cursor)
+
+def _history_page_size(limit: Optional[int]) -> int:
+    settings = content_generator.settings
+    if limit is None:
+        return settings.history_page_size
+    if not 1 <= limit <= settings.history_max_page_size:
+        raise HTTPException(status_code=400, detail=f"每页条数需在 1 到 {settings.history_max_page_size} 之间")
+    return limit
+
+def _history_store() -> GenerationHistory:
+    if content_generator.history is None:
+        raise HTTPException(status_code=404, detail="未开启生成历史")
+    return content_generator.history
+
+@app.get("/api/v1/overseas_content/history")
+async def list_generation_history(market: Optional[str] = None, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """按时间倒序列出生成历史，next_cursor 用于获取下一页"""
+    history = _history_store()
+    market_code = resolve_market_code(market) if market else None
+    result = await history.recent(market_code, _history_cursor(cursor), _history_page_size(limit))
+    return FastJSONResponse(content=result)
+
+@app.get("/api/v1/overseas_content/history/search")
+async def search_generation_history(q: str, market: Optional[str] = None, cursor: Optional[str] = None,
+                                    limit: Optional[int] = None):
+    """全文检索生成历史（提示词和生成内容），按时间倒序分页"""
+    history = _history_store()
+    if not q.split():
+        raise HTTPException(status_code=400, detail="搜索词不能为空")
+    market_code = resolve_market_code(market) if market else None
+    try:
+        result = await history.search(q, market_code, _history_cursor(cursor), _history_page_size(limit))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(content=result)
+
+@app.get("/api/v1/overseas_content/history/{generation_id}")
+async def get_generation_history(generation_id: int):
+    """查询一条生成历史"""
+    record = await _history_store().get(generation_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="生成历史不存在")
+    return FastJSONResponse(content=record)
 
 @app.get("/api/v1/overseas_content/markets")
-async def get_supported_markets():
+async def get_supported_markets(request: Request):
     """获取支持的市场列表"""
-    return JSONResponse(content=content_generator.get_supported_markets())
+    return get_static_response("markets").respond(request)
 
-@app.post("/api/v1/geo_optimize")
+@app.post("/api/v1/geo_optimize", dependencies=[Depends(enforce_client_rate_limit)])
 async def optimize_content(request: GEORequest):
     """GEO优化内容"""
-    result = geo_optimizer.optimize_content(request)
-    return JSONResponse(content=result)
+    try:
+        result = await optimizer_executor.optimize(geo_optimizer, request)
+    except OptimizerTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return FastJSONResponse(content=result)
+
+@app.post("/api/v1/geo_optimize/score", dependencies=[Depends(enforce_client_rate_limit)])
+async def score_content(request: GEOScoreRequest):
+    """批量GEO评分，按得分从高到低返回"""
+    settings = content_generator.settings
+    if len(request.texts) > settings.geo_score_max_texts:
+        raise HTTPException(status_code=400, detail=f"单批最多支持 {settings.geo_score_max_texts} 条文本")
+    if len(request.keywords) + len(request.long_tail_keywords or []) > settings.geo_score_max_keywords:
+        raise HTTPException(status_code=400, detail=f"关键词最多支持 {settings.geo_score_max_keywords} 个")
+    try:
+        result = await optimizer_executor.score(geo_optimizer, request)
+    except OptimizerTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return FastJSONResponse(content=result)
+
+@app.get("/api/v1/cache/stats")
+async def cache_stats():
+    """响应缓存命中、请求合并和近似重复复用统计"""
+    single_flight = content_generator.single_flight.stats()
+    near_duplicates = content_generator.near_duplicates
+    near_duplicate_stats = near_duplicates.stats() if near_duplicates is not None else {"enabled": False}
+    if content_generator.cache is None:
+        return FastJSONResponse(content={"enabled": False, "single_flight": single_flight, "near_duplicates": near_duplicate_stats})
+    return FastJSONResponse(content={
+        "enabled": True,
+        **await content_generator.cache.stats(),
+        "single_flight": single_flight,
+        "near_duplicates": near_duplicate_stats
+    })
+
+@app.get("/api/v1/providers/status")
+async def provider_status():
+    """各AI服务商的熔断状态"""
+    return FastJSONResponse(content=content_generator.provider_status())
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus 指标"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/api/v1/health")
 async def health_check():
     """健康检查"""
-    return JSONResponse(content={
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
-        "version": "1.0.0",
-        "features": [
-            "海外内容生成",
-            "多AI模型集成",
-            "GEO优化功能"
-        ]
-    })
+    return health_response()
+
+# ==================== MCP服务 ====================
+
+# 支持的 MCP 协议版本，第一个为默认版本
+MCP_PROTOCOL_VERSIONS = ("2025-06-18", "2025-03-26", "2024-11-05")
+JSONRPC_PARSE_ERROR = -32700
+JSONRPC_INVALID_REQUEST = -32600
+JSONRPC_METHOD_NOT_FOUND = -32601
+JSONRPC_INVALID_PARAMS = -32602
+JSONRPC_INTERNAL_ERROR = -32603
+
+class MCPError(Exception):
+    """以 JSON-RPC 错误响应返回的协议错误"""
+    
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+def valid_jsonrpc_id(value: Any) -> bool:
+    """请求 id 只能是字符串、整数或 null；布尔值是 int 的子类，但不是合法的 id"""
+    return value is None or (isinstance(value, (str, int)) and not isinstance(value, bool))
+
+def jsonrpc_error(request_id: Any, code: int, message: str) -> Dict[str, Any]:
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+# 工具调用的进度回调：(已完成数, 总数, 说明)
+ProgressCallback = Callable[[int, int, str], None]
+
+@dataclass(frozen=True)
+class MCPTool:
+    name: str
+    description: str
+    input_schema: Dict[str, Any]
+    handler: Callable[[Dict[str, Any], Optional[ProgressCallback]], Awaitable[Dict[str, Any]]]
+    
+    def describe(self) -> Dict[str, Any]:
+        return {"name": self.name, "description": self.description, "inputSchema": self.input_schema}
+
+def _tool_schema(model: type, exclude: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    """由请求模型生成工具的输入 JSON Schema，去掉与工具调用无关的字段"""
+    schema = model.model_json_schema()
+    for name in exclude:
+        schema["properties"].pop(name, None)
+    return schema
+
+class MCPServer:
+    """MCP（Model Context Protocol）服务：JSON-RPC 2.0，工具直接调用进程内的生成器和优化器
+    
+    stdio 和 HTTP 两种传输共用 handle：每个请求独立执行，并发的工具调用互不等待，
+    响应按完成顺序发出；带 progressToken 的 generate_content 每个模型完成时推送一次进度通知。
+    """
+    
+    def __init__(self, generator: OverseasContentGenerator, optimizer: GEOOptimizer, executor: OptimizerExecutor):
+        self.generator = generator
+        self.optimizer = optimizer
+        self.executor = executor
+        self.tools = {tool.name: tool for tool in [
+            MCPTool(
+                "generate_content",
+                "为目标海外市场生成内容，多个AI模型并行生成（mode=race 时返回最先完成的模型）",
+                _tool_schema(ContentRequest, exclude=("stream_deltas",)),
+                self._generate_content
+            ),
+            MCPTool(
+                "get_supported_markets",
+                "获取支持的海外市场及其文化特点、内容偏好和优化建议",
+                {"type": "object", "properties": {}},
+                self._get_supported_markets
+            ),
+            MCPTool(
+                "geo_optimize",
+                "按目标平台、优化目标和市场给出GEO优化策略和建议",
+                _tool_schema(GEORequest),
+                self._geo_optimize
+            )
+        ]}
+        self._in_flight: Dict[Any, asyncio.Task] = {}
+        self._cancelled: Set[Any] = set()
+    
+    async def _generate_content(self, arguments: Dict[str, Any], progress: Optional[ProgressCallback]) -> Dict[str, Any]:
+        request = ContentRequest.model_validate(arguments)
+        if progress is None:
+            return await self.generator.generate_content(request)
+        total = len(self.generator.providers)
+        finished = 0
+        
+        def on_provider(provider: str, outcome: str):
+            nonlocal finished
+            finished += 1
+            progress(finished, total, f"{provider}: {outcome}")
+        
+        token = provider_progress.set(on_provider)
+        try:
+            result = await self.generator.generate_content(request)
+        finally:
+            provider_progress.reset(token)
+        if finished < total:
+            # 合并到其他请求（进度回调在发起方的上下文中）、复用近似重复结果或提前失败时没有逐模型进度，
+            # 补一条完成通知，进度总能到达 total
+            if "reused" in result:
+                reason = "reused"
+            elif result.get("coalesced"):
+                reason = "coalesced"
+            else:
+                reason = "completed" if result.get("success") else "failed"
+            progress(total, total, reason)
+        return result
+    
+    async def _get_supported_markets(self, arguments: Dict[str, Any], progress: Optional[ProgressCallback]) -> Dict[str, Any]:
+        return self.generator.get_supported_markets()
+    
+    async def _geo_optimize(self, arguments: Dict[str, Any], progress: Optional[ProgressCallback]) -> Dict[str, Any]:
+        request = GEORequest.model_validate(arguments)
+        try:
+            return await self.executor.optimize(self.optimizer, request)
+        except OptimizerTimeoutError as e:
+            return {"success": False, "error": str(e), "generated_at": datetime.now().isoformat()}
+    
+    @staticmethod
+    def has_requests(message: Any) -> bool:
+        """消息（或批量消息）中是否有需要响应的请求"""
+        messages = message if isinstance(message, list) else [message]
+        return any(isinstance(item, dict) and "id" in item and "method" in item for item in messages)
+    
+    async def handle(self, message: Any, notify: Callable[[Dict[str, Any]], None]) -> Any:
+        """处理一条消息或一批消息，返回响应；通知和被取消的请求没有响应，返回 None"""
+        if isinstance(message, list):
+            if not message:
+                return jsonrpc_error(None, JSONRPC_INVALID_REQUEST, "空的批量请求")
+            responses = await asyncio.gather(*(self.handle(item, notify) for item in message))
+            return [response for response in responses if response is not None] or None
+        if not isinstance(message, dict) or message.get("jsonrpc") != "2.0" or not isinstance(message.get("method"), str):
+            if isinstance(message, dict) and "method" not in message and ("result" in message or "error" in message):
+                # 客户端对服务端请求的响应，本服务不发起请求，忽略
+                return None
+            request_id = message.get("id") if isinstance(message, dict) else None
+            return jsonrpc_error(request_id, JSONRPC_INVALID_REQUEST, "无效的 JSON-RPC 请求")
+        
+        method = message["method"]
+        params = message.get("params")
+        if params is None:
+            params = {}
+        if "id" not in message:
+            # 通知没有响应，格式不对时直接忽略
+            if isinstance(params, dict):
+                self._notification(method, params)
+            return None
+        
+        request_id = message["id"]
+        if not valid_jsonrpc_id(request_id):
+            return jsonrpc_error(None, JSONRPC_INVALID_REQUEST, "请求 id 必须是字符串、整数或 null")
+        if not isinstance(params, dict):
+            return jsonrpc_error(request_id, JSONRPC_INVALID_PARAMS, "params 必须是对象")
+        if request_id in self._in_flight:
+            return jsonrpc_error(request_id, JSONRPC_INVALID_REQUEST, f"请求 id {request_id} 仍在处理中")
+        task = asyncio.ensure_future(self._dispatch(method, params, notify))
+        self._in_flight[request_id] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if request_id in self._cancelled:
+                # 客户端已取消的请求不再响应
+                return None
+            raise
+        except MCPError as e:
+            return jsonrpc_error(request_id, e.code, e.message)
+        except Exception as e:
+            logger.error(f"MCP 请求 {method} 处理失败: {e}")
+            return jsonrpc_error(request_id, JSONRPC_INTERNAL_ERROR, str(e))
+        finally:
+            self._in_flight.pop(request_id, None)
+            self._cancelled.discard(request_id)
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+    
+    def _notification(self, method: str, params: Dict[str, Any]):
+        if method == "notifications/cancelled":
+            request_id = params.get("requestId")
+            if not valid_jsonrpc_id(request_id):
+                return
+            task = self._in_flight.get(request_id)
+            if task is not None and not task.done():
+                self._cancelled.add(request_id)
+                task.cancel()
+    
+    async def _dispatch(self, method: str, params: Dict[str, Any], notify: Callable[[Dict[str, Any]], None]) -> Any:
+        if method == "initialize":
+            requested = params.get("protocolVersion")
+            return {
+                "protocolVersion": requested if requested in MCP_PROTOCOL_VERSIONS else MCP_PROTOCOL_VERSIONS[0],
+                "capabilities": {"tools": {"listChanged": False}},
+                "serverInfo": {"name": "geo-content-platform", "version": app.version},
+                "instructions": "海外内容生成与GEO优化：先用 get_supported_markets 查看市场，再调用 generate_content 或 geo_optimize"
+            }
+        if method == "ping":
+            return {}
+        if method == "tools/list":
+            return {"tools": [tool.describe() for tool in self.tools.values()]}
+        if method == "tools/call":
+            return await self._call_tool(params, notify)
+        raise MCPError(JSONRPC_METHOD_NOT_FOUND, f"不支持的方法: {method}")
+    
+    async def _call_tool(self, params: Dict[str, Any], notify: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+        name = params.get("name")
+        tool = self.tools.get(name) if isinstance(name, str) else None
+        if tool is None:
+            raise MCPError(JSONRPC_INVALID_PARAMS, f"未知的工具: {name}")
+        arguments = params.get("arguments") or {}
+        if not isinstance(arguments, dict):
+            raise MCPError(JSONRPC_INVALID_PARAMS, "arguments 必须是对象")
+        meta = params.get("_meta") or {}
+        if not isinstance(meta, dict):
+            raise MCPError(JSONRPC_INVALID_PARAMS, "_meta 必须是对象")
+        
+        progress: Optional[ProgressCallback] = None
+        progress_token = meta.get("progressToken")
+        if progress_token is not None:
+            def send_progress(done: int, total: int, text: str):
+                notify({
+                    "jsonrpc": "2.0",
+                    "method": "notifications/progress",
+                    "params": {"progressToken": progress_token, "progress": done, "total": total, "message": text}
+                })
+            
+            progress = send_progress
+        
+        try:
+            payload = await tool.handler(arguments, progress)
+        except ValidationError as e:
+            # 参数错误作为工具结果返回，调用方模型可以据此修正参数
+            return {"content": [{"type": "text", "text": f"参数错误: {e}"}], "isError": True}
+        return {
+            "content": [{"type": "text", "text": dumps_json(payload).decode("utf-8")}],
+            "structuredContent": payload,
+            "isError": payload.get("success") is False
+        }
+    
+    async def serve_stdio(self, reader, writer):
+        """stdio 传输：逐行读取 JSON-RPC 消息，每条消息独立处理，响应和通知逐行写出"""
+        loop = asyncio.get_running_loop()
+        
+        def send(message: Any):
+            writer.write(dumps_json(message) + b"\n")
+            writer.flush()
+        
+        async def process(line: bytes):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                send(jsonrpc_error(None, JSONRPC_PARSE_ERROR, "JSON 解析失败"))
+                return
+            response = await self.handle(message, send)
+            if response is not None:
+                send(response)
+        
+        tasks: Set[asyncio.Task] = set()
+        while True:
+            # 标准输入在线程中阻塞读取，不依赖平台的管道异步支持
+            line = await loop.run_in_executor(None, reader.readline)
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.ensure_future(process(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+mcp_server = MCPServer(content_generator, geo_optimizer, optimizer_executor)
+
+@app.post("/mcp", dependencies=[Depends(enforce_client_rate_limit)])
+async def mcp_endpoint(request: Request):
+    """MCP Streamable HTTP 传输：客户端接受 SSE 时以事件流返回进度通知和最终响应，否则直接返回 JSON"""
+    try:
+        message = json.loads(await request.body())
+    except ValueError:
+        return FastJSONResponse(status_code=400, content=jsonrpc_error(None, JSONRPC_PARSE_ERROR, "JSON 解析失败"))
+    if not MCPServer.has_requests(message):
+        await mcp_server.handle(message, lambda notification: None)
+        return Response(status_code=202)
+    
+    if "text/event-stream" not in request.headers.get("accept", ""):
+        response = await mcp_server.handle(message, lambda notification: None)
+        return FastJSONResponse(content=response) if response is not None else Response(status_code=202)
+    
+    events: asyncio.Queue = asyncio.Queue()
+    
+    async def run():
+        try:
+            response = await mcp_server.handle(message, events.put_nowait)
+            if response is not None:
+                events.put_nowait(response)
+        finally:
+            events.put_nowait(None)
+    
+    async def event_stream():
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                item = await events.get()
+                if item is None:
+                    break
+                yield b"event: message\ndata: " + dumps_json(item) + b"\n\n"
+        finally:
+            # 客户端断开时取消尚未完成的调用
+            if not task.done():
+                task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def serve_mcp_stdio():
+    """以 stdio 传输运行 MCP 服务；标准输出只写协议消息，日志写到标准错误"""
+    await content_generator.startup()
+    await optimizer_executor.start()
+    try:
+        await mcp_server.serve_stdio(sys.stdin.buffer, sys.stdout.buffer)
+    finally:
+        await optimizer_executor.shutdown()
+        await content_generator.shutdown()
 
 # ==================== 主程序 ====================
 
-if __name__ == "__main__":
-    print("🌍 启动 GEO 智能内容中台...")
-    print("📡 服务地址: http://localhost:8000")
-    print("📚 API文档: http://localhost:8000/docs")
-    print("🌍 海外内容生成: http://localhost:8000/overseas")
+def _installed(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def run_server(settings: Settings):
+    """开发模式单进程热重载；生产模式按 workers 启动多进程，优先使用 uvloop 和 httptools"""
+    # 只有直接启动时才需要 uvicorn，不拖慢被导入时的冷启动
+    import uvicorn
     
+    reload = settings.debug and settings.workers == 1
     uvicorn.run(
         "geo_content_platform:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
+        host=settings.host,
+        port=settings.port,
+        reload=reload,
+        workers=None if reload else settings.workers,
+        loop="uvloop" if _installed("uvloop") else "asyncio",
+        http="httptools" if _installed("httptools") else "h11",
+        timeout_keep_alive=settings.keep_alive_timeout,
+        access_log=settings.debug
     )
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["mcp"]:
+        # MCP stdio 模式：标准输出只用于协议消息，不打印启动信息
+        asyncio.run(serve_mcp_stdio())
+        sys.exit(0)
+    
+    settings = content_generator.settings
+    print("🌍 启动 GEO 智能内容中台...")
+    print(f"📡 服务地址: http://localhost:{settings.port}")
+    print(f"📚 API文档: http://localhost:{settings.port}/docs")
+    print(f"🌍 海外内容生成: http://localhost:{settings.port}/overseas")
+    print(f"⚙️ 运行模式: {'开发（热重载）' if settings.debug and settings.workers == 1 else f'生产（{settings.workers} 个进程）'}")
+    
+    run_server(settings)
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import pytest
+
+from geo_content_platform import GenerationHistory, text_bigrams
+
+
+def _entry(i, market="USA", prompt=None):
+    return {
+        "created_at": time.time(),
+        "market": market,
+        "content_type": "social_media",
+        "tone": "professional",
+        "length": "medium",
+        "mode": "all",
+        "prompt": prompt or f"wireless earbuds prompt {i}",
+        "content": {"gemini": f"content {i}"},
+        "errors": {},
+        "durations": {"gemini": 0.1},
+        "tokens": {},
+    }
+
+
+async def _flush(history, count):
+    for _ in range(200):
+        if history.stats()["written"] >= count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("history writes did not finish")
+
+
+@pytest.fixture
+async def history(tmp_path):
+    history = GenerationHistory(str(tmp_path / "history.db"), queue_size=1000, batch_size=7, read_threads=1)
+    assert await history.start()
+    yield history
+    await history.close()
+
+
+async def _collect(fetch):
+    pages = []
+    cursor = None
+    while True:
+        page = await fetch(cursor)
+        pages.append(page)
+        if page["next_cursor"] is None:
+            return pages
+        cursor = int(page["next_cursor"])
+
+
+async def test_keyset_pages_cover_all_records_newest_first(history):
+    for i in range(25):
+        history.record(_entry(i, market="USA" if i % 2 else "Japan"))
+    await _flush(history, 25)
+
+    pages = await _collect(lambda cursor: history.recent(before=cursor, limit=10))
+    assert [page["count"] for page in pages] == [10, 10, 5]
+    ids = [item["id"] for page in pages for item in page["items"]]
+    assert ids == sorted(ids, reverse=True)
+    assert len(set(ids)) == 25
+    assert pages[0]["next_cursor"] == str(pages[0]["items"][-1]["id"])
+
+
+async def test_cursor_is_stable_when_new_records_arrive(history):
+    for i in range(10):
+        history.record(_entry(i))
+    await _flush(history, 10)
+    first = await history.recent(limit=5)
+
+    for i in range(10, 15):
+        history.record(_entry(i))
+    await _flush(history, 15)
+    second = await history.recent(before=int(first["next_cursor"]), limit=5)
+    assert [item["id"] for item in second["items"]] == [item["id"] - 5 for item in first["items"]]
+
+
+async def test_market_filter(history):
+    for i in range(12):
+        history.record(_entry(i, market="USA" if i % 3 == 0 else "Japan"))
+    await _flush(history, 12)
+    pages = await _collect(lambda cursor: history.recent(market="USA", before=cursor, limit=3))
+    items = [item for page in pages for item in page["items"]]
+    assert len(items) == 4
+    assert {item["market"] for item in items} == {"USA"}
+
+
+async def test_search_pages_with_short_and_long_terms(history):
+    for i in range(20):
+        prompt = f"为跑步爱好者写无线耳机文案 {i}" if i % 2 else f"智能手表 product copy {i}"
+        history.record(_entry(i, prompt=prompt))
+    await _flush(history, 20)
+
+    # 两个字的词走二字索引，三个字及以上走 trigram 索引
+    for query, expected in [("耳机", 10), ("手表", 10), ("product", 10), ("跑步 耳机", 10), ("耳机 手表", 0)]:
+        pages = await _collect(lambda cursor: history.search(query, before=cursor, limit=4))
+        ids = [item["id"] for page in pages for item in page["items"]]
+        assert len(ids) == expected, query
+        assert ids == sorted(ids, reverse=True)
+
+
+async def test_single_character_terms_rejected(history):
+    with pytest.raises(ValueError):
+        await history.search("耳")
+    with pytest.raises(ValueError):
+        await history.search("C#")
+
+
+async def test_get(history):
+    history.record(_entry(0))
+    await _flush(history, 1)
+    record_id = (await history.recent(limit=1))["items"][0]["id"]
+    assert (await history.get(record_id))["content"] == {"gemini": "content 0"}
+    assert await history.get(record_id + 1) is None
+
+
+def test_text_bigrams():
+    assert text_bigrams("无线耳机, AI!") == {"无线", "线耳", "耳机", "ai"}
+    assert text_bigrams("a b") == set()
@@ -0,0 +1,119 @@
+import pytest
+
+from geo_content_platform import (
+    FINGERPRINT_BITS,
+    NearDuplicateIndex,
+    Settings,
+    create_near_duplicate_index,
+    hamming_distance,
+    simhash,
+)
+
+PROMPT = (
+    "Write a short product description for wireless earbuds aimed at runners, "
+    "highlighting comfort, battery life and price"
+)
+
+
+def test_hamming_distance():
+    assert hamming_distance(0, 0) == 0
+    assert hamming_distance(0b1011, 0b0001) == 2
+    assert hamming_distance(0, (1 << FINGERPRINT_BITS) - 1) == FINGERPRINT_BITS
+
+
+def test_simhash_ignores_case_whitespace_and_punctuation():
+    assert simhash(PROMPT, 3) == simhash("  " + PROMPT.upper().replace(",", "") + "!!", 3)
+
+
+def test_simhash_fits_in_64_bits():
+    assert 0 <= simhash(PROMPT, 3) < 1 << FINGERPRINT_BITS
+    assert 0 <= simhash("", 3) < 1 << FINGERPRINT_BITS
+
+
+def test_small_edit_within_default_threshold():
+    index = create_near_duplicate_index(Settings(_env_file=None))
+    distance = hamming_distance(simhash(PROMPT, 3), simhash(PROMPT + " please", 3))
+    assert distance <= index.max_distance
+
+
+def test_shingles_keep_word_order():
+    reordered = " ".join(reversed(PROMPT.split()))
+    index = create_near_duplicate_index(Settings(_env_file=None))
+    assert simhash(PROMPT, 1) == simhash(reordered, 1)
+    assert hamming_distance(simhash(PROMPT, 3), simhash(reordered, 3)) > index.max_distance
+
+
+@pytest.mark.parametrize("threshold, max_distance", [(1.0, 0), (0.90625, 6), (0.875, 8), (0.75, 16)])
+def test_threshold_to_max_distance(threshold, max_distance):
+    settings = Settings(_env_file=None, near_duplicate_threshold=threshold)
+    assert create_near_duplicate_index(settings).max_distance == max_distance
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.3, 1.5])
+def test_invalid_threshold_rejected(threshold):
+    with pytest.raises(ValueError):
+        create_near_duplicate_index(Settings(_env_file=None, near_duplicate_threshold=threshold))
+
+
+def test_disabled_index():
+    assert create_near_duplicate_index(Settings(_env_file=None, near_duplicate_enabled=False)) is None
+
+
+def _index(tmp_path, max_distance=6):
+    return NearDuplicateIndex(str(tmp_path / "near.db"), max_entries=10, max_distance=max_distance, shingle_size=3)
+
+
+def _flip(fingerprint, bits):
+    for bit in bits:
+        fingerprint ^= 1 << bit
+    return fingerprint
+
+
+async def test_find_respects_max_distance(tmp_path):
+    index = _index(tmp_path)
+    base = simhash(PROMPT, 3)
+    # 翻转的位分散在各段中，验证分段索引仍能找到候选
+    index.add("USA|social_media", PROMPT, base, {"gemini": "text"})
+    assert index.find("USA|social_media", _flip(base, [0, 10, 20, 30, 40, 63])).distance == 6
+    assert index.find("USA|social_media", _flip(base, [0, 10, 20, 30, 40, 50, 63])) is None
+    assert index.find("Japan|social_media", base) is None
+    await index.close()
+
+
+async def test_find_returns_closest_entry(tmp_path):
+    index = _index(tmp_path)
+    base = simhash(PROMPT, 3)
+    far = index.add("p", "far", _flip(base, [1, 2, 3]), {})
+    near = index.add("p", "near", _flip(base, [1]), {})
+    match = index.find("p", base)
+    assert match.entry is near and match.entry is not far
+    assert match.similarity == 1 - 1 / FINGERPRINT_BITS
+    await index.close()
+
+
+async def test_lru_eviction_and_reload(tmp_path):
+    index = _index(tmp_path)
+    await index.start()
+    fingerprints = [simhash(f"prompt number {i} about earbuds", 3) for i in range(12)]
+    for i, fingerprint in enumerate(fingerprints):
+        index.add("p", f"prompt {i}", fingerprint, {"gemini": str(i)})
+    assert index.stats()["entries"] == 10
+    await index.close()
+
+    reloaded = _index(tmp_path)
+    await reloaded.start()
+    assert reloaded.stats()["entries"] == 10
+    assert reloaded.find("p", fingerprints[-1]).entry.content == {"gemini": "11"}
+    await reloaded.close()
+
+
+async def test_shingle_size_change_clears_stored_fingerprints(tmp_path):
+    index = _index(tmp_path)
+    await index.start()
+    index.add("p", PROMPT, simhash(PROMPT, 3), {})
+    await index.close()
+
+    other = NearDuplicateIndex(str(tmp_path / "near.db"), max_entries=10, max_distance=6, shingle_size=2)
+    await other.start()
+    assert other.stats()["entries"] == 0
+    await other.close()
@@ -0,0 +1,61 @@
+import json
+
+from geo_content_platform import SSEParser
+
+
+def feed_all(chunks):
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+
+def test_single_event():
+    assert feed_all([b"data: hello\n\n"]) == [("message", "hello")]
+
+
+def test_utf8_character_split_across_chunks():
+    """多字节字符在块边界截断时不能产生替换字符"""
+    raw = "data: 无线耳机\n\n".encode("utf-8")
+    split = raw.index("线".encode("utf-8")) + 1
+    assert feed_all([raw[:split], raw[split:]]) == [("message", "无线耳机")]
+
+
+def test_every_byte_as_its_own_chunk():
+    payload = {"text": "こんにちは 🌍", "n": 1}
+    raw = f"event: delta\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+    events = feed_all([raw[i:i + 1] for i in range(len(raw))])
+    assert len(events) == 1
+    name, data = events[0]
+    assert name == "delta"
+    assert json.loads(data) == payload
+
+
+def test_json_frame_split_across_chunks():
+    frame = json.dumps({"candidates": [{"content": {"parts": [{"text": "Hello"}]}}]})
+    raw = f"data: {frame}\n\ndata: [DONE]\n\n".encode("utf-8")
+    middle = len(raw) // 3
+    events = feed_all([raw[:middle], raw[middle:middle * 2], raw[middle * 2:]])
+    assert [json.loads(events[0][1]), events[1][1]] == [json.loads(frame), "[DONE]"]
+
+
+def test_event_names_reset_between_events():
+    raw = b"event: message_start\ndata: {}\n\ndata: plain\n\n"
+    assert feed_all([raw]) == [("message_start", "{}"), ("message", "plain")]
+
+
+def test_multiline_data_crlf_and_comments():
+    raw = b": keep-alive\r\ndata: first\r\ndata: second\r\n\r\n"
+    assert feed_all([raw]) == [("message", "first\nsecond")]
+
+
+def test_close_flushes_event_without_trailing_blank_line():
+    parser = SSEParser()
+    assert parser.feed(b"data: tail") == []
+    assert parser.close() == [("message", "tail")]
+
+
+def test_events_without_data_are_dropped():
+    assert feed_all([b"event: ping\n\n"]) == []
@@ -0,0 +1,87 @@
+import pytest
+
+import geo_content_platform
+from geo_content_platform import (
+    LocalQuotaStore,
+    ProviderRateLimiter,
+    Settings,
+    TokenBucket,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(geo_content_platform.time, "monotonic", clock)
+    return clock
+
+
+def test_starts_full_and_refills_at_rate(clock):
+    bucket = TokenBucket(rate=2.0, capacity=10.0)
+    assert bucket.delay(10) == 0
+    bucket.consume(10)
+    assert bucket.delay(4) == pytest.approx(2.0)
+    clock.now += 1.5
+    assert bucket.delay(4) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.delay(4) == 0
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(rate=5.0, capacity=10.0)
+    bucket.consume(3)
+    clock.now += 3600
+    bucket.consume(10)
+    assert bucket.tokens == pytest.approx(0.0)
+
+
+def test_request_above_capacity_waits_for_full_bucket_and_leaves_debt(clock):
+    bucket = TokenBucket(rate=1.0, capacity=5.0)
+    assert bucket.delay(8) == 0
+    bucket.consume(8)
+    assert bucket.tokens == pytest.approx(-3.0)
+    assert bucket.delay(1) == pytest.approx(4.0)
+
+
+def test_drain_blocks_for_given_seconds(clock):
+    bucket = TokenBucket(rate=2.0, capacity=10.0)
+    bucket.drain(3)
+    assert bucket.delay(1) == pytest.approx(3.5)
+
+
+async def test_local_store_takes_all_buckets_or_none(clock):
+    store = LocalQuotaStore(max_keys=10)
+    limits = [("rpm", 1, 1.0, 2.0), ("tpm", 10, 10.0, 100.0)]
+    assert await store.take(limits) == 0
+    assert await store.take(limits) == 0
+    # rpm 桶已空：整次申请被拒绝，tpm 桶不扣减
+    assert await store.take(limits) == pytest.approx(1.0)
+    assert store._buckets["tpm"].tokens == pytest.approx(80.0)
+    clock.now += 1
+    assert await store.take(limits) == 0
+
+
+async def test_provider_limiter_skips_disabled_buckets(clock):
+    store = LocalQuotaStore(max_keys=10)
+    limiter = ProviderRateLimiter(
+        "demo", rpm=0, tpm=600, settings=Settings(), store=store
+    )
+    assert [key for key, *_ in limiter._limits(5)] == ["provider:demo:tokens"]
+    await limiter.acquire(5)
+    await limiter.pause(2)
+    assert limiter.retry_after() > 0
+
+    unlimited = ProviderRateLimiter(
+        "open", rpm=0, tpm=0, settings=Settings(), store=store
+    )
+    await unlimited.acquire(10_000)
+    await unlimited.pause(2)
+    assert store._buckets.keys() == {"provider:demo:tokens"}